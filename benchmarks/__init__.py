@@ -0,0 +1,13 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Benchmarks of marcaroni on synthetic data, run with
+
+    python -m benchmarks.run --rows 1000000 --records 20000
+
+from the top directory. See benchmarks/run.py for the options.
+"""
@@ -0,0 +1,343 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Time marcaroni on a synthetic catalogue and vendor files, and compare the times with a
+stored baseline:
+
+    python -m benchmarks.run --rows 1000000 --records 20000 --save-baseline
+    ... change the code ...
+    python -m benchmarks.run --rows 1000000 --records 20000
+
+The second run exits with status 1 if a benchmark got slower than the baseline by more
+than --tolerance. Baselines only compare between runs of the same size on the same
+machine; the sizes are stored with the times, and a baseline of other sizes is ignored.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout, redirect_stderr
+
+import bibmatcher
+import marcaroni.ils
+import marcaroni.policy
+import marcaroni.snapshot
+import marcaroni.sources
+from marcaroni.normalize import canonical_identifier
+from benchmarks import synthetic
+
+TOP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# The scripts of tools/ that take a .mrc file and nothing else. edit-marc.py only makes
+# sense on Curio records.
+TOOLS = ('deduper.py', 'mrc2csv.py', 'f-mrc2csv.py', 'mrchead.py', 'remove-records-missing-field.py')
+
+# Identifier sets per match_many() call in the match benchmarks, as in bibmatcher.py.
+LOOKUP_BATCH_SIZE = bibmatcher.MATCH_BATCH_SIZE
+
+
+class BenchmarkData:
+    """
+    The files a run of the benchmarks works on, generated into a directory once.
+    """
+    def __init__(self, directory, bibsources, policy, rows, records, match_rate, seed):
+        self.directory = directory
+        self.bibsources = bibsources
+        self.policy = policy
+        self.rows = rows
+        self.records = records
+        self.match_rate = match_rate
+        self.seed = seed
+        self.catalogue = synthetic.Catalogue(bibsources, policy, seed)
+        name = 'bench-%d-%d' % (rows, seed)
+        self.bib_data_file = os.path.join(directory, name + '.txt')
+        self.snapshot_file = os.path.join(directory, name + '.snap')
+        name = 'vendor-%d-%d-%g' % (records, seed, match_rate)
+        self.vendor_files = {
+            '020': os.path.join(directory, name + '-020.mrc'),
+            '035': os.path.join(directory, name + '-035.mrc'),
+        }
+
+    def generate(self):
+        """
+        Write whatever files are not in the directory yet. Files of an earlier run with the
+        same sizes and seed are used as they are.
+        """
+        if not os.path.exists(self.bib_data_file):
+            print("Writing %d rows of bib data to %s" % (self.rows, self.bib_data_file))
+            synthetic.write_bib_data(self.bib_data_file, self.catalogue, self.rows)
+        else:
+            # The catalogue has ids 1 to record_count, and the last row is of the last record.
+            self.catalogue.record_count = int(_last_line(self.bib_data_file).split(',')[1])
+        if not os.path.exists(self.snapshot_file):
+            print("Writing snapshot to %s" % (self.snapshot_file,))
+            synthetic.write_snapshot(self.snapshot_file, self.catalogue, self.rows)
+        for match_field, filename in self.vendor_files.items():
+            if not os.path.exists(filename):
+                print("Writing %d vendor records to %s" % (self.records, filename))
+                synthetic.write_vendor_file(filename, self.catalogue, self.records, self.match_rate, match_field,
+                                            self.seed)
+
+    def identifier_sets(self, match_field):
+        """
+        :return: list of set of str, the canonical identifiers of the vendor records.
+        """
+        return [set(canonical_identifier(value, match_field) for value in identifiers)
+                for identifiers in synthetic.vendor_identifier_sets(self.catalogue, self.records, self.match_rate,
+                                                                    match_field, self.seed)]
+
+    def bib_source(self, match_field):
+        """
+        :return: str, the largest bib source of the catalogue that is matched on match_field.
+        """
+        for source_id in self.catalogue.source_ids:
+            if self.policy.match_field(source_id) == match_field:
+                return source_id
+        return self.catalogue.source_ids[0]
+
+
+def _last_line(filename):
+    with open(filename, 'rb') as fp:
+        fp.seek(max(0, os.path.getsize(filename) - 4096))
+        return fp.read().decode('utf-8').rstrip('\n').rsplit('\n', 1)[-1]
+
+
+def timed(function, repeat):
+    """
+    :return: (float, result), the best time of repeat calls of function, and what the last call returned.
+    """
+    best = None
+    result = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def _load(kind, data, match_field):
+    if kind == 'csv':
+        eg_records = marcaroni.ils.ILSBibData()
+    elif kind == 'compact':
+        eg_records = marcaroni.ils.CompactILSBibData()
+    else:
+        eg_records = marcaroni.snapshot.SnapshotBibData()
+    eg_records.load_from_file(data.snapshot_file if kind == 'snapshot' else data.bib_data_file, match_field)
+    return eg_records
+
+
+def _match_all(eg_records, identifier_sets):
+    matched = 0
+    for start in range(0, len(identifier_sets), LOOKUP_BATCH_SIZE):
+        matched += sum(1 for matches in eg_records.match_many(identifier_sets[start:start + LOOKUP_BATCH_SIZE])
+                       if matches)
+    return matched
+
+
+def _process(data, eg_records, match_field, workers, directory):
+    bibsources = data.bibsources
+    bibsources.set_selected(data.bib_source(match_field))
+    prefix = os.path.join(directory, 'out-%s-%d' % (match_field, workers))
+    shutil.rmtree(prefix, ignore_errors=True)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+        bibmatcher.process_input_files([data.vendor_files[match_field]], bibsources.selected, bibsources,
+                                       eg_records, match_field, data.policy, workers, prefix=prefix)
+
+
+def _run_tool(tool, data, directory):
+    input_file = os.path.join(directory, 'tool-input.mrc')
+    shutil.copyfile(data.vendor_files['020'], input_file)
+    # The tools import marcaroni from the top directory.
+    environment = dict(os.environ, PYTHONPATH=os.path.abspath(TOP_DIRECTORY))
+    subprocess.run([sys.executable, os.path.join(TOP_DIRECTORY, 'tools', tool), input_file], cwd=directory,
+                   env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+
+def run_benchmarks(data, repeat, workers, names=None):
+    """
+    :type data: BenchmarkData
+    :param names: set of str, the benchmarks to run (by name or prefix), or None for all.
+    :return: dict of results by benchmark name: seconds, items and what the items are.
+    """
+    results = {}
+    scratch = tempfile.mkdtemp(dir=data.directory)
+
+    def wanted(name):
+        return names is None or any(name == n or name.startswith(n + '_') for n in names)
+
+    def record(name, seconds, items, unit):
+        results[name] = {'seconds': seconds, 'items': items, 'unit': unit}
+        print("%-36s %10.3f s %12.0f %s/s" % (name, seconds, items / seconds if seconds > 0 else 0, unit))
+
+    try:
+        loaded = {}
+        for kind in ('csv', 'compact', 'snapshot'):
+            for match_field in ('020', '035'):
+                name = 'load_%s_%s' % (kind, match_field)
+                if not wanted(name) and not wanted('match_%s_%s' % (kind, match_field)) \
+                        and not (kind == 'csv' and any(wanted('process_%s_w%d' % (match_field, process_workers))
+                                                       for process_workers in (1, workers))):
+                    continue
+                seconds, eg_records = timed(lambda: _load(kind, data, match_field), repeat)
+                loaded[kind, match_field] = eg_records
+                if wanted(name):
+                    record(name, seconds, data.rows, 'rows')
+
+        if wanted('load_by_tag'):
+            seconds, by_tag = timed(lambda: marcaroni.ils.load_by_tag(data.bib_data_file, ['020', '035']), repeat)
+            record('load_by_tag', seconds, data.rows, 'rows')
+
+        for match_field in ('020', '035'):
+            identifier_sets = data.identifier_sets(match_field)
+            for kind in ('csv', 'compact', 'snapshot'):
+                name = 'match_%s_%s' % (kind, match_field)
+                if wanted(name):
+                    eg_records = loaded[kind, match_field]
+                    seconds, matched = timed(lambda: _match_all(eg_records, identifier_sets), repeat)
+                    record(name, seconds, len(identifier_sets), 'lookups')
+
+        for match_field in ('020', '035'):
+            for process_workers in sorted(set((1, workers))):
+                name = 'process_%s_w%d' % (match_field, process_workers)
+                if wanted(name):
+                    eg_records = loaded['csv', match_field]
+                    seconds, result = timed(lambda: _process(data, eg_records, match_field, process_workers,
+                                                             scratch), repeat)
+                    record(name, seconds, data.records, 'records')
+
+        for tool in TOOLS:
+            name = 'tools_' + os.path.splitext(tool)[0].replace('-', '_')
+            if wanted(name):
+                seconds, result = timed(lambda: _run_tool(tool, data, scratch), repeat)
+                record(name, seconds, data.records, 'records')
+    finally:
+        shutil.rmtree(scratch)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: dict, as returned by run_benchmarks().
+    :param baseline: dict, results of an earlier run.
+    :param tolerance: float, how much slower than the baseline is still fine, e.g. 0.25.
+    :return: list of str, one line per benchmark slower than that.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        if result['seconds'] > before * (1 + tolerance):
+            regressions.append("%s: %.3f s, was %.3f s (+%.0f%%)" % (
+                name, result['seconds'], before, (result['seconds'] / before - 1) * 100))
+    return regressions
+
+
+def read_baseline(filename, sizes):
+    """
+    :param sizes: dict, the sizes of this run.
+    :return: dict of results, or None if there is no baseline of these sizes.
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as fp:
+        baseline = json.load(fp)
+    if baseline.get('sizes') != sizes:
+        print("Baseline %s is of other sizes (%s); not comparing." % (filename, baseline.get('sizes')))
+        return None
+    return baseline['results']
+
+
+def write_baseline(filename, sizes, results):
+    with open(filename, 'w') as fp:
+        json.dump({'sizes': sizes, 'results': results}, fp, indent=1, sort_keys=True)
+        fp.write('\n')
+
+
+def parse_cmd_line():
+    parser = optparse.OptionParser(usage="python -m benchmarks.run [options] [BENCHMARK ...]",
+                                   description="Benchmarks are named load_*, load_by_tag, match_*, process_* and "
+                                               "tools_*. Give names or prefixes (e.g. load match_csv) to run only "
+                                               "those.")
+    parser.add_option("--rows", dest="rows", type="int", default=1000000,
+                      help="Rows of synthetic bib data. [default: %default]")
+    parser.add_option("--records", dest="records", type="int", default=20000,
+                      help="Records in each synthetic vendor file. [default: %default]")
+    parser.add_option("--match-rate", dest="match_rate", type="float", default=0.6,
+                      help="Share of the vendor records that match the bib data. [default: %default]")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="Seed of the synthetic data. [default: %default]")
+    parser.add_option("--data-dir", dest="data_dir", default=None,
+                      help="Keep the generated files in this directory, and reuse them next time. "
+                           "[default: a temporary directory]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Run each benchmark this many times and keep the best. [default: %default]")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=os.cpu_count() or 1,
+                      help="Also time process_* with this many workers. [default: %default]")
+    parser.add_option("--baseline", dest="baseline", default=DEFAULT_BASELINE_FILE,
+                      help="Baseline to compare with. [default: %default]")
+    parser.add_option("--save-baseline", dest="save_baseline", action="store_true", default=False,
+                      help="Store the times of this run as the baseline.")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.25,
+                      help="Flag a benchmark slower than the baseline by more than this share. [default: %default]")
+    parser.add_option("--bib-source-file", dest="bib_source_file",
+                      default=os.path.join(TOP_DIRECTORY, 'conf', 'bib_sources.csv'),
+                      help="Bib sources to spread the synthetic records over. [default: %default]")
+    opts, args = parser.parse_args()
+    if opts.rows < 1 or opts.records < 1:
+        parser.error("--rows and --records must be at least 1.")
+    if not 0 <= opts.match_rate <= 1:
+        parser.error("--match-rate must be between 0 and 1.")
+    if opts.repeat < 1 or opts.workers < 1:
+        parser.error("--repeat and --workers must be at least 1.")
+    return opts, set(args) or None
+
+
+def main():
+    opts, names = parse_cmd_line()
+    bibsources = marcaroni.sources.BibSourceRegistry()
+    bibsources.load_from_file(opts.bib_source_file)
+    policy = marcaroni.policy.MatchPolicy()
+    policy.load_from_file()
+
+    directory = opts.data_dir or tempfile.mkdtemp(prefix='marcaroni-bench-')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        data = BenchmarkData(directory, bibsources, policy, opts.rows, opts.records, opts.match_rate, opts.seed)
+        data.generate()
+        results = run_benchmarks(data, opts.repeat, opts.workers, names)
+    finally:
+        if not opts.data_dir:
+            shutil.rmtree(directory)
+
+    sizes = {'rows': opts.rows, 'records': opts.records, 'match_rate': opts.match_rate, 'seed': opts.seed}
+    if opts.save_baseline:
+        write_baseline(opts.baseline, sizes, results)
+        print("Saved baseline to %s" % (opts.baseline,))
+        return
+    baseline = read_baseline(opts.baseline, sizes)
+    if baseline is None:
+        return
+    regressions = compare(results, baseline, opts.tolerance)
+    if regressions:
+        print("Slower than the baseline:")
+        for line in regressions:
+            print("  " + line)
+        sys.exit(1)
+    print("No regressions against %s." % (opts.baseline,))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Synthetic bib data and vendor files, for benchmarks.
+
+The catalogue is a function of the bib id: the source of a record and its identifiers
+are worked out from a hash of its id, so a vendor file can pick any record and know
+its identifiers without keeping the catalogue in memory, and a run with the same seed
+always writes the same files.
+
+Each catalogue record has:
+
+    020 $a  its e-ISBN, 978 0 <bib id>. Some records are another platform's copy of an
+            earlier record, and share its e-ISBN.
+    020 $z  a print ISBN, 978 1 <bib id>, on some records.
+    035 $a  an OCLC number on some records, and a vendor number on every record of a
+            bib source matched on 035.
+
+The sources are spread over conf/bib_sources.csv with a few large sources and a long
+tail, as in a real catalogue. Vendor records that should not match get ISBNs from
+978 9, which the catalogue never uses.
+"""
+
+import csv
+import random
+from bisect import bisect_right
+from itertools import accumulate
+
+from pymarc import Record, Field
+
+from marcaroni.normalize import canonical_identifier
+
+# Percent of the records that have each of these.
+PRINT_ISBN_PERCENT = 40
+OCLC_PERCENT = 60
+SHARED_ISBN_PERCENT = 15
+
+# Up to 10^8 bib ids fit in the ISBN ranges below.
+MAX_RECORDS = 10 ** 8
+
+_MASK = (1 << 64) - 1
+
+
+def isbn(group, number):
+    """
+    :param group: int, 0 for e-ISBNs, 1 for print ISBNs, 9 for ISBNs not in the catalogue.
+    :type number: int
+    :return: str, an ISBN-13 with a valid check digit.
+    """
+    first_12_digits = '978%d%08d' % (group, number)
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(first_12_digits))
+    return first_12_digits + str((10 - total % 10) % 10)
+
+
+class Catalogue:
+    """
+    The synthetic catalogue of one seed.
+    """
+    def __init__(self, bibsources, policy, seed=1):
+        """
+        :type bibsources: marcaroni.sources.BibSourceRegistry
+        :type policy: marcaroni.policy.MatchPolicy
+        :type seed: int
+        """
+        self.seed = seed
+        self.record_count = 0
+        source_ids = sorted(bibsources.bib_source_by_id, key=int)
+        random.Random(seed).shuffle(source_ids)
+        self.source_ids = source_ids
+        # Zipf-like: the n-th source has 1/n of the records of the first.
+        self.cumulative_weights = list(accumulate(1.0 / (rank + 1) for rank in range(len(source_ids))))
+        self.matched_on_035 = set(source_id for source_id in source_ids if policy.match_field(source_id) == '035')
+
+    def _hash(self, bib_id, salt):
+        # splitmix64, good enough to spread consecutive ids.
+        x = (bib_id * 0x9E3779B97F4A7C15 + self.seed * 0xBF58476D1CE4E5B9 + salt) & _MASK
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK
+        return x ^ (x >> 31)
+
+    def source(self, bib_id):
+        """
+        :type bib_id: int
+        :return: str, the bib source id of the record.
+        """
+        u = (self._hash(bib_id, 1) >> 11) / float(1 << 53) * self.cumulative_weights[-1]
+        return self.source_ids[min(bisect_right(self.cumulative_weights, u), len(self.source_ids) - 1)]
+
+    def e_isbn(self, bib_id):
+        if bib_id > 1 and self._hash(bib_id, 2) % 100 < SHARED_ISBN_PERCENT:
+            bib_id = 1 + self._hash(bib_id, 3) % (bib_id - 1)
+        return isbn(0, bib_id)
+
+    def oclc_number(self, bib_id):
+        """
+        :return: str, or None if the record has no OCLC number.
+        """
+        if self._hash(bib_id, 4) % 100 < OCLC_PERCENT:
+            return '(OCoLC)%d' % (bib_id,)
+        return None
+
+    def vendor_number(self, bib_id):
+        """
+        :return: str, or None if the record's bib source is not matched on 035.
+        """
+        source = self.source(bib_id)
+        if source in self.matched_on_035:
+            return '(V%s)%d' % (source, bib_id)
+        return None
+
+    def identifiers(self, bib_id):
+        """
+        :return: list of (identifier, tag, subfield), as they are written to the bib data file.
+        """
+        identifiers = [(self.e_isbn(bib_id), '020', 'a')]
+        if self._hash(bib_id, 5) % 100 < PRINT_ISBN_PERCENT:
+            identifiers.append((isbn(1, bib_id), '020', 'z'))
+        for value in (self.oclc_number(bib_id), self.vendor_number(bib_id)):
+            if value is not None:
+                identifiers.append((canonical_identifier(value, '035'), '035', 'a'))
+        return identifiers
+
+    def rows(self, row_count):
+        """
+        Rows of a bib data file, for bib ids from 1 up, until there are row_count of them.
+        record_count is left at the number of records written.
+
+        :return: iterator of (identifier, id, source, tag, subfield)
+        """
+        written = 0
+        bib_id = 0
+        while written < row_count:
+            bib_id += 1
+            if bib_id > MAX_RECORDS:
+                raise ValueError("At most %d records fit in a synthetic catalogue." % (MAX_RECORDS,))
+            source = self.source(bib_id)
+            for identifier, tag, subfield in self.identifiers(bib_id):
+                yield identifier, str(bib_id), source, tag, subfield
+                written += 1
+            self.record_count = bib_id
+
+    def random_record(self, rng, has_oclc_number=False):
+        """
+        :type rng: random.Random
+        :return: int, a bib id of the catalogue.
+        """
+        while True:
+            bib_id = rng.randint(1, self.record_count)
+            if not has_oclc_number or self.oclc_number(bib_id) is not None:
+                return bib_id
+
+
+def write_bib_data(filename, catalogue, row_count):
+    """
+    Write a bib data file as update-data.py does.
+
+    :return: int, the number of records in it.
+    """
+    with open(filename, 'w', newline='') as fp:
+        writer = csv.writer(fp, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['identifier', 'id', 'source', 'tag', 'subfield'])
+        writer.writerows(catalogue.rows(row_count))
+    return catalogue.record_count
+
+
+def write_snapshot(filename, catalogue, row_count):
+    """
+    Write the same rows as write_bib_data() as a snapshot.
+
+    :return: int, the number of records in it.
+    """
+    from marcaroni.snapshot import SnapshotBuilder
+
+    builder = SnapshotBuilder()
+    for row in catalogue.rows(row_count):
+        builder.add(row)
+    builder.write(filename)
+    return catalogue.record_count
+
+
+def vendor_record(sequence, identifiers, match_field, publisher=None):
+    """
+    :param identifiers: list of str, raw 020 or 035 values.
+    :rtype: pymarc.Record
+    """
+    record = Record(force_utf8=True)
+    record.leader = record.leader[:9] + 'a' + record.leader[10:]
+    record.add_field(Field(tag='001', data='bench%d' % (sequence,)))
+    for value in identifiers:
+        record.add_field(Field(tag=match_field, indicators=[' ', ' '], subfields=['a', value]))
+    record.add_field(Field(tag='245', indicators=['1', '0'],
+                           subfields=['a', 'Synthetic title %d :' % (sequence,), 'b', 'a benchmark record.']))
+    if publisher:
+        record.add_field(Field(tag='264', indicators=[' ', '1'], subfields=['b', publisher]))
+    record.add_field(Field(tag='856', indicators=['4', '0'],
+                           subfields=['u', 'https://ebooks.example.com/detail.action?docID=%d' % (sequence,)]))
+    return record
+
+
+def vendor_identifier_sets(catalogue, record_count, match_rate, match_field='020', seed=1,
+                           missing_percent=2):
+    """
+    The raw identifiers of the records of a vendor file. About match_rate of the records
+    carry an identifier of a catalogue record.
+
+    :type match_rate: float
+    :param missing_percent: int, percent of the records without any identifier.
+    :return: list of list of str
+    """
+    rng = random.Random(seed)
+    identifier_sets = []
+    for sequence in range(record_count):
+        if rng.randrange(100) < missing_percent:
+            identifier_sets.append([])
+        elif match_field == '035':
+            if rng.random() < match_rate:
+                identifier_sets.append([catalogue.oclc_number(catalogue.random_record(rng, True))])
+            else:
+                identifier_sets.append(['(OCoLC)%d' % (MAX_RECORDS + sequence,)])
+        elif rng.random() < match_rate:
+            bib_id = catalogue.random_record(rng)
+            identifier_sets.append([catalogue.e_isbn(bib_id) + ' (ebook)', isbn(1, bib_id) + ' (print)'])
+        else:
+            identifier_sets.append([isbn(9, sequence % MAX_RECORDS) + ' (ebook)'])
+    return identifier_sets
+
+
+def write_vendor_file(filename, catalogue, record_count, match_rate, match_field='020', seed=1):
+    """
+    Write a .mrc vendor file of record_count records, about match_rate of which match the
+    catalogue.
+
+    :return: int, the number of records written.
+    """
+    identifier_sets = vendor_identifier_sets(catalogue, record_count, match_rate, match_field, seed)
+    with open(filename, 'wb') as fp:
+        for sequence, identifiers in enumerate(identifier_sets):
+            publisher = 'Nova Science Publishers' if sequence % 97 == 0 else None
+            fp.write(vendor_record(sequence, identifiers, match_field, publisher).as_marc())
+    return len(identifier_sets)
@@ -9,7 +9,9 @@ from io import BytesIO
 import re
 import sys
 from datetime import datetime, timedelta
+from marcaroni import compress
 from marcaroni import db
+import marcaroni.metrics
 import optparse
 import psycopg2.extras
 import os
@@ -26,12 +28,18 @@ def parse_config():
                       help="Numerical id of bib source for this batch. If empty, will prompt for this.")
     parser.add_option("-u", "--user", dest="user_id", default='1',
                       help="User id of the record creator and editor. [default: %default]")
+    parser.add_option("--metrics", dest="metrics", default=None,
+                      help="Time the stages of the load (parse, xml, copy, execute_batch), and write them as JSON "
+                           "to this file and as a Prometheus textfile next to it (.prom).")
+    parser.add_option("--profile", dest="profile", default=None,
+                      help="Run under cProfile and save the profile to this file.")
     opts, args = parser.parse_args()
+    marcaroni.metrics.measure_until_exit('bib-insert', opts.metrics, opts.profile, record_stage='execute_batch')
     return opts.init, opts.source, opts.test, opts.silent, opts.user_id, args[0]
 
 def load_marc_reader(filename):
     try:
-        handler = open(filename, "rb")
+        handler = compress.open_input(filename)
         reader = MARCReader(handler, to_unicode=True, force_utf8=True)
     except Exception as e:
         print("Error loading marc file")
@@ -41,21 +49,22 @@ def load_marc_reader(filename):
         return reader
 
 def marc_record_to_xml_string(record):
-    b = BytesIO()
-    writer = XMLWriter(b)
-    writer.write(record)
-    writer.close(close_fh=False)
-
-    # Transform record from bytes to string.
-    b.seek(0,0)
-    bytestr = b.read()
-    marc = bytestr.decode('UTF-8')
-
-    # Remove the XML declaration and collection stuff.
-    marc = re.sub(r'^.*<collection[^>]*>','',marc)
-    marc = re.sub(r'</collection>$','',marc)
-    # Remove tab characters.
-    marc = re.sub(r'\t','',marc)
+    with marcaroni.metrics.stage('xml'):
+        b = BytesIO()
+        writer = XMLWriter(b)
+        writer.write(record)
+        writer.close(close_fh=False)
+
+        # Transform record from bytes to string.
+        b.seek(0,0)
+        bytestr = b.read()
+        marc = bytestr.decode('UTF-8')
+
+        # Remove the XML declaration and collection stuff.
+        marc = re.sub(r'^.*<collection[^>]*>','',marc)
+        marc = re.sub(r'</collection>$','',marc)
+        # Remove tab characters.
+        marc = re.sub(r'\t','',marc)
 
     # Verify cleaning worked:
     if not marc.startswith('<record'):
@@ -67,8 +76,9 @@ def marc_record_to_xml_string(record):
 def copy_marc_into_insert_staging(conn, reader):
     with conn.cursor() as cursor:
         record_string_iterator = db.StringIteratorIO(((marc_record_to_xml_string(record)) + '\n'
-                                                       for record in reader))
-        cursor.copy_from(record_string_iterator,'public.custom_insert_staging_test', sep='\t', columns=['marc'])
+                                                       for record in marcaroni.metrics.timed(reader, 'parse')))
+        with marcaroni.metrics.stage('copy'):
+            cursor.copy_from(record_string_iterator,'public.custom_insert_staging_test', sep='\t', columns=['marc'])
     conn.commit()
 
 def push_staging_to_bre_simple(conn):
@@ -78,7 +88,8 @@ def push_staging_to_bre_simple(conn):
         row_ids = cursor.fetchall()
 
         cursor.execute("PREPARE stmt AS UPDATE public.custom_insert_staging_test SET finished = TRUE where id = $1;")
-        psycopg2.extras.execute_batch(cursor,"EXECUTE stmt (%s)", row_ids)
+        with marcaroni.metrics.stage('execute_batch', len(row_ids)):
+            psycopg2.extras.execute_batch(cursor,"EXECUTE stmt (%s)", row_ids)
         cursor.execute("DEALLOCATE stmt")
     conn.commit()
 
@@ -104,7 +115,8 @@ def insert_staged_records_to_biblio_record_entry(conn, bib_source, user_id, sile
                        "    AND EXISTS (SELECT 1 from ins)"
                        , (user_id, user_id, bib_source))
 
-        psycopg2.extras.execute_batch(cursor,"EXECUTE stmt (%s)", row_ids)
+        with marcaroni.metrics.stage('execute_batch', len(row_ids)):
+            psycopg2.extras.execute_batch(cursor,"EXECUTE stmt (%s)", row_ids)
         cursor.execute("DEALLOCATE stmt")
     conn.commit()
 
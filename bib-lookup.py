@@ -0,0 +1,63 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+##
+# Given files of bib ids (e.g. exact_match_ids.txt), print the source and identifiers
+# of each record from a bib data snapshot, without going to the database.
+
+import csv
+import optparse
+import os
+import sys
+
+import marcaroni.snapshot
+
+
+def parse_cmd_line():
+    parser = optparse.OptionParser(usage="%prog -d bib-data.snap ID_FILE [ ... ID_FILE_N ]")
+    parser.add_option("-d", "--bib-data", dest="bib_data", default="bib-data.snap",
+                      help="Snapshot of Bib Data to use, as written by update-data.py --snapshot. [default: %default]")
+    opts, args = parser.parse_args()
+
+    if not os.path.exists(opts.bib_data) or not marcaroni.snapshot.is_snapshot(opts.bib_data):
+        parser.error("Bib data snapshot [%s] not found." % (opts.bib_data,))
+    if len(args) < 1:
+        parser.error("Need at least one file of bib ids on command line.")
+    return opts.bib_data, args
+
+
+def read_ids(filename):
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if not line.isdigit():
+                print('Bad input - %s' % (line,), file=sys.stderr)
+                continue
+            yield line
+
+
+def main():
+    bib_data_file_name, id_files = parse_cmd_line()
+    records = marcaroni.snapshot.RecordIndex(marcaroni.snapshot.Snapshot(bib_data_file_name))
+    writer = csv.writer(sys.stdout, dialect='excel-tab')
+    writer.writerow(('BibId', 'Source', 'Identifiers'))
+    for filename in id_files:
+        if not os.path.exists(filename):
+            print("File not found: [%s]" % (filename,), file=sys.stderr)
+            continue
+        for bib_id in read_ids(filename):
+            record = records.get(bib_id)
+            if record is None:
+                writer.writerow((bib_id, 'NULL', ''))
+                continue
+            writer.writerow((record.id, record.source,
+                             '; '.join('%s %s' % (tag, identifier) for tag, identifier in record.identifiers)))
+
+
+if __name__ == '__main__':
+    main()
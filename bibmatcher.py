@@ -5,20 +5,30 @@
 #vim: shiftwidth=4:
 import sys
 import csv
+import io
 import os
 import optparse
+import multiprocessing
+from contextlib import redirect_stdout, redirect_stderr
 from collections import namedtuple
 from collections import Counter
 import datetime
 import re
 
 from pymarc.field import Field
-from pymarc import MARCReader
-import isbnlib
 
+import marcaroni.checkpoint
+import marcaroni.compress
+import marcaroni.fallback
 import marcaroni.ils
+import marcaroni.metrics
+import marcaroni.normalize
+import marcaroni.snapshot
 import marcaroni.sources
 import marcaroni.output
+import marcaroni.policy
+import marcaroni.rawmarc
+import marcaroni.server
 
 
 def no_op_filter_function(remaining_matches, bib_source_of_inputs, bibsources, marc_record):
@@ -29,6 +39,9 @@ FILTER_FUNCTIONS = [
     no_op_filter_function,
 ]
 
+# Records (or spreadsheet rows) matched per call to match_many().
+MATCH_BATCH_SIZE = 1000
+
 
 def filter_matches(matches, bib_source_of_inputs, bibsources, marc_record):
     """
@@ -84,7 +97,9 @@ def handle_special_actions_and_misc_reports(output_handler, matches, bib_source_
 PredicateVector = namedtuple('PredicateVector', ['match_is_dda',
                                                  'match_is_same_platform',
                                                  'match_is_better_license',
-                                                 'match_is_odd_bibsource'])
+                                                 'match_is_odd_bibsource',
+                                                 'match_is_same_bibsource'],
+                             defaults=[False])
 
 
 def license_comparator(license_of_existing, license_of_input):
@@ -104,12 +119,21 @@ def license_comparator(license_of_existing, license_of_input):
         return False
 
 
-def compute_predicates_for_match(match, match_bib_source, bib_source_of_input, marc_record):
+def compute_predicates_for_match(match_bib_source, bib_source_of_input, policy):
+    """
+    Everything the rules need to know about a match, which only depends on its bib source.
+
+    :type match_bib_source: BibSource
+    :type bib_source_of_input: BibSource
+    :type policy: marcaroni.policy.MatchPolicy
+    :rtype: PredicateVector
+    """
     return PredicateVector(
         match_is_dda=match_bib_source.license == 'dda',
         match_is_same_platform=match_bib_source.platform == bib_source_of_input.platform,
         match_is_better_license=license_comparator(match_bib_source.license, bib_source_of_input.license),
-        match_is_odd_bibsource=(match_bib_source.id in ['81', '59', '56', '43', '22', '21', '9', '6'])
+        match_is_odd_bibsource=(match_bib_source.id in policy.odd_bib_sources),
+        match_is_same_bibsource=match_bib_source.id == bib_source_of_input.id
     )
 
 def ambiguous_if_matches_on_ambiguous_bibsource(marc_record, bib_source_of_input, predicate_vectors, output_handler):
@@ -123,7 +147,7 @@ def ambiguous_if_matches_on_ambiguous_bibsource(marc_record, bib_source_of_input
     """
     n = len(predicate_vectors)
     for matching_record in list(predicate_vectors.keys()):
-        if matching_record.source in ['81', '59', '56', '43', '22', '21', '9', '6']:
+        if predicate_vectors[matching_record].match_is_odd_bibsource:
             output_handler.ambiguous(marc_record, "Record matched " + str(n) + " record(s), including at least one "
                                                                           "ambiguous bibsource. record: " +
                                      matching_record.id + " source: " + matching_record.source)
@@ -151,22 +175,25 @@ def ignore_if_new_record_is_dda_and_better_is_available(marc_record, bib_source_
     return False
 
 def ignore_depending_on_publisher(marc_record, bib_source_of_input, predicate_vectors,
-                                                        output_handler):
+                                                        output_handler, publishers=()):
     """
+    This one looks at the record itself, so it is checked before matching rather than
+    being part of the decision table.
 
     :param marc_record:
     :param bib_source_of_input: BibSource
     :type predicate_vectors: Dict[Record, PredicateVector]
     :type output_handler: OutputRecordHandler
+    :param publishers: list of str, publishers whose records this bib source never loads.
     :rtype: bool
     """
-    if bib_source_of_input.id != '1':
+    if not publishers:
         return False
     pub_tags = ['264', '260']
     for tag in pub_tags:
       for f in marc_record.marc.get_fields(tag):
         if f['b']:
-            if f['b'].startswith('Nova Science'):
+            if f['b'].startswith(tuple(publishers)):
                 output_handler.match_is_better(marc_record)
                 return True
     return False
@@ -264,124 +291,312 @@ def handle_same_platform_matches(marc_record, bib_source_of_input, predicate_vec
     return True
 
 
-RULES = [
-    #ambiguous_if_matches_on_ambiguous_bibsource,
-    ignore_depending_on_publisher,
+# The rules a match policy can use, by name. The order they are tried in is set in
+# conf/match_policy.ini.
+RULES_BY_NAME = {rule.__name__: rule for rule in [
+    ambiguous_if_matches_on_ambiguous_bibsource,
     ignore_if_new_record_is_dda_and_better_is_available,
     update_same_dda_record_if_unambiguous,
     mark_as_ambiguous_new_record_is_dda_and_better_is_not_available,
     add_if_all_matches_are_on_other_platforms,
     handle_same_platform_matches,
-]
+]}
 
 
-def process_input_files(input_files, bib_source_of_input, bibsources, eg_records, match_field):
+def checkpoint_state(output_handler, input_files, input_index, input_offset, records_processed_count,
+                     bib_source_of_input, match_field, finished=False):
+    """
+    :return: dict, for marcaroni.checkpoint.Checkpoint.save().
+    """
+    input_files = [os.path.abspath(filename) for filename in input_files]
+    digest = None
+    if input_index < len(input_files):
+        digest = marcaroni.checkpoint.input_digest(input_files[input_index], input_offset)
+    return {
+        'input_files': input_files,
+        'input_index': input_index,
+        'input_offset': input_offset,
+        'input_digest': digest,
+        'records_processed_count': records_processed_count,
+        'bib_source': bib_source_of_input.id,
+        'match_field': match_field,
+        'finished': finished,
+        'output': output_handler.checkpoint_state(),
+    }
+
+
+def process_input_files(input_files, bib_source_of_input, bibsources, eg_records, match_field, policy, workers=1,
+                        prefix=None, resume=False, compression=None):
+    """
+    :param input_files: list of str, .mrc files, or .mrc files compressed (e.g. .mrc.gz).
+    :param prefix: str, the output directory. Named after the first input file if not given.
+    :param resume: bool, carry on from the checkpoint of an earlier run into the same output directory.
+    :param compression: str, 'gz', 'bz2' or 'xz' to write the .mrc output files compressed.
+    """
     output_handler = None
+    checkpoint = None
+    state = None
     bibsource_prefix = re.sub('[^A-Za-z0-9]','_',bib_source_of_input.name)
-    for filename in input_files:
-        f, ext = os.path.splitext(filename)
-        if ext != '.mrc':
-            print("This is not a marc file: " + filename)
-            exit(1)
-        if output_handler is None:
-            output_handler = marcaroni.output.OutputRecordHandler(prefix=os.path.splitext(filename)[0], bibsource_prefix=bibsource_prefix)
-        with open(filename, 'rb') as handler:
-            if output_handler is not None:
-                output_handler.logger("Bibsource: %s"%(bib_source_of_input.name))
-            reader = MARCReader(handler, to_unicode=True, force_utf8=True)
-            total_record_count = process_mrc_file(eg_records, reader, output_handler, bib_source_of_input, bibsources, match_field)
-            if output_handler is not None:
-                output_handler.print_report(bibsources, total_record_count)
-
-def extract_identifiers_from_row(row, isbn_columns):
-    cols = [int(x) for x in isbn_columns.split(',')]
+    try:
+        for input_index, filename in enumerate(input_files):
+            f, ext = os.path.splitext(marcaroni.compress.uncompressed_name(filename))
+            if ext != '.mrc':
+                print("This is not a marc file: " + filename)
+                exit(1)
+            if output_handler is None:
+                prefix = prefix or f
+                checkpoint = marcaroni.checkpoint.Checkpoint(prefix)
+                try:
+                    if resume:
+                        state = checkpoint.load()
+                        checkpoint.check(state, input_files, bib_source_of_input.id, match_field)
+                        if state['finished']:
+                            print("The run into %s has already finished." % (prefix,))
+                            return
+                    output_handler = marcaroni.output.OutputRecordHandler(prefix=prefix,
+                                                                          bibsource_prefix=bibsource_prefix,
+                                                                          checkpoint=state and state['output'],
+                                                                          compression=compression)
+                except marcaroni.checkpoint.CheckpointError as e:
+                    print(e)
+                    sys.exit(1)
+
+            records_processed_count = 0
+            input_offset = 0
+            if state is not None:
+                if input_index < state['input_index']:
+                    continue
+                if input_index == state['input_index']:
+                    records_processed_count = state['records_processed_count']
+                    input_offset = state['input_offset']
+                    print("Resuming %s after record %d." % (filename, records_processed_count))
+
+            def save_checkpoint(records_done, records_end, force=False):
+                # Called between batches, when every record before records_end is written out.
+                if force or checkpoint.due():
+                    checkpoint.save(checkpoint_state(output_handler, input_files, input_index, records_end,
+                                                     records_done, bib_source_of_input, match_field))
+
+            with marcaroni.compress.open_input(filename) as handler:
+                if output_handler is not None:
+                    output_handler.logger("Bibsource: %s"%(bib_source_of_input.name))
+                if workers > 1:
+                    total_record_count = process_mrc_file_in_parallel(eg_records, handler, output_handler, bibsources,
+                                                                      match_field, policy, workers,
+                                                                      records_processed_count, input_offset,
+                                                                      save_checkpoint)
+                else:
+                    raw_records = marcaroni.rawmarc.read_raw_records(handler, input_offset)
+                    total_record_count = process_mrc_file(eg_records, raw_records, output_handler, bib_source_of_input,
+                                                          bibsources, match_field, policy, records_processed_count,
+                                                          input_offset, save_checkpoint)
+                if output_handler is not None:
+                    output_handler.print_report(bibsources, total_record_count)
+            checkpoint.save(checkpoint_state(output_handler, input_files, input_index + 1, 0, 0, bib_source_of_input,
+                                             match_field, finished=input_index + 1 == len(input_files)))
+    finally:
+        if output_handler is not None:
+            output_handler.close()
+
+def extract_identifiers_from_row(row, identifier_columns, match_field='020'):
+    """
+    :type row: list[str]
+    :param identifier_columns: list of int, counting from 0.
+    :type match_field: str
+    :return: set of str
+    """
     isbns = set()
-    for isbn_column in cols:
+    for isbn_column in identifier_columns:
+        if isbn_column >= len(row):
+            continue
         raw = row[isbn_column].strip('"=')
-        isbns.add(raw)
-        # Transform to ISBN 10 or 13.
-        if isbnlib.is_isbn13(raw):
-            isbns.add(isbnlib.to_isbn10(raw))
-        elif isbnlib.is_isbn10(raw):
-            isbns.add(isbnlib.to_isbn13(raw))
+        identifier = marcaroni.normalize.canonical_identifier(raw, match_field)
+        if identifier is not None:
+            isbns.add(identifier)
     return isbns
 
 
-def match_input_files(input_files, bibsources, eg_records, isbn_columns, negate):
+# Column headings that hold identifiers of each match field.
+IDENTIFIER_HEADINGS = {
+    '020': re.compile(r'isbn|\b020\b', re.IGNORECASE),
+    '035': re.compile(r'oclc|\b035\b|control num', re.IGNORECASE),
+    '856': re.compile(r'url|link|\b856\b', re.IGNORECASE),
+}
+
+# Rows looked at to find identifier columns when the headings don't tell.
+SNIFF_ROWS = 50
+
+
+def detect_identifier_columns(first_row, sample_rows, match_field):
+    """
+    Find the identifier columns of a spreadsheet, first by their heading, then by
+    whether most of their values are identifiers.
+
+    :type first_row: list[str]
+    :type sample_rows: list[list[str]]
+    :type match_field: str
+    :return: list of int, empty if none were found.
+    """
+    heading = IDENTIFIER_HEADINGS.get(match_field)
+    if heading is not None:
+        columns = [i for i, name in enumerate(first_row) if heading.search(name)]
+        if columns:
+            return columns
+    if match_field != '020':
+        # Only ISBNs are distinctive enough to recognize by their values.
+        return []
+    columns = []
+    for i in range(len(first_row)):
+        values = [row[i].strip('"=') for row in sample_rows if i < len(row) and row[i].strip('"=')]
+        isbns = [value for value in values if marcaroni.normalize.canonical_identifier(value, '020')]
+        if values and len(isbns) * 2 > len(values):
+            columns.append(i)
+    return columns
+
+
+def match_rows(rows, bibsources, eg_records, identifier_columns, match_field, other_sources_on_platform):
+    """
+    Match a chunk of spreadsheet rows with one call to match_many().
+
+    :return: (list of rows with the match columns in front, Counter of matches by source)
+    """
+    with marcaroni.metrics.stage('extract', len(rows)):
+        identifier_sets = [extract_identifiers_from_row(row, identifier_columns, match_field) for row in rows]
+    with marcaroni.metrics.stage('lookup', len(rows)):
+        batch_matches = eg_records.match_many(identifier_sets)
+    histogram = Counter()
+    out_rows = []
+    for row, matches in zip(rows, batch_matches):
+        # Add to histogram.
+        for x in matches:
+            histogram[x.source] += 1
+
+        # sort matches.
+        matches_with_same_bibsource = []
+        matches_with_same_platform = []
+        matches_with_different_platform = []
+        for match in matches:
+            if match.source == bibsources.selected.id:
+                matches_with_same_bibsource.append(match)
+            elif match.source in other_sources_on_platform:
+                matches_with_same_platform.append(match)
+            else:
+                matches_with_different_platform.append(match)
+
+        # Create printable strings, one per output column.
+        out_rows.append([csvify(matches_with_same_bibsource),
+                         csvify(matches_with_same_platform),
+                         csvify(matches_with_different_platform)] + row)
+    return out_rows, histogram
+
+
+def read_row_chunks(reader, first_rows=(), chunk_size=MATCH_BATCH_SIZE):
+    """
+    :param reader: csv reader, positioned after the heading.
+    :param first_rows: rows already read from reader.
+    :return: iterator of lists of rows
+    """
+    chunk = list(first_rows)
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _match_rows_chunk(rows, identifier_columns):
+    bibsources = _worker['bibsources']
+    result = match_rows(rows, bibsources, _worker['eg_records'], identifier_columns, _worker['match_field'],
+                        bibsources.other_sources_on_platform())
+    return result + (take_worker_metrics(),)
+
+
+def match_input_files(input_files, bibsources, eg_records, isbn_columns, negate, match_field='020', workers=1):
     '''
     This function is for the Excel matching. Spreadsheet must have a header row.
 
     :param input_files:
     :param bibsources: BibSourceRegistry
     :param eg_records: ILSBibData
-    :param isbn_columns: str
+    :param isbn_columns: list of int, or None to find them from the header row (or ask).
     :param negate:
+    :param match_field: str, the tag the identifier columns hold.
+    :param workers: int, processes to match chunks of rows over.
     :return:
     '''
 
     other_sources_on_platform = bibsources.other_sources_on_platform()
 
-    for filename in input_files:
-        prefix = os.path.splitext(filename)[0]
+    pool = None
+    shared, published = None, None
+    if workers > 1:
+        shared, published = share_bib_data(eg_records, match_field)
+        pool = multiprocessing.Pool(workers, _init_worker, (shared, bibsources, None, metrics_enabled()))
 
-        # Avoiding output handler. Just throw -matched.csv on there. FIXME - use different handler?
-        outfile = open(prefix + '-matched.csv', 'w')
-        out_writer = csv.writer(outfile)
+    try:
+        for filename in input_files:
+            prefix = os.path.splitext(marcaroni.compress.uncompressed_name(filename))[0]
 
-        with open(filename, 'r') as handler:
-            reader = csv.reader(handler)
+            # Avoiding output handler. Just throw -matched.csv on there. FIXME - use different handler?
+            outfile = open(prefix + '-matched.csv', 'w')
+            out_writer = csv.writer(outfile)
 
-            # If on first try you get a single column, try again with tab delimiter.
-            first_row = next(reader)
-            if len(first_row) < 2:
-                reader = csv.reader(handler, delimiter='\t')
-                first_row = next(reader)
+            with marcaroni.compress.open_input(filename, 'r') as handler:
+                reader = csv.reader(handler)
 
-            # OUTPUT - requires first line.
-            # Add our custom output columns, and write first row of output spreadsheet.
-            # Columns are: Same bibsource, Same platform, Other platforms
-            first_row[0:0] = ['Same bibsource', 'Same platform', 'Other platforms']
-            out_writer.writerow(first_row)
-
-            histogram = Counter()
-
-            for row in reader:
-                matches = set()
-
-                isbns = extract_identifiers_from_row(row, isbn_columns)
-                matches = eg_records.match(isbns)
-
-                # Add to histogram.
-                for x in matches:
-                    histogram[x.source] += 1
-
-                # sort matches.
-                matches_with_same_bibsource = []
-                matches_with_same_platform = []
-                matches_with_different_platform = []
-                for match in matches:
-                    if match.source == bibsources.selected.id:
-                        matches_with_same_bibsource.append(match)
-                    elif match.source in other_sources_on_platform:
-                        matches_with_same_platform.append(match)
+                # If on first try you get a single column, try again with tab delimiter.
+                first_row = next(reader)
+                if len(first_row) < 2:
+                    reader = csv.reader(handler, delimiter='\t')
+                    first_row = next(reader)
+
+                sample_rows = []
+                identifier_columns = isbn_columns
+                if identifier_columns is None:
+                    sample_rows = [row for _, row in zip(range(SNIFF_ROWS), reader)]
+                    identifier_columns = detect_identifier_columns(first_row, sample_rows, match_field)
+                    if identifier_columns:
+                        print("Identifier columns of %s: %s" %
+                              (filename, ', '.join(first_row[i] for i in identifier_columns)))
                     else:
-                        matches_with_different_platform.append(match)
-
-                # Create printable strings.
-                row.insert(0, [csvify(matches_with_same_bibsource),
-                               csvify(matches_with_same_platform),
-                               csvify(matches_with_different_platform)
-                               ])
-                out_writer.writerow(row)
-
-
-        outfile.close()
-
-        print("\nMatches per Bibsource:")
-        print("\tsource\tcount(records)")
-        for source in sorted(histogram.keys(), reverse=True,
-                             key=lambda x: histogram[x]):
-            print("\t%s: \t%d" % (source, histogram[source]))
+                        identifier_columns = [int(x) for x in input("Identifier (e.g. ISBN) column(s) separated by "
+                                                                    "commas, counting from 0: ").split(',')]
+
+                # OUTPUT - requires first line.
+                # Add our custom output columns, and write first row of output spreadsheet.
+                # Columns are: Same bibsource, Same platform, Other platforms
+                first_row[0:0] = ['Same bibsource', 'Same platform', 'Other platforms']
+                out_writer.writerow(first_row)
+
+                histogram = Counter()
+
+                chunks = read_row_chunks(reader, sample_rows)
+                if pool is None:
+                    results = (match_rows(rows, bibsources, eg_records, identifier_columns, match_field,
+                                          other_sources_on_platform) for rows in chunks)
+                else:
+                    results = (merge_worker_metrics(result) for result in
+                               imap_in_order(pool, _match_rows_chunk, ((rows, identifier_columns) for rows in chunks),
+                                             workers))
+                for out_rows, chunk_histogram in results:
+                    with marcaroni.metrics.stage('write', len(out_rows)):
+                        out_writer.writerows(out_rows)
+                    histogram.update(chunk_histogram)
+
+            outfile.close()
+
+            print("\nMatches per Bibsource:")
+            print("\tsource\tcount(records)")
+            for source in sorted(histogram.keys(), reverse=True,
+                                 key=lambda x: histogram[x]):
+                print("\t%s: \t%d" % (source, histogram[source]))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if published is not None:
+            published.close()
 
 def csvify(match_list):
     if len(match_list) == 0:
@@ -391,12 +606,19 @@ def csvify(match_list):
     else:
         return "multi: " + ','.join([x.id for x in match_list])
 
+# Subfields holding the identifiers of a match field, if not $a and $z.
+IDENTIFIER_SUBFIELDS = {
+    '856': ['u'],
+}
+
+
 class PendingRecord:
     def __init__(self, marc_record, bibsource, id_field, sequence):
         self.marc = marc_record
         self.source = bibsource
         self.id_field = id_field
         self.sequence = sequence
+        self.matched_on_title = False
         self._extract_identifiers()
         self.title = 'No title'
         if self.marc['245']:
@@ -418,134 +640,643 @@ class PendingRecord:
         else:
             return True
 
+    def description(self):
+        """
+        :return: marcaroni.fallback.Description, from the 245, the main entry (100, 110
+                 or 111) and the date of publication (264 or 260 $c, else the 008).
+        """
+        title = ''
+        if self.marc['245']:
+            title = ' '.join(self.marc['245'].get_subfields('a', 'b', 'n', 'p'))
+        author = ''
+        for f in self.marc.get_fields('100', '110', '111'):
+            author = ' '.join(f.get_subfields('a'))
+            break
+        date = ''
+        for f in self.marc.get_fields('264', '260'):
+            if f['c']:
+                date = f['c']
+                break
+        if not date and self.marc['008']:
+            date = self.marc['008'].data[7:11]
+        return marcaroni.fallback.describe(title, author, date)
+
     def _extract_identifiers(self):
         self.identifiers = set()
-        # Loop over all fields and 'a','z' subfields.
+        # Loop over all fields and 'a','z' subfields, or the URLs of an 856.
         for f in self.marc.get_fields(self.id_field):
-            for subfield in ['a', 'z']:
+            for subfield in IDENTIFIER_SUBFIELDS.get(self.id_field, ['a', 'z']):
                 for value in f.get_subfields(subfield):
-                    if self.id_field == '020':
-                        cleaned = value.strip()
-                        cleaned = cleaned.split('(')[0]
-                        incoming_identifier = cleaned.split(' ')[0]
-                        # We did less cleaning on the incoming ISBNS: this is our chance to fix them!!
-                        if len(incoming_identifier) not in [10, 13]:
-                            print('Probably a bad isbn: ' + incoming_identifier)
-                    elif self.id_field == '035':
-                        cleaned = value.replace('(',' ')
-                        cleaned = cleaned.replace(')',' ')
-                        cleaned = cleaned.replace('-',' ')
-                        cleaned = cleaned.lower()
-                        incoming_identifier = cleaned.strip()
-                    # A valid identifier contains numbers.
-                    elif self.id_field == '856':
-                        cleaned = re.sub(value, r'.*url=', '')
-                        cleaned = cleaned.replace(':',' ')
-                        cleaned = cleaned.replace('/',' ')
-                        cleaned = cleaned.replace('\.',' ')
-                        cleaned = cleaned.replace('/',' ')
-                        incoming_identifier = cleaned.strip()
-                    if any(i.isdigit() for i in incoming_identifier) and len(incoming_identifier) > 7:
+                    incoming_identifier = marcaroni.normalize.canonical_identifier(value, self.id_field)
+                    if incoming_identifier is None:
+                        if self.id_field == '020':
+                            print('Probably a bad isbn: ' + value)
+                        continue
+                    # A valid ISBN or 035 contains numbers. A URL is taken as it is, as the
+                    # bib data keeps every 856.
+                    if self.id_field == '856' or \
+                            (any(i.isdigit() for i in incoming_identifier) and len(incoming_identifier) > 7):
                         self.identifiers.add(incoming_identifier)
         if len(self.identifiers) == 0:
             return False
         return self.identifiers
 
 
-def process_mrc_file(eg_records, reader, output_handler, bib_source_of_input, bibsources, match_field):
+def read_pending_records(raw_records, bibsources, match_field, records_processed_count=0, input_offset=0):
+    """
+    :param raw_records: iterable of bytes, one MARC record each.
+    :param records_processed_count: int, records of the file before the first one of raw_records.
+    :param input_offset: int, byte offset of the first one of raw_records.
+    :return: iterator of PendingRecord, numbered from records_processed_count + 1.
+    """
+    for data in raw_records:
+        records_processed_count += 1
+        with marcaroni.metrics.stage('parse'):
+            marc_record = marcaroni.rawmarc.RawRecord(data)
+
+        with marcaroni.metrics.stage('extract'):
+            record = PendingRecord(marc_record, bibsources.selected, match_field, records_processed_count)
+        record.input_start = input_offset
+        input_offset += len(data)
+        record.input_end = input_offset
+        record.ldr_to_utf8()
+
+        # Convert record encoding to UTF-8 in leader.
+        marc_record.leader = marc_record.leader[0:9] + 'a' + marc_record.leader[10:]
+        yield record
+
+
+def batch_pending_records(pending_records, batch_size=MATCH_BATCH_SIZE):
+    """
+    Group records for match_many(). A record without an 856 ends processing, so it also
+    ends its batch; nothing after it is read.
+
+    :return: iterator of lists of PendingRecord
+    """
+    batch = []
+    for record in pending_records:
+        batch.append(record)
+        if len(batch) >= batch_size or not record.verify_856():
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def decision_table(bib_source_of_input, bibsources, policy):
+    """
+    :type bib_source_of_input: BibSource
+    :type bibsources: BibSourceRegistry
+    :type policy: marcaroni.policy.MatchPolicy
+    :rtype: marcaroni.policy.DecisionTable
+    """
+    return marcaroni.policy.DecisionTable(
+        policy.rules(RULES_BY_NAME), bib_source_of_input,
+        lambda source: compute_predicates_for_match(bibsources.get_bib_source_by_id(source), bib_source_of_input,
+                                                    policy))
+
+
+def match_by_title(eg_records, batch, batch_matches, threshold):
+    """
+    Match the records of a batch that no identifier matched by their title, main entry
+    and date. Those that match something are marked matched_on_title.
+
+    :type eg_records: marcaroni.snapshot.SnapshotBibData
+    :type batch: list of PendingRecord
+    :param batch_matches: list of sets of Record, the matches on identifiers.
+    :param threshold: float, the lowest score kept.
+    :return: list of sets of Record, one per record of the batch.
+    """
+    unmatched = [i for i, matches in enumerate(batch_matches) if not matches]
+    if not unmatched:
+        return batch_matches
+    batch_matches = list(batch_matches)
+    title_matches = eg_records.match_titles([batch[i].description() for i in unmatched], threshold)
+    for i, matches in zip(unmatched, title_matches):
+        if matches:
+            batch[i].matched_on_title = True
+            batch_matches[i] = matches
+    return batch_matches
+
+
+def process_mrc_file(eg_records, raw_records, output_handler, bib_source_of_input, bibsources, match_field,
+                     policy, records_processed_count=0, input_offset=0, checkpoint=None):
     """
 
     :type eg_records: marcaroni.ils.ILSBibData
-    :type reader: MARCReader
+    :param raw_records: iterable of bytes, one MARC record each.
     :type output_handler: OutputRecordHandler
     :type bib_source_of_input: BibSource
     :type bibsources: BibSourceRegistry
     :type match_field: str
+    :type policy: marcaroni.policy.MatchPolicy
+    :param records_processed_count: int, records of the file before the first one of raw_records.
+    :param input_offset: int, byte offset of the first one of raw_records.
+    :param checkpoint: function of (records processed, byte offset after them, force), called
+                       after each batch.
     :return: int
     """
-    records_processed_count = 0
-    for marc_record in reader:
-        records_processed_count += 1
+    decisions = decision_table(bib_source_of_input, bibsources, policy)
+    excluded_publishers = policy.excluded_publishers.get(bib_source_of_input.id, [])
+    pending_records = read_pending_records(raw_records, bibsources, match_field, records_processed_count,
+                                           input_offset)
+    for batch in batch_pending_records(pending_records):
+        # Match the whole batch in one call; a record without identifiers matches nothing.
+        with marcaroni.metrics.stage('lookup', len(batch)):
+            batch_matches = eg_records.match_many([record.identifiers for record in batch])
+        if policy.fallback:
+            with marcaroni.metrics.stage('fallback', len(batch)):
+                batch_matches = match_by_title(eg_records, batch, batch_matches, policy.fallback_threshold)
+        for record, matches in zip(batch, batch_matches):
+            with marcaroni.metrics.stage('rules'):
+                records_processed_count = record.sequence
+
+                # Ensure record has title. Warn if not.
+                if record.title == '<>.':
+                    print("WARNING: <>. as a title found! at record no {}".format( str(records_processed_count)), file=sys.stderr)
+
+                # Ensure record has 856. Exit if not.
+                if not record.verify_856():
+                    print("ERROR: NO 856 IN RECORD #[{}], Title: [{}]".format(str(records_processed_count),record.title), file=sys.stderr)
+                    if checkpoint is not None:
+                        # Resume at this record, once it has been fixed.
+                        checkpoint(records_processed_count - 1, record.input_start, True)
+                    sys.exit(1)
+
+                # Ensure record has identifier, or matched by title. Ambiguous if not.
+                if len(record.identifiers) < 1 and not record.matched_on_title:
+                    print("WARNING: NO {} identifier! at record no {}, Title: [{}]".format(match_field, str(records_processed_count), record.title), file=sys.stderr)
+                    output_handler.ambiguous(record, "Record has no identifier in {}.".format(match_field,))
+                    continue
+
+                if ignore_depending_on_publisher(record, bib_source_of_input, {}, output_handler, excluded_publishers):
+                    continue
+
+                if record.matched_on_title:
+                    print("NOTE: record no {} matched {} by title: {}, Title: [{}]".format(
+                        str(records_processed_count), len(matches), csvify(sorted(matches, key=lambda m: int(m.id))),
+                        record.title), file=sys.stderr)
+
+                # Count Matches
+                output_handler.count_matches_by_bibsource(matches)
+
+                if len(matches) == 0:
+                    output_handler.no_match(record)
+                    continue
+                else:
+                    remaining_matches, removed_matches = filter_matches(matches, bib_source_of_input, bibsources, record)
+                    handle_special_actions_and_misc_reports(output_handler, remaining_matches, bib_source_of_input,
+                                                            bibsources, record)
+                    # Now we need to know things about the remaining matches so we may make decision on them.
+                    predicate_vectors = {}
+                    for match in remaining_matches:
+                        predicate_vectors[match] = decisions.vector(match.source)
+
+                    # The decision table knows which rule applies; only that one is run.
+                    rule = decisions.rule(remaining_matches)
+                    done = rule is not None and rule(record, bib_source_of_input, predicate_vectors, output_handler)
+
+                    if not done:
+                        output_handler.ambiguous(record, "One or more match but no rules matched.")
+
+        if checkpoint is not None:
+            checkpoint(records_processed_count, batch[-1].input_end)
 
-        record = PendingRecord(marc_record, bibsources.selected, match_field, records_processed_count)
-        record.ldr_to_utf8()
+    return records_processed_count
 
-        # Convert record encoding to UTF-8 in leader.
-        marc_record.leader = marc_record.leader[0:9] + 'a' + marc_record.leader[10:]
 
-        # Ensure record has title. Warn if not.
-        if record.title == '<>.':
-            print("WARNING: <>. as a title found! at record no {}".format( str(records_processed_count)), file=sys.stderr)
+# Records per task handed to a worker process. Big enough to amortize the pickling, small
+# enough to keep every worker busy until the end of the file.
+WORKER_CHUNK_SIZE = 500
 
-        # Ensure record has 856. Exit if not.
-        if not record.verify_856():
-            print("ERROR: NO 856 IN RECORD #[{}], Title: [{}]".format(str(records_processed_count),record.title), file=sys.stderr)
-            sys.exit(1)
 
-        # Ensure record has identifier. Ambiguous if not.
-        if len(record.identifiers) < 1:
-            print("WARNING: NO {} identifier! at record no {}, Title: [{}]".format(match_field, str(records_processed_count), record.title), file=sys.stderr)
-            output_handler.ambiguous(record, "Record has no identifier in {}.".format(match_field,))
-            continue
+def read_record_chunks(handler, chunk_size=WORKER_CHUNK_SIZE, records_before_chunk=0, input_offset=0):
+    """
+    :param records_before_chunk: int, records before input_offset.
+    :param input_offset: int, byte offset of the first record to read.
+    :return: iterator of (int, bytes), the number of records before the chunk and the chunk.
+    """
+    chunk = []
+    for data in marcaroni.rawmarc.read_raw_records(handler, input_offset):
+        chunk.append(data)
+        if len(chunk) >= chunk_size:
+            yield records_before_chunk, b''.join(chunk)
+            records_before_chunk += len(chunk)
+            chunk = []
+    if chunk:
+        yield records_before_chunk, b''.join(chunk)
+
+
+def share_bib_data(eg_records, match_field):
+    """
+    Describe eg_records so worker processes can open it without copying it.
 
-        if ignore_depending_on_publisher(record, bib_source_of_input, {}, output_handler):
-            continue
+    :return: (tuple, CompactILSBibData or None), what to pass to attach_bib_data() in the
+             worker, and the published index to close once the workers are done.
+    """
+    if isinstance(eg_records, marcaroni.snapshot.SnapshotBibData):
+        return ('snapshot', eg_records.snapshot.filename, match_field), None
+    if isinstance(eg_records, marcaroni.server.RemoteBibData):
+        return ('server', eg_records.socket_path, match_field), None
+    if not isinstance(eg_records, marcaroni.ils.CompactILSBibData):
+        eg_records = eg_records.compact()
+    return ('shared', eg_records.publish(), match_field), eg_records
 
-        # Calculate Matches
-        matches = eg_records.match(record.identifiers)
-        output_handler.count_matches_by_bibsource(matches)
 
-        if len(matches) == 0:
-            output_handler.no_match(record)
-            continue
-        else:
-            remaining_matches, removed_matches = filter_matches(matches, bib_source_of_input, bibsources, record)
-            handle_special_actions_and_misc_reports(output_handler, remaining_matches, bib_source_of_input,
-                                                    bibsources, record)
-            # Now we need to know things about the remaining matches so we may make decision on them.
-            predicate_vectors = {}
-            for match in remaining_matches:
-                predicate_vectors[match] = compute_predicates_for_match(match,
-                                                                        bibsources.get_bib_source_by_id(match.source),
-                                                                        bib_source_of_input,
-                                                                        marc_record)
-
-            done = False
-            for rule in RULES:
-                if rule(record, bib_source_of_input, predicate_vectors, output_handler):
-                    done = True
-                    break
-
-            if not done:
-                output_handler.ambiguous(record, "One or more match but no rules matched.")
+def attach_bib_data(shared):
+    """
+    :param shared: tuple, as returned by share_bib_data().
+    """
+    kind, name, match_field = shared
+    if kind == 'snapshot':
+        eg_records = marcaroni.snapshot.SnapshotBibData()
+        eg_records.load_from_file(name, match_field)
+        return eg_records
+    if kind == 'server':
+        return marcaroni.server.RemoteBibData(name, match_field)
+    return marcaroni.ils.CompactILSBibData.attach(name)
+
 
+_worker = {}
+
+
+def metrics_enabled():
+    return marcaroni.metrics.current() is not None
+
+
+def enable_worker_metrics(enabled):
+    # A forked worker starts with a copy of the parent's metrics; start over, so only
+    # the worker's own stages are sent back.
+    if enabled:
+        marcaroni.metrics.enable('worker')
+
+
+def take_worker_metrics():
+    """
+    :return: dict of the stages measured by this worker since the last call, or None.
+    """
+    metrics = marcaroni.metrics.current()
+    return metrics.take() if metrics is not None else None
+
+
+def merge_worker_metrics(result):
+    """
+    :param result: tuple, returned by a worker with take_worker_metrics() last.
+    :return: the rest of the tuple.
+    """
+    if result[-1] is not None:
+        marcaroni.metrics.current().merge(result[-1])
+    return result[:-1]
+
+
+def _init_worker(shared, bibsources, policy, metrics=False):
+    enable_worker_metrics(metrics)
+    _worker['eg_records'] = attach_bib_data(shared)
+    _worker['bibsources'] = bibsources
+    _worker['policy'] = policy
+    _worker['match_field'] = shared[2]
+
+
+def _process_chunk(records_before_chunk, data):
+    """
+    Run process_mrc_file over one chunk in a worker. Output calls and console messages
+    are collected and returned, to be replayed by the parent in input order.
+    """
+    recorder = marcaroni.output.OutputRecorder()
+    out, err = io.StringIO(), io.StringIO()
+    records_processed_count = records_before_chunk
+    exit_code = None
+    error = None
+    bibsources = _worker['bibsources']
+    # Records done and the byte offset after them in the chunk, for the parent's checkpoint.
+    progress = [records_before_chunk, 0]
+
+    def note_progress(records_done, records_end, force=False):
+        progress[:] = [records_done, records_end]
+
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            raw_records = marcaroni.rawmarc.split_records(data)
+            records_processed_count = process_mrc_file(_worker['eg_records'], raw_records, recorder, bibsources.selected,
+                                                       bibsources, _worker['match_field'], _worker['policy'],
+                                                       records_before_chunk, 0, note_progress)
+        except SystemExit as e:
+            exit_code = e.code
+        except Exception as e:
+            error = e
+    return recorder.calls, out.getvalue(), err.getvalue(), records_processed_count, exit_code, error, progress, \
+        take_worker_metrics()
+
+
+def imap_in_order(pool, function, args_iterable, workers):
+    """
+    Like pool.imap(), but only reads a couple of tasks per worker ahead of the results
+    taken, instead of the whole input.
+
+    :param args_iterable: iterable of argument tuples.
+    :return: iterator of results, in input order.
+    """
+    pending = []
+    args_iterator = iter(args_iterable)
+    while True:
+        for args in args_iterator:
+            pending.append(pool.apply_async(function, args))
+            if len(pending) >= workers * 2:
+                break
+        if not pending:
+            return
+        yield pending.pop(0).get()
+
+
+def process_mrc_file_in_parallel(eg_records, handler, output_handler, bibsources, match_field, policy, workers,
+                                 records_processed_count=0, input_offset=0, checkpoint=None):
+    """
+    Same as process_mrc_file, with the records split into chunks over a pool of worker
+    processes. The output is written in input order, so it is the same as a serial run.
+
+    :type handler: file
+    :type workers: int
+    :return: int
+    """
+    shared, published = share_bib_data(eg_records, match_field)
+    chunks = read_record_chunks(handler, WORKER_CHUNK_SIZE, records_processed_count, input_offset)
+    try:
+        with multiprocessing.Pool(workers, _init_worker, (shared, bibsources, policy, metrics_enabled())) as pool:
+            for result in imap_in_order(pool, _process_chunk, chunks, workers):
+                calls, out, err, records_processed_count, exit_code, error, progress = merge_worker_metrics(result)
+                marcaroni.output.OutputRecorder.replay(calls, output_handler)
+                sys.stdout.write(out)
+                sys.stderr.write(err)
+                if error is not None:
+                    raise error
+                records_done, chunk_offset = progress
+                if checkpoint is not None:
+                    checkpoint(records_done, input_offset + chunk_offset, exit_code is not None)
+                input_offset += chunk_offset
+                if exit_code is not None:
+                    sys.exit(exit_code)
+    finally:
+        if published is not None:
+            published.close()
     return records_processed_count
 
 
+# One run of bibmatcher over an input file, as listed in a manifest.
+Job = namedtuple('Job', ['input_file', 'bib_source', 'match_field', 'output'])
+
+
+def read_manifest(filename, bibsources, policy, match_field='', bib_source_id=None):
+    """
+    Read a manifest of jobs: a CSV file with the columns input, bib_source, match_field
+    and output. Blank bib sources and match fields are taken from the command line, or
+    the match field from the policy. A blank output is named after the input, as for a
+    single run. Relative paths are relative to the manifest.
+
+    :type filename: str
+    :type bibsources: BibSourceRegistry
+    :type policy: marcaroni.policy.MatchPolicy
+    :return: list of Job
+    """
+    directory = os.path.dirname(filename)
+    jobs = []
+    with open(filename, 'r') as fp:
+        for line_number, row in enumerate(csv.DictReader(fp), 2):
+            input_file = os.path.join(directory, (row.get('input') or '').strip())
+            input_name, ext = os.path.splitext(marcaroni.compress.uncompressed_name(input_file))
+            if ext != '.mrc' or not os.path.exists(input_file):
+                print("Manifest line %d: [%s] is not a marc file." % (line_number, input_file))
+                sys.exit(1)
+            job_bib_source_id = (row.get('bib_source') or '').strip() or bib_source_id
+            if job_bib_source_id not in bibsources:
+                print("Manifest line %d: unknown bib source [%s]." % (line_number, job_bib_source_id))
+                sys.exit(1)
+            job_match_field = (row.get('match_field') or '').strip() or match_field or \
+                bibsources.get_match_field(policy, job_bib_source_id)
+            output = (row.get('output') or '').strip()
+            output = os.path.join(directory, output) if output else input_name
+            jobs.append(Job(input_file, job_bib_source_id, job_match_field, output))
+
+    outputs = Counter(os.path.abspath(job.output) for job in jobs)
+    for output, count in outputs.items():
+        if count > 1:
+            print("Manifest has %d jobs writing to [%s]." % (count, output))
+            sys.exit(1)
+    if not jobs:
+        print("Manifest [%s] has no jobs." % (filename,))
+        sys.exit(1)
+    return jobs
+
+
+def run_job(job, eg_records, bibsources, policy, resume=False, compression=None):
+    """
+    :type job: Job
+    :param resume: bool, carry on from the job's checkpoint, if it has one.
+    :param compression: str, to write the .mrc output files compressed.
+    :return: the exit code of the job, 0 if it ran to the end.
+    """
+    bibsources.set_selected(job.bib_source)
+    resume = resume and marcaroni.checkpoint.Checkpoint(job.output).exists()
+    try:
+        process_input_files([job.input_file], bibsources.selected, bibsources, eg_records, job.match_field, policy,
+                            prefix=job.output, resume=resume, compression=compression)
+    except SystemExit as e:
+        return e.code
+    return 0
+
+
+def _init_job_worker(shared_by_tag, bibsources, policy, resume, compression, metrics=False):
+    enable_worker_metrics(metrics)
+    _worker['eg_records_by_tag'] = {match_field: attach_bib_data(shared)
+                                    for match_field, shared in shared_by_tag.items()}
+    _worker['bibsources'] = bibsources
+    _worker['policy'] = policy
+    _worker['resume'] = resume
+    _worker['compression'] = compression
+
+
+def _run_job(job):
+    """
+    Run a job in a worker. Console messages are returned, to be printed by the parent in
+    manifest order.
+    """
+    out, err = io.StringIO(), io.StringIO()
+    with redirect_stdout(out), redirect_stderr(err):
+        exit_code = run_job(job, _worker['eg_records_by_tag'][job.match_field], _worker['bibsources'],
+                            _worker['policy'], _worker['resume'], _worker['compression'])
+    return out.getvalue(), err.getvalue(), exit_code, take_worker_metrics()
+
+
+def run_jobs(jobs, eg_records_by_tag, bibsources, policy, workers=1, resume=False, compression=None):
+    """
+    Run the jobs of a manifest against bib data loaded once, over up to workers processes.
+
+    :type jobs: list[Job]
+    :param eg_records_by_tag: dict of ILSBibData, by match field.
+    :param resume: bool, carry on from the checkpoints of jobs that have one.
+    :param compression: str, to write the .mrc output files compressed.
+    :return: int, 0 if every job ran to the end.
+    """
+    def describe(number, job):
+        return "\nJob %d of %d: %s, bib source %s, matching on %s, into %s" % (
+            number, len(jobs), job.input_file, bibsources.get_bib_source_by_id(job.bib_source).name,
+            job.match_field, job.output)
+
+    exit_codes = []
+    if workers == 1 or len(jobs) == 1:
+        for number, job in enumerate(jobs, 1):
+            print(describe(number, job))
+            exit_codes.append(run_job(job, eg_records_by_tag[job.match_field], bibsources, policy, resume,
+                                      compression))
+    else:
+        shared_by_tag = {}
+        published = []
+        try:
+            for match_field, eg_records in eg_records_by_tag.items():
+                shared, compact = share_bib_data(eg_records, match_field)
+                shared_by_tag[match_field] = shared
+                if compact is not None:
+                    published.append(compact)
+            with multiprocessing.Pool(min(workers, len(jobs)), _init_job_worker,
+                                      (shared_by_tag, bibsources, policy, resume, compression,
+                                       metrics_enabled())) as pool:
+                results = (merge_worker_metrics(result)
+                           for result in imap_in_order(pool, _run_job, ((job,) for job in jobs), workers))
+                for number, (job, (out, err, exit_code)) in enumerate(zip(jobs, results), 1):
+                    print(describe(number, job))
+                    sys.stdout.write(out)
+                    sys.stderr.write(err)
+                    exit_codes.append(exit_code)
+        finally:
+            for compact in published:
+                compact.close()
+
+    failed = [job for job, exit_code in zip(jobs, exit_codes) if exit_code]
+    for job in failed:
+        print("Job did not finish: %s" % (job.input_file,))
+    return 1 if failed else 0
+
+
+def load_bib_data_by_tag(bib_data_file_name, match_fields, compact=False):
+    """
+    Load the bib data once for several match fields.
+
+    :type match_fields: list[str]
+    :return: dict of ILSBibData (or a stand-in for it), by match field.
+    """
+    if len(match_fields) == 1 or marcaroni.snapshot.is_snapshot(bib_data_file_name):
+        # A snapshot is mapped, not read, so opening it per match field costs nothing.
+        return {match_field: load_bib_data(bib_data_file_name, match_field, compact) for match_field in match_fields}
+    return marcaroni.ils.load_by_tag(bib_data_file_name, match_fields, compact)
+
+
+def load_bib_data(bib_data_file_name, match_field, compact=False):
+    """
+    Load the bib data from either a bib-data.txt CSV file or a compiled snapshot.
+
+    :type bib_data_file_name: str
+    :type match_field: str
+    :param compact: bool, hold CSV data in typed arrays rather than Python objects.
+    :rtype: marcaroni.ils.ILSBibData | marcaroni.ils.CompactILSBibData | marcaroni.snapshot.SnapshotBibData
+    """
+    if marcaroni.snapshot.is_snapshot(bib_data_file_name):
+        eg_records = marcaroni.snapshot.SnapshotBibData()
+    elif compact:
+        eg_records = marcaroni.ils.CompactILSBibData()
+    else:
+        eg_records = marcaroni.ils.ILSBibData()
+    eg_records.load_from_file(bib_data_file_name, match_field)
+    return eg_records
+
+
 def parse_cmd_line():
     parser = optparse.OptionParser(usage="%prog [options] INPUT_FILE [ ... INPUT_FILE_N ]")
     parser.add_option("-d", "--bib-data", dest="bib_data", default="bib-data.txt",
-                      help="CSV file of Bib Data to use. [default: %default]")
+                      help="CSV file or compiled snapshot of Bib Data to use. [default: %default]")
     parser.add_option("--bib-source-file", dest="bib_source_file", default=os.path.join(os.path.dirname(__file__), 'conf', 'bib_sources.csv'),
                       help="CSV file of Bib Sources to use. [default: %default]")
+    parser.add_option("--policy-file", dest="policy_file", default=marcaroni.policy.DEFAULT_POLICY_FILE,
+                      help="Match policy: match fields, odd bib sources, excluded publishers and rule order. "
+                           "[default: %default]")
     parser.add_option("-s", "--bib-source", dest="bib_source",
                       help="Numerical id of bib source for this batch. If empty, will prompt for this.")
     parser.add_option("-x", "--excel", action="store_true", dest="excel", default=False,
                       help="Instead of a .mrc file, the input is a CSV file. Output will be a modified CSV file..")
+    parser.add_option("--columns", dest="columns", default=None,
+                      help="For an excel report, the identifier column(s) separated by commas, counting from 0. "
+                           "Found from the header row if not given.")
     parser.add_option("-n", "--negate", action="store_true", dest="negate", default=False,
                       help="For an excel report, find matches NOT in a specific bibsource.")
     parser.add_option("-m", "--match-field", dest="match_field", default='',
-                      help="Marc tag to use as identifier. Options are '020' or '035'. Default depends on bibsource.")
+                      help="Marc tag to use as identifier. Options are '020', '035' or '856' (the URL). "
+                           "Default depends on bibsource.")
+    parser.add_option("--compact", action="store_true", dest="compact", default=False,
+                      help="Hold a CSV bib data file in compact typed arrays instead of Python objects. "
+                           "Loads 5M+ identifier rows in a fraction of the memory.")
+    parser.add_option("--live", action="store_true", dest="live", default=False,
+                      help="Match against the Evergreen database instead of a bib data file. The identifiers of the "
+                           "input are resolved with one query, so matches are fresh without running update-data.py.")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=None,
+                      help="Match the records of a .mrc file, or the rows of a CSV file, over this many processes. "
+                           "The output is the same as with one. With --manifest, run this many jobs at once. "
+                           "[default: 1, or one per CPU with --manifest]")
+    parser.add_option("--manifest", dest="manifest", default=None,
+                      help="CSV file of jobs (input, bib_source, match_field, output) to run against the bib data, "
+                           "loaded once, instead of the input files on the command line.")
+    parser.add_option("--resume", action="store_true", dest="resume", default=False,
+                      help="Carry on from the checkpoint of an interrupted run into the same output directory, "
+                           "instead of starting over.")
+    parser.add_option("--compress", dest="compress", type="choice", choices=['gz', 'bz2', 'xz'], default=None,
+                      help="Write the .mrc output files compressed: gz, bz2 or xz. Input files may be compressed "
+                           "(e.g. .mrc.gz) either way. Resume a run with the same --compress.")
+    parser.add_option("--fallback", action="store_true", dest="fallback", default=False,
+                      help="Match the records that no identifier matches by title, main entry and date, as "
+                           "scored against the [fallback] threshold of the match policy. Needs a snapshot written "
+                           "by update-data.py --titles.")
+    parser.add_option("--server", dest="server", default=None,
+                      help="Unix socket of a running match-server.py. The bib data is matched there instead of "
+                           "being loaded, if the server is up.")
+    parser.add_option("--metrics", dest="metrics", default=None,
+                      help="Time the stages of the run (parse, extract, lookup, rules, write), and write them as "
+                           "JSON to this file and as a Prometheus textfile next to it (.prom).")
+    parser.add_option("--profile", dest="profile", default=None,
+                      help="Run under cProfile and save the profile to this file.")
     opts, args = parser.parse_args()
 
-    if not os.path.exists(opts.bib_data):
+    if not opts.live and not opts.server and not os.path.exists(opts.bib_data):
         parser.error("Bib data file [%s] not found." % (opts.bib_data,))
     if not os.path.exists(opts.bib_source_file):
         parser.error("Bib source file [%s] not found." % (opts.bib_source,))
-
-    if len(args) < 1:
+    if not os.path.exists(opts.policy_file):
+        parser.error("Match policy file [%s] not found." % (opts.policy_file,))
+    if opts.live and opts.excel:
+        parser.error("--live only works on .mrc files.")
+    if opts.resume and opts.excel:
+        parser.error("--resume only works on .mrc files.")
+    if opts.compress and opts.excel:
+        parser.error("--compress only works on .mrc files.")
+    if opts.fallback and (opts.excel or opts.live or opts.server):
+        parser.error("--fallback only works on .mrc files, against a bib data snapshot.")
+    if opts.columns is not None:
+        try:
+            opts.columns = [int(x) for x in opts.columns.split(',')]
+        except ValueError:
+            parser.error("--columns must be numbers separated by commas.")
+    if opts.manifest and not os.path.exists(opts.manifest):
+        parser.error("Manifest [%s] not found." % (opts.manifest,))
+    if opts.manifest and (opts.live or opts.excel):
+        parser.error("--manifest only works on .mrc files, against a bib data file or server.")
+    if opts.workers is None:
+        opts.workers = (os.cpu_count() or 1) if opts.manifest else 1
+    if opts.workers < 1:
+        parser.error("--workers must be at least 1.")
+    if opts.live and opts.server:
+        parser.error("--live and --server cannot be used together.")
+
+    if opts.manifest and args:
+        parser.error("With --manifest, the input files are listed in the manifest.")
+    if len(args) < 1 and not opts.manifest:
         parser.error("Need at least one input file on command line.")
-    return opts.bib_source_file, opts.bib_source, opts.bib_data, opts.excel, opts.negate, opts.match_field, args
+    return opts, args
 
 
 def prompt_for_bib_source(bibsources):
@@ -563,38 +1294,169 @@ def prompt_for_bib_source(bibsources):
     return response
 
 
-def main():
-    bib_source_file_name, bib_source_id, bib_data_file_name, excel, negate, match_field, input_files = parse_cmd_line()
+def identifiers_in_input_files(input_files, bibsources, match_field):
+    """
+    Read the input files once to collect every identifier to match.
 
-    bibsources = marcaroni.sources.BibSourceRegistry()
-    bibsources.load_from_file(bib_source_file_name)
+    :type input_files: list[str]
+    :type bibsources: BibSourceRegistry
+    :type match_field: str
+    :return: set of str
+    """
+    identifiers = set()
+    for filename in input_files:
+        with marcaroni.compress.open_input(filename) as handler:
+            for data in marcaroni.rawmarc.read_raw_records(handler):
+                marc_record = marcaroni.rawmarc.RawRecord(data)
+                identifiers |= PendingRecord(marc_record, bibsources.selected, match_field, 0).identifiers
+    return identifiers
+
+
+def load_live_bib_data(input_files, bibsources, match_field):
+    """
+    :rtype: marcaroni.live.LiveBibData
+    """
+    from marcaroni import db
+    import marcaroni.live
+
+    identifiers = identifiers_in_input_files(input_files, bibsources, match_field)
+    print("Matching %d identifiers against the database." % (len(identifiers),))
+    conn = db.connect()
+    try:
+        eg_records = marcaroni.live.LiveBibData()
+        eg_records.load_from_database(conn, identifiers, match_field)
+    finally:
+        conn.close()
+    return eg_records
+
+
+def connect_to_server(socket_path, match_field):
+    """
+    :return: marcaroni.server.RemoteBibData, or None if the server is not running.
+    """
+    try:
+        eg_records = marcaroni.server.RemoteBibData(socket_path, match_field)
+    except OSError as e:
+        print("Match server at %s is not available (%s)." % (socket_path, e))
+        return None
+    print("Matching through server at %s" % (socket_path,))
+    return eg_records
+
+
+def open_bib_data(opts, match_fields):
+    """
+    Connect to the match server, or failing that load the bib data file, for each of
+    match_fields.
+
+    :type match_fields: list[str]
+    :return: dict of ILSBibData (or a stand-in for it), by match field.
+    """
+    if opts.server:
+        eg_records_by_tag = {}
+        for match_field in match_fields:
+            eg_records = connect_to_server(opts.server, match_field)
+            if eg_records is None:
+                break
+            eg_records_by_tag[match_field] = eg_records
+        else:
+            status = eg_records_by_tag[match_fields[0]].status()
+            print("Server has records from %s" % (status['bib_data']))
+            warn_if_old(datetime.datetime.fromtimestamp(status['modified']))
+            return eg_records_by_tag
+        for eg_records in eg_records_by_tag.values():
+            eg_records.close()
+        if not os.path.exists(opts.bib_data):
+            print("Bib data file [%s] not found." % (opts.bib_data,))
+            sys.exit(1)
+    print("Loading records from %s" % (opts.bib_data))
+    warn_if_old(datetime.datetime.fromtimestamp(os.path.getmtime(opts.bib_data)))
+    return load_bib_data_by_tag(opts.bib_data, match_fields, opts.compact)
+
+
+def warn_if_old(mod_time):
+    print("File last modified: %s" % (mod_time))
+    if mod_time < (datetime.datetime.now() - datetime.timedelta(hours=1)):
+        input("WARNING! Bib data is old. Press a key to continue, or Ctrl-D to cancel ")
+
+
+def check_titles(eg_records):
+    """
+    Exit unless eg_records can match records by title.
+    """
+    if not isinstance(eg_records, marcaroni.snapshot.SnapshotBibData) or eg_records.titles is None:
+        print("--fallback needs a snapshot written by update-data.py --titles.")
+        sys.exit(1)
+
+
+def run(opts, input_files):
+    match_field = opts.match_field
 
+    bibsources = marcaroni.sources.BibSourceRegistry()
+    bibsources.load_from_file(opts.bib_source_file)
+    policy = marcaroni.policy.MatchPolicy()
+    try:
+        policy.load_from_file(opts.policy_file)
+        policy.rules(RULES_BY_NAME)
+    except marcaroni.policy.PolicyError as e:
+        print(e)
+        sys.exit(1)
+    policy.fallback = opts.fallback
+
+    if opts.manifest:
+        jobs = read_manifest(opts.manifest, bibsources, policy, match_field, opts.bib_source)
+        with marcaroni.metrics.stage('load'):
+            eg_records_by_tag = open_bib_data(opts, sorted(set(job.match_field for job in jobs)))
+        if policy.fallback:
+            for eg_records in eg_records_by_tag.values():
+                check_titles(eg_records)
+        print("Running %d jobs." % (len(jobs),))
+        sys.exit(run_jobs(jobs, eg_records_by_tag, bibsources, policy, opts.workers, opts.resume, opts.compress))
+
+    bib_source_id = opts.bib_source
     if not bib_source_id:
         bib_source_id = prompt_for_bib_source(bibsources)
     bibsources.set_selected(bib_source_id)
     print("\nYou have chosen the [%s] Bib Source." % (bibsources.selected.name,))
 
     if not match_field:
-        match_field = bibsources.get_match_field()
+        match_field = bibsources.get_match_field(policy)
         print("This bibsource matches on field: %s.\n" % (match_field))
     else:
         print("Matching on field: %s.\n" % (match_field))
 
-    print("Loading records from %s" % (bib_data_file_name))
-    mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(bib_data_file_name))
-    print("File last modified: %s" % (mod_time))
-    if mod_time < (datetime.datetime.now() - datetime.timedelta(hours=1)):
-        input("WARNING! Bib data is old. Press a key to continue, or Ctrl-D to cancel ")
-
-    eg_records = marcaroni.ils.ILSBibData()
-    eg_records.load_from_file(bib_data_file_name, match_field)
+    with marcaroni.metrics.stage('load'):
+        if opts.live:
+            eg_records = load_live_bib_data(input_files, bibsources, match_field)
+        else:
+            eg_records = open_bib_data(opts, [match_field])[match_field]
+    if policy.fallback:
+        check_titles(eg_records)
 
-    if excel:
-        isbn_columns = input("Identifier (e.g. ISBN) column(s) separated by commas, counting from 0: ")
-        match_input_files(input_files, bibsources, eg_records, isbn_columns, negate)
+    if opts.excel:
+        match_input_files(input_files, bibsources, eg_records, opts.columns, opts.negate, match_field, opts.workers)
         return
     print("Processing input files.")
-    process_input_files(input_files, bibsources.selected, bibsources, eg_records, match_field)
+    process_input_files(input_files, bibsources.selected, bibsources, eg_records, match_field, policy, opts.workers,
+                        resume=opts.resume, compression=opts.compress)
+
+
+def main():
+    opts, input_files = parse_cmd_line()
+    if opts.metrics:
+        marcaroni.metrics.enable('bibmatcher', record_stage='extract' if opts.excel else 'parse')
+    try:
+        if opts.profile:
+            with marcaroni.metrics.profiling(opts.profile):
+                run(opts, input_files)
+        else:
+            run(opts, input_files)
+    finally:
+        # Also when a bad record stops the run: the time up to it is still worth having.
+        if opts.metrics:
+            metrics = marcaroni.metrics.current()
+            metrics.write(opts.metrics)
+            for line in metrics.report():
+                print(line)
 
 
 if __name__ == '__main__':
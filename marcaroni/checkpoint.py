@@ -0,0 +1,157 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Checkpoints of a bibmatcher.py run, so a long run can be resumed where it stopped.
+
+A checkpoint is taken between batches of records, when every record before it has been
+written out. It holds the byte offset in the input file to carry on from, the number of
+records before it, and the size of every output file and the counters of the
+OutputRecordHandler at that point. Resuming cuts the output files back to those sizes,
+so records written after the checkpoint are not written twice.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from marcaroni import compress
+
+CHECKPOINT_FILE_NAME = 'checkpoint.json'
+
+# Seconds between checkpoints. Taking one flushes every output file.
+CHECKPOINT_INTERVAL = 30
+
+# Bytes of input before the offset that must be unchanged for a resume.
+DIGEST_LENGTH = 4096
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def input_digest(file_name, input_offset):
+    """
+    Digest of the input just before input_offset. A bad record after the checkpoint may
+    be fixed before resuming, but the records before it must not have changed.
+
+    :type file_name: str
+    :type input_offset: int
+    :rtype: str
+    """
+    start = max(0, input_offset - DIGEST_LENGTH)
+    if compress.compression_of(file_name):
+        data = _compressed_data_before(file_name, input_offset)
+    else:
+        with open(file_name, 'rb') as fp:
+            fp.seek(start)
+            data = fp.read(input_offset - start)
+    if len(data) != input_offset - start:
+        return None
+    return hashlib.sha1(data).hexdigest()
+
+
+class _ForwardReader:
+    """
+    Reads a compressed file forward, keeping the last DIGEST_LENGTH bytes read.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.fp = compress.open_file(file_name, 'rb')
+        self.offset = 0
+        self.tail = b''
+
+    def read_to(self, offset):
+        while self.offset < offset:
+            data = self.fp.read(min(offset - self.offset, compress.BLOCK_SIZE))
+            if not data:
+                break
+            self.offset += len(data)
+            self.tail = (self.tail + data)[-DIGEST_LENGTH:]
+        return self.tail
+
+
+# Checkpoints of a run go forward through its input, so the compressed file being read
+# is not decompressed from its start for each of them.
+_forward_reader = None
+
+
+def _compressed_data_before(file_name, input_offset):
+    """
+    :return: bytes, up to DIGEST_LENGTH bytes of uncompressed data before input_offset.
+    """
+    global _forward_reader
+    if _forward_reader is None or _forward_reader.file_name != file_name or _forward_reader.offset > input_offset:
+        if _forward_reader is not None:
+            _forward_reader.fp.close()
+        _forward_reader = _ForwardReader(file_name)
+    tail = _forward_reader.read_to(input_offset)
+    if _forward_reader.offset != input_offset:
+        return b''
+    return tail
+
+
+class Checkpoint:
+    def __init__(self, prefix, interval=CHECKPOINT_INTERVAL):
+        """
+        :param prefix: str, the output directory of the run.
+        """
+        self.file_name = os.path.join(prefix, CHECKPOINT_FILE_NAME)
+        self.interval = interval
+        self.saved_at = time.monotonic()
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def due(self):
+        return time.monotonic() - self.saved_at >= self.interval
+
+    def save(self, state):
+        """
+        :type state: dict
+        """
+        # Write next to it and rename, so a crash while saving leaves the last one whole.
+        temporary_file_name = self.file_name + '.tmp'
+        with open(temporary_file_name, 'w') as fp:
+            json.dump(state, fp, indent=1, sort_keys=True)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temporary_file_name, self.file_name)
+        self.saved_at = time.monotonic()
+
+    def load(self):
+        """
+        :rtype: dict
+        """
+        try:
+            with open(self.file_name, 'r') as fp:
+                return json.load(fp)
+        except OSError as e:
+            raise CheckpointError("No checkpoint to resume from in %s (%s)." %
+                                  (os.path.dirname(self.file_name), e.strerror))
+        except ValueError as e:
+            raise CheckpointError("Checkpoint %s is unreadable: %s" % (self.file_name, e))
+
+    def check(self, state, input_files, bib_source_id, match_field):
+        """
+        Make sure a checkpoint was taken by a run over the same input, and that the input
+        has not changed before the checkpoint.
+
+        :type state: dict
+        :type input_files: list[str]
+        """
+        if state['input_files'] != [os.path.abspath(filename) for filename in input_files]:
+            raise CheckpointError("Checkpoint is of a run over other input files: %s" %
+                                  (', '.join(state['input_files']),))
+        if state['bib_source'] != bib_source_id or state['match_field'] != match_field:
+            raise CheckpointError("Checkpoint is of a run with bib source %s, matching on %s." %
+                                  (state['bib_source'], state['match_field']))
+        if state['finished']:
+            return
+        input_file = state['input_files'][state['input_index']]
+        if input_digest(input_file, state['input_offset']) != state['input_digest']:
+            raise CheckpointError("%s has changed before the checkpoint." % (input_file,))
@@ -0,0 +1,169 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Compressed files, told apart by their extension: .gz, .bz2 and .xz.
+
+open_file() opens a file, compressed or not, like open(). open_input() is for files
+read from start to end: a compressed one is decompressed on a separate thread, a block
+ahead of the reader, so decompression overlaps with parsing. zlib, bz2 and lzma let go
+of the GIL while they work. Nothing is ever written out uncompressed on the way.
+
+A compressed file opened for appending gets another stream (gzip member, bz2 or xz
+stream) at its end. Readers go through all of them, so a file can be added to between
+runs, e.g. when a run is resumed.
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+
+# Compression by file extension.
+COMPRESSIONS = {
+    '.gz': 'gz',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+}
+
+EXTENSIONS = dict((compression, extension) for extension, compression in COMPRESSIONS.items())
+
+# Bytes decompressed at a time by the thread of open_input(), and blocks kept ready.
+BLOCK_SIZE = 1 << 20
+READ_AHEAD = 4
+
+
+def compression_of(file_name):
+    """
+    :type file_name: str
+    :return: str, 'gz', 'bz2' or 'xz', or None if the file is not compressed.
+    """
+    return COMPRESSIONS.get(os.path.splitext(file_name)[1].lower())
+
+
+def uncompressed_name(file_name):
+    """
+    :return: str, file_name without its compression extension, e.g. 'a.mrc' for 'a.mrc.gz'.
+    """
+    if compression_of(file_name):
+        return os.path.splitext(file_name)[0]
+    return file_name
+
+
+def extension(compression):
+    """
+    :param compression: str, or None.
+    :return: str, the file name extension of compression, e.g. '.gz', or '' for None.
+    """
+    return EXTENSIONS[compression] if compression else ''
+
+
+def open_file(file_name, mode='rb', compression=None, **kwargs):
+    """
+    Open a file like open(), compressed according to its extension or to compression.
+    Text modes take encoding, newline etc. as open() does.
+
+    :param compression: str, to compress a file whose name doesn't tell, e.g. a temporary file.
+    """
+    compression = compression or compression_of(file_name)
+    if compression == 'gz':
+        return gzip.open(file_name, mode, **kwargs)
+    if compression == 'bz2':
+        return bz2.open(file_name, mode, **kwargs)
+    if compression == 'xz':
+        return lzma.open(file_name, mode, **kwargs)
+    return open(file_name, mode, **kwargs)
+
+
+def fsync(file_name):
+    """
+    Make sure a file written and closed is on disk, e.g. before it is moved into place.
+    A compressed file is only complete once closed.
+    """
+    with open(file_name, 'rb') as fp:
+        os.fsync(fp.fileno())
+
+
+class _ThreadedReader(io.RawIOBase):
+    """
+    Reads a decompressing file on a thread of its own, a few blocks ahead.
+    """
+    def __init__(self, fp):
+        self._fp = fp
+        self._blocks = queue.Queue(READ_AHEAD)
+        self._block = b''
+        self._position = 0
+        self._eof = False
+        self._error = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='marcaroni-decompress', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                block = self._fp.read(BLOCK_SIZE)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self._error = e
+            self._put(b'')
+
+    def _put(self, block):
+        # Don't hang on a full queue once the reader is closed.
+        while not self._stopped.is_set():
+            try:
+                self._blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._position >= len(self._block):
+            if self._eof:
+                return 0
+            block = self._blocks.get()
+            if not block:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+                return 0
+            self._block = block
+            self._position = 0
+        size = min(len(buffer), len(self._block) - self._position)
+        buffer[:size] = self._block[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stopped.set()
+            self._thread.join()
+            self._fp.close()
+        super().close()
+
+
+def open_input(file_name, mode='rb', **kwargs):
+    """
+    Open a file to read through once. A compressed file is decompressed on a separate
+    thread.
+
+    :param mode: str, 'rb' or 'r'; text mode takes encoding, newline etc. as open() does.
+    :return: file object, without seek() if the file is compressed.
+    """
+    if not compression_of(file_name):
+        return open(file_name, mode, **kwargs)
+    buffered = io.BufferedReader(_ThreadedReader(open_file(file_name, 'rb')), BLOCK_SIZE)
+    if 'b' in mode:
+        return buffered
+    return io.TextIOWrapper(buffered, **kwargs)
@@ -0,0 +1,271 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+import os
+import csv
+import shutil
+import multiprocessing
+from itertools import groupby
+
+from marcaroni import compress
+from marcaroni import db
+from marcaroni.normalize import canonical_identifier
+
+CSV_HEADER = 'identifier,id,source,tag,subfield\n'
+
+# The coarse identifier cleaning is done by the database, so only candidate identifiers
+# cross the wire: trim whitespace and commas; for ISBNs keep the first word, trim hyphens
+# and cut at 'ü', '(' and '\\'. marcaroni.normalize then turns them into the same
+# canonical keys bibmatcher.py looks up; for 856 $u, it also strips the proxy prefix.
+TRIMMED_VALUE_SQL = "btrim(btrim(rfr.value, E' \\t\\r\\n'), ',')"
+
+CLEANED_ISBN_SQL = "split_part(split_part(split_part(" \
+                "btrim(split_part(" + TRIMMED_VALUE_SQL + ", ' ', 1), '-'), " \
+                "'\u00fc', 1), '(', 1), E'\\\\', 1)"
+
+EXPORT_QUERY = "SELECT identifier, id, source, tag, subfield FROM (" \
+               "SELECT bre.id, bre.source, rfr.tag, rfr.subfield, " \
+               "CASE rfr.tag WHEN '020' THEN " + CLEANED_ISBN_SQL + " " \
+               "ELSE " + TRIMMED_VALUE_SQL + " END AS identifier " \
+               "FROM biblio.record_entry bre JOIN metabib.real_full_rec rfr ON bre.id = rfr.record " \
+               "WHERE not bre.deleted AND (" \
+               "(rfr.tag IN ('020', '035') AND rfr.subfield IN ('a', 'z')) " \
+               "OR (rfr.tag = '856' AND rfr.subfield = 'u')) and bre.source is not NULL " \
+               "{record_filter}" \
+               ") cleaned " \
+               "WHERE identifier <> '' AND CASE tag " \
+               "WHEN '020' THEN length(identifier) BETWEEN 9 AND 14 " \
+               "WHEN '856' THEN true " \
+               "ELSE identifier ~ '[0-9]' END"
+
+# Rows fetched per round trip from the server-side cursor.
+EXPORT_BATCH_SIZE = 10000
+
+# The fields a record is described by for marcaroni.fallback: its title, main entry and
+# date of publication, in record and field order.
+DESCRIPTION_QUERY = "SELECT bre.id, bre.source, rfr.tag, rfr.subfield, rfr.value " \
+                    "FROM biblio.record_entry bre JOIN metabib.real_full_rec rfr ON bre.id = rfr.record " \
+                    "WHERE not bre.deleted AND bre.source is not NULL AND (" \
+                    "(rfr.tag = '245' AND rfr.subfield IN ('a', 'b', 'n', 'p')) " \
+                    "OR (rfr.tag IN ('100', '110', '111') AND rfr.subfield = 'a') " \
+                    "OR (rfr.tag IN ('264', '260') AND rfr.subfield = 'c')) " \
+                    "{record_filter}" \
+                    "ORDER BY bre.id, rfr.id"
+
+WATERMARK_QUERY = "SELECT coalesce(max(id), 0), max(edit_date) FROM biblio.record_entry"
+
+# edit_date is set when a transaction starts, not when it commits: a record saved by a
+# transaction still open when the watermark was read would be older than the watermark,
+# and missed by every delta after. Going back this far picks such records up, along with
+# records created under an id lower than the watermark's but committed later. Records
+# changed in the overlap are exported again, which costs little.
+WATERMARK_OVERLAP = '1 hour'
+
+CHANGED_RECORDS_QUERY = "SELECT id FROM biblio.record_entry " \
+                        "WHERE id > %s OR edit_date > coalesce(%s::timestamptz, '-infinity') - %s::interval"
+
+ID_RANGE_QUERY = "SELECT coalesce(min(id), 0), coalesce(max(id), 0) FROM biblio.record_entry"
+
+# A parallel export cuts the id space into this many shards per connection, so a slow
+# range doesn't hold up the whole export.
+SHARDS_PER_JOB = 4
+
+
+def read_watermark(cur):
+    """
+    The point the database has reached. Take it before exporting, so that records
+    changed during the export are picked up again by the next delta.
+
+    :param cur: psycopg2 cursor
+    :return: dict, stored in the snapshot meta.
+    """
+    cur.execute(WATERMARK_QUERY)
+    max_id, edit_date = cur.fetchone()
+    return {
+        'max_id': max_id,
+        'edit_date': edit_date.isoformat() if edit_date else None,
+    }
+
+
+def changed_record_ids(cur, watermark):
+    """
+    Ids of the records created, edited or deleted since the watermark, and of those
+    edited within WATERMARK_OVERLAP before it.
+
+    :param cur: psycopg2 cursor
+    :type watermark: dict
+    :return: set of int
+    """
+    cur.execute(CHANGED_RECORDS_QUERY, (watermark['max_id'], watermark['edit_date'], WATERMARK_OVERLAP))
+    return set(row[0] for row in cur)
+
+
+def export_rows(conn, record_ids=None, id_range=None):
+    """
+    Stream the cleaned rows through a server-side cursor, so the client never holds
+    more than one batch of the result set.
+
+    :param conn: psycopg2 connection
+    :param record_ids: set of int, to export only these records.
+    :param id_range: (int, int), to export only the records with lower <= id < upper.
+    :return: iterator of (identifier, id, source, tag, subfield) tuples of str.
+    """
+    with conn.cursor(name='bib_data_export') as cur:
+        cur.itersize = EXPORT_BATCH_SIZE
+        if record_ids is not None:
+            cur.execute(EXPORT_QUERY.format(record_filter='AND bre.id = ANY(%s)'), (sorted(record_ids),))
+        elif id_range is not None:
+            cur.execute(EXPORT_QUERY.format(record_filter='AND bre.id >= %s AND bre.id < %s'), id_range)
+        else:
+            cur.execute(EXPORT_QUERY.format(record_filter=''))
+        for row in cur:
+            identifier = canonical_identifier(row[0], row[3])
+            if identifier is None:
+                continue
+            yield identifier, str(row[1]), str(row[2]), row[3], row[4]
+
+
+def export_descriptions(conn, record_ids=None):
+    """
+    Stream the title, main entry and date of each record, like export_rows().
+
+    :param conn: psycopg2 connection
+    :param record_ids: set of int, to export only these records.
+    :return: iterator of (id, source, title, author, date) tuples of str, one per record
+             with a title.
+    """
+    with conn.cursor(name='bib_description_export') as cur:
+        cur.itersize = EXPORT_BATCH_SIZE
+        if record_ids is not None:
+            cur.execute(DESCRIPTION_QUERY.format(record_filter='AND bre.id = ANY(%s) '), (sorted(record_ids),))
+        else:
+            cur.execute(DESCRIPTION_QUERY.format(record_filter=''))
+        for (bib_id, source), rows in groupby(cur, key=lambda row: (row[0], row[1])):
+            title = []
+            author = date = ''
+            for _, _, tag, subfield, value in rows:
+                if tag == '245':
+                    title.append(value)
+                elif tag in ('100', '110', '111'):
+                    author = author or value
+                else:
+                    date = date or value
+            if title:
+                yield str(bib_id), str(source), ' '.join(title), author, date
+
+
+def split_id_range(lower, upper, count):
+    """
+    Cut the ids lower..upper (inclusive) into at most count half-open ranges.
+
+    :rtype: list[(int, int)]
+    """
+    step = max(1, -(-(upper - lower + 1) // count))
+    return [(start, min(start + step, upper + 1)) for start in range(lower, upper + 1, step)]
+
+
+def _export_shard(task):
+    """
+    Pool worker: export one id range over its own connection into a shard file.
+    """
+    id_range, shard_file_name = task
+    conn = db.connect()
+    try:
+        with open(shard_file_name, 'w') as output:
+            count = write_rows(export_rows(conn, id_range=id_range), output)
+    finally:
+        conn.close()
+    return shard_file_name, count
+
+
+def export_shards(cur, jobs, directory):
+    """
+    Export the whole catalogue over several connections at once, one shard file per
+    id range.
+
+    :param cur: psycopg2 cursor
+    :param jobs: int, number of connections and worker processes.
+    :param directory: str, where to write the shard files.
+    :return: list of shard file names, in id order.
+    """
+    cur.execute(ID_RANGE_QUERY)
+    lower, upper = cur.fetchone()
+    tasks = [(id_range, os.path.join(directory, 'shard-%04d.txt' % (i,)))
+             for i, id_range in enumerate(split_id_range(lower, upper, jobs * SHARDS_PER_JOB))]
+    with multiprocessing.Pool(jobs) as pool:
+        for shard_file_name, count in pool.imap_unordered(_export_shard, tasks):
+            print('%s: %d rows' % (os.path.basename(shard_file_name), count))
+    return [shard_file_name for _, shard_file_name in tasks]
+
+
+def read_shard(shard_file_name):
+    """
+    :return: iterator of (identifier, id, source, tag, subfield) tuples of str.
+    """
+    with open(shard_file_name, 'r') as fp:
+        for row in csv.reader(fp):
+            yield tuple(row)
+
+
+def write_rows(rows, output):
+    """
+    Write rows in the bib-data.txt format, without the header.
+
+    :param rows: iterable of (identifier, id, source, tag, subfield)
+    :param output: text file object
+    :return: int, number of rows written.
+    """
+    count = 0
+    for row in rows:
+        output.write(','.join(row))
+        output.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(rows, output):
+    """
+    Write rows in the bib-data.txt format.
+
+    :param rows: iterable of (identifier, id, source, tag, subfield)
+    :param output: text file object
+    """
+    output.write(CSV_HEADER)
+    write_rows(rows, output)
+
+
+def _publish(filename, write):
+    temp_file_name = filename + '.tmp'
+    with compress.open_file(temp_file_name, 'wt', compress.compression_of(filename)) as output:
+        write(output)
+    compress.fsync(temp_file_name)
+    os.replace(temp_file_name, filename)
+
+
+def publish_csv(rows, filename):
+    """
+    Write rows in the bib-data.txt format to a temporary file, then move it into place,
+    so readers never see a half-written file.
+
+    :param rows: iterable of (identifier, id, source, tag, subfield)
+    :param filename: str
+    """
+    _publish(filename, lambda output: write_csv(rows, output))
+
+
+def publish_shards(shard_file_names, filename):
+    """
+    Concatenate shard files into one bib-data.txt, published like publish_csv().
+
+    :param shard_file_names: list of str
+    :param filename: str
+    """
+    def write(output):
+        output.write(CSV_HEADER)
+        for shard_file_name in shard_file_names:
+            with open(shard_file_name, 'r') as shard:
+                shutil.copyfileobj(shard, output)
+    _publish(filename, write)
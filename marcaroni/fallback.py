@@ -0,0 +1,102 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Matching records that have no identifiers, or whose identifiers match nothing, by their
+title, main entry and date.
+
+A snapshot written by update-data.py --titles holds an inverted index from title words
+to records (see marcaroni.snapshot.TitleIndex). A record is only compared with the few
+catalogue records that share the most of its rarer title words, and a match is kept if
+it scores at least the threshold of the match policy. The matches then go through the
+rules like matches on identifiers.
+
+The score is the Dice coefficient of the two sets of title words, raised when the main
+entries or the years agree and lowered when they differ, between 0 and 1.
+"""
+
+from collections import Counter, namedtuple
+
+from marcaroni.normalize import title_key, author_key, publication_year
+
+# title and author are keys from marcaroni.normalize, year is an int, 0 if unknown.
+Description = namedtuple('Description', ['title', 'author', 'year'])
+
+# Records compared per record, those sharing the most title words with it.
+CANDIDATES = 20
+
+# Records with a title word are not looked at if there are more of them than this: the
+# word hardly narrows the search, and the other words of the title are rarer.
+MAX_POSTINGS = 10000
+
+AUTHOR_AGREES = 0.1
+AUTHOR_DIFFERS = 0.3
+YEAR_AGREES = 0.05
+YEAR_DIFFERS = 0.25
+
+
+def describe(title, author='', date=''):
+    """
+    :param title: str, e.g. 245 $a $b $n $p.
+    :param author: str, the main entry.
+    :param date: str, the date of publication.
+    :rtype: Description
+    """
+    return Description(title_key(title), author_key(author), publication_year(date))
+
+
+def score(description, candidate):
+    """
+    :type description: Description
+    :type candidate: Description
+    :return: float, from 0 (nothing in common) to 1.
+    """
+    words = set(description.title.split())
+    other_words = set(candidate.title.split())
+    if not words or not other_words:
+        return 0.0
+    authors_agree = None
+    if description.author and candidate.author:
+        authors_agree = description.author == candidate.author
+    if min(len(words), len(other_words)) < 2 and not authors_agree:
+        # One word is too little to go on by itself.
+        return 0.0
+    similarity = 2.0 * len(words & other_words) / (len(words) + len(other_words))
+    if authors_agree is not None:
+        similarity += AUTHOR_AGREES if authors_agree else -AUTHOR_DIFFERS
+    if description.year and candidate.year:
+        similarity += YEAR_AGREES if abs(description.year - candidate.year) <= 1 else -YEAR_DIFFERS
+    return max(0.0, min(1.0, similarity))
+
+
+def candidates(index, description, limit=CANDIDATES):
+    """
+    :type index: marcaroni.snapshot.TitleIndex
+    :type description: Description
+    :return: list of int, positions in index of the records sharing the most title words
+             with description, at most limit of them.
+    """
+    postings = [index.postings(word) for word in set(description.title.split())]
+    hits = Counter()
+    for positions in postings:
+        if len(positions) <= MAX_POSTINGS:
+            hits.update(positions)
+    ranked = sorted(hits.items(), key=lambda item: (-item[1], item[0]))
+    return [position for position, _ in ranked[:limit]]
+
+
+def match(index, description, threshold):
+    """
+    :type index: marcaroni.snapshot.TitleIndex
+    :type description: Description
+    :param threshold: float, the lowest score kept.
+    :return: set of Record
+    """
+    matches = set()
+    for position in candidates(index, description):
+        if score(description, index.description(position)) >= threshold:
+            matches.add(index.record(position))
+    return matches
@@ -6,17 +6,50 @@
 
 import sys
 import csv
+import gc
+import json
+import struct
+from array import array
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+from marcaroni import compress
+from marcaroni.normalize import identifier_key
 
 from collections import namedtuple
 # Rename this? KnownRecord? ExistingRecord?
 Record = namedtuple('Record', ['id', 'source'])
 
+# Freeze what a load allocated, for runs that load once. A process that loads again and
+# again (the match server) turns this off: frozen objects are never collected, so each
+# replaced load would stay in memory for good.
+FREEZE_AFTER_LOAD = True
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the garbage collector for a bulk load. Everything allocated by the load is
+    frozen afterwards, unless FREEZE_AFTER_LOAD is off, so later collections don't have
+    to walk it again.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if FREEZE_AFTER_LOAD:
+            gc.freeze()
+        if was_enabled:
+            gc.enable()
+
+
 class ILSBibData:
     def __init__(self):
         self.records_by_identifiers = {}
 
     def load_from_file(self, bib_data_file_name, match_field = None):
-        with open(bib_data_file_name, 'r') as datafile:
+        with compress.open_input(bib_data_file_name, 'r') as datafile, gc_paused():
             reader = csv.DictReader(datafile, delimiter=',')
             next(reader)  # skip header, which is 'identifier,id,source,tag,subfield'
             for row in reader:
@@ -32,6 +65,15 @@ class ILSBibData:
             print("Bib data file did not contain valid records.", file=sys.stderr)
             sys.exit(1)
 
+    @property
+    def key_count(self):
+        return len(self.records_by_identifiers)
+
+    def add(self, identifier, bib_id, source):
+        if identifier not in self.records_by_identifiers:
+            self.records_by_identifiers[identifier] = []
+        self.records_by_identifiers[identifier].append(Record(bib_id, source))
+
     def __contains__(self, item):
         return item in self.records_by_identifiers
 
@@ -41,3 +83,269 @@ class ILSBibData:
             if identifier in self.records_by_identifiers:
                 matches |= set(self.records_by_identifiers[identifier])
         return matches
+
+    def match_many(self, identifier_sets):
+        """
+        Match the identifiers of many records at once. Here that is one dict lookup per
+        identifier, as in match(): sharing lookups across the batch costs more than it
+        saves. CompactILSBibData and SnapshotBibData, whose lookups cost more, batch them.
+
+        :type identifier_sets: list[set[str]]
+        :return: list of sets of Record, one per identifier set.
+        """
+        return [self.match(identifiers) for identifiers in identifier_sets]
+
+    def compact(self):
+        """
+        The same data as a CompactILSBibData, e.g. to publish it to worker processes.
+
+        :rtype: CompactILSBibData
+        """
+        compact = CompactILSBibData()
+        for identifier, records in self.records_by_identifiers.items():
+            for record in records:
+                compact.add(identifier, record.id, record.source)
+        return compact
+
+
+class CompactILSBibData:
+    """
+    Same interface as ILSBibData, but held in typed arrays rather than Python objects.
+
+    Each row of bib-data.txt costs one 64-bit identifier_key(), a 32-bit bib id, a 16-bit
+    source code and a chain link. Rows are found through an open-addressing table of
+    first rows, and rows sharing a key are chained through next_rows. Record tuples are
+    only built for hits.
+    """
+    _EMPTY = -1
+    # ISBN keys are nearly sequential, so spread them with a multiplicative hash before
+    # taking the slot.
+    _MIX = 0x9E3779B97F4A7C15
+
+    # Shared memory layout: header, then each column 8-byte aligned in _SHARED_COLUMNS
+    # order, then the source names as JSON.
+    _SHARED_MAGIC = b'MRCNSHM1'
+    _SHARED_HEADER = struct.Struct('<8sQQQQ')  # magic, rows, slots, key count, names length
+    _SHARED_COLUMNS = (('keys', 'Q'), ('next_rows', 'q'), ('slots', 'q'), ('ids', 'I'), ('sources', 'H'))
+
+    def __init__(self):
+        self._shared_memory = None
+        self._owner = False
+        self.keys = array('Q')  # per row: identifier_key() of the identifier
+        self.ids = array('I')  # per row: bib id
+        self.sources = array('H')  # per row: index into source_names
+        self.next_rows = array('q')  # per row: next row with the same key, or _EMPTY
+        self.slots = array('q', [self._EMPTY]) * 8  # first row for each key, by key & mask
+        self.key_count = 0
+        self.source_names = []  # list[str]
+        self.source_codes = {}  # dict[str] = int
+
+    def _source_code(self, source):
+        if source not in self.source_codes:
+            self.source_codes[source] = len(self.source_names)
+            self.source_names.append(source)
+        return self.source_codes[source]
+
+    def _find_slot(self, key):
+        slots, keys = self.slots, self.keys
+        mask = len(slots) - 1
+        i = ((key * self._MIX) >> 32) & mask
+        while True:
+            row = slots[i]
+            if row == self._EMPTY or keys[row] == key:
+                return i
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old_slots = self.slots
+        self.slots = array('q', [self._EMPTY]) * (len(old_slots) * 2)
+        for row in old_slots:
+            if row != self._EMPTY:
+                self.slots[self._find_slot(self.keys[row])] = row
+
+    def add(self, identifier, bib_id, source):
+        """
+        :type identifier: str
+        :type bib_id: str
+        :type source: str
+        """
+        key = identifier_key(identifier)
+        row = len(self.keys)
+        self.keys.append(key)
+        self.ids.append(int(bib_id))
+        self.sources.append(self._source_code(source))
+        i = self._find_slot(key)
+        self.next_rows.append(self.slots[i])
+        if self.slots[i] == self._EMPTY:
+            self.key_count += 1
+        self.slots[i] = row
+        if self.key_count * 2 > len(self.slots):
+            self._grow()
+
+    def load_from_file(self, bib_data_file_name, match_field = None):
+        with compress.open_input(bib_data_file_name, 'r') as datafile, gc_paused():
+            reader = csv.reader(datafile, delimiter=',')
+            header = next(reader)  # 'identifier,id,source,tag,subfield'
+            identifier_column, id_column, source_column, tag_column = \
+                [header.index(name) for name in ('identifier', 'id', 'source', 'tag')]
+            for row in reader:
+                if match_field \
+                        and row[tag_column] != match_field:
+                    continue
+                self.add(row[identifier_column], row[id_column], row[source_column])
+        if self.key_count == 0:
+            print("Bib data file did not contain valid records.", file=sys.stderr)
+            sys.exit(1)
+
+    def _rows(self, identifier):
+        row = self.slots[self._find_slot(identifier_key(identifier))]
+        while row != self._EMPTY:
+            yield row
+            row = self.next_rows[row]
+
+    def __contains__(self, item):
+        return self.slots[self._find_slot(identifier_key(item))] != self._EMPTY
+
+    def match(self, new_identifiers):
+        matches = set()
+        for identifier in new_identifiers:
+            for row in self._rows(identifier):
+                matches.add(Record(str(self.ids[row]), self.source_names[self.sources[row]]))
+        return matches
+
+    def match_many(self, identifier_sets):
+        """
+        Match the identifiers of many records at once. Each identifier of the batch is
+        keyed and probed once, and the Records of its rows built once, however many of
+        the sets hold it.
+
+        :type identifier_sets: list[set[str]]
+        :return: list of sets of Record, one per identifier set.
+        """
+        slots, keys, next_rows, ids, sources, source_names = \
+            self.slots, self.keys, self.next_rows, self.ids, self.sources, self.source_names
+        mask, empty = len(slots) - 1, self._EMPTY
+        found = {}  # dict[str] = list[Record], the identifiers of the batch that matched
+        for identifier in set().union(*identifier_sets):
+            # _find_slot(), inlined for the batch.
+            key = identifier_key(identifier)
+            i = ((key * self._MIX) >> 32) & mask
+            row = slots[i]
+            while row != empty and keys[row] != key:
+                i = (i + 1) & mask
+                row = slots[i]
+            if row == empty:
+                continue
+            records = found[identifier] = []
+            while row != empty:
+                records.append(Record(str(ids[row]), source_names[sources[row]]))
+                row = next_rows[row]
+        results = []
+        for identifiers in identifier_sets:
+            matches = set()
+            for identifier in identifiers:
+                records = found.get(identifier)
+                if records is not None:
+                    matches.update(records)
+            results.append(matches)
+        return results
+
+    @staticmethod
+    def _aligned(offset):
+        return (offset + 7) & ~7
+
+    def publish(self):
+        """
+        Copy the index into a block of shared memory that worker processes can attach()
+        to. The block lives until close() is called on this instance.
+
+        :return: str, the name of the block.
+        """
+        names = json.dumps(self.source_names).encode('utf-8')
+        offset = self._SHARED_HEADER.size
+        for name, typecode in self._SHARED_COLUMNS:
+            offset = self._aligned(offset + len(getattr(self, name)) * array(typecode).itemsize)
+        block = shared_memory.SharedMemory(create=True, size=offset + len(names))
+        self._SHARED_HEADER.pack_into(block.buf, 0, self._SHARED_MAGIC,
+                                      len(self.keys), len(self.slots), self.key_count, len(names))
+        offset = self._SHARED_HEADER.size
+        for name, typecode in self._SHARED_COLUMNS:
+            data = getattr(self, name).tobytes()
+            block.buf[offset:offset + len(data)] = data
+            offset = self._aligned(offset + len(data))
+        block.buf[offset:offset + len(names)] = names
+        self._shared_memory = block
+        self._owner = True
+        return block.name
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Open an index published by another process. The columns are read-only views of
+        the shared block, so nothing is copied and nothing is written to the pages.
+
+        :param name: str, as returned by publish().
+        :rtype: CompactILSBibData
+        """
+        block = shared_memory.SharedMemory(name=name)
+        magic, rows, slots, key_count, names_length = cls._SHARED_HEADER.unpack_from(block.buf, 0)
+        if magic != cls._SHARED_MAGIC:
+            block.close()
+            raise ValueError("Shared memory [%s] does not hold bib data." % (name,))
+        bib_data = cls()
+        buf = block.buf.toreadonly()
+        offset = cls._SHARED_HEADER.size
+        for column, typecode in cls._SHARED_COLUMNS:
+            length = (slots if column == 'slots' else rows) * array(typecode).itemsize
+            setattr(bib_data, column, buf[offset:offset + length].cast(typecode))
+            offset = cls._aligned(offset + length)
+        bib_data.source_names = json.loads(bytes(buf[offset:offset + names_length]).decode('utf-8'))
+        bib_data.source_codes = {source: code for code, source in enumerate(bib_data.source_names)}
+        bib_data.key_count = key_count
+        bib_data._shared_memory = block
+        return bib_data
+
+    def close(self):
+        """
+        Detach from shared memory. The publishing instance also frees the block, so it
+        should close last.
+        """
+        if self._shared_memory is None:
+            return
+        if not self._owner:
+            for column, typecode in self._SHARED_COLUMNS:
+                getattr(self, column).release()
+                setattr(self, column, array(typecode))
+        self._shared_memory.close()
+        if self._owner:
+            self._shared_memory.unlink()
+        self._shared_memory = None
+
+
+def load_by_tag(bib_data_file_name, match_fields, compact=False):
+    """
+    Read a bib data file once into a separate index per match field, as if it had been
+    loaded once per match field.
+
+    :type bib_data_file_name: str
+    :type match_fields: list[str]
+    :param compact: bool, hold the data in CompactILSBibData rather than ILSBibData.
+    :return: dict[str] = ILSBibData | CompactILSBibData
+    """
+    by_tag = {}
+    for match_field in match_fields:
+        by_tag[match_field] = CompactILSBibData() if compact else ILSBibData()
+    with compress.open_input(bib_data_file_name, 'r') as datafile, gc_paused():
+        reader = csv.reader(datafile, delimiter=',')
+        header = next(reader)  # 'identifier,id,source,tag,subfield'
+        identifier_column, id_column, source_column, tag_column = \
+            [header.index(name) for name in ('identifier', 'id', 'source', 'tag')]
+        for row in reader:
+            eg_records = by_tag.get(row[tag_column])
+            if eg_records is not None:
+                eg_records.add(row[identifier_column], row[id_column], row[source_column])
+    for match_field, eg_records in by_tag.items():
+        if eg_records.key_count == 0:
+            print("Bib data file did not contain valid records for %s." % (match_field,), file=sys.stderr)
+            sys.exit(1)
+    return by_tag
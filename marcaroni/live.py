@@ -0,0 +1,153 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Match straight against the Evergreen database, for when the bib data file is stale.
+
+Every identifier of the input goes into a temporary table with COPY, and all matches are
+resolved with one join against metabib.real_full_rec. The database side is cleaned by
+the SQL expressions below, which mirror marcaroni.normalize. Without an index on these
+expressions, the join cleans every 020 or 035 of the catalogue; create_indexes() (run by
+update-data.py --live-indexes) adds them, after which each input spelling is looked up.
+
+URL tokens are too involved to work out in SQL, so 856 $u are tokenized here instead.
+Every word of a token is a word of the $u it comes from, so only the $u having the most
+telling word of some input token (see _url_word()) are read, through a server-side
+cursor, along with those still percent-encoded, which tokenize into words of their own.
+"""
+
+from marcaroni import db
+from marcaroni.export import CLEANED_ISBN_SQL, EXPORT_BATCH_SIZE
+from marcaroni.ils import ILSBibData, Record
+from marcaroni.normalize import canonical_url, spellings
+
+_FOLDED_VALUE_SQL = "btrim(regexp_replace(lower(rfr.value), '[^[:alnum:]]+', ' ', 'g'))"
+
+# The value of real_full_rec, cleaned into one of normalize.spellings().
+SPELLING_SQL = {
+    '020': "upper(replace(" + CLEANED_ISBN_SQL + ", '-', ''))",
+    '035': "regexp_replace(" + _FOLDED_VALUE_SQL + ", "
+           "'^(ocolc (ocm|ocn|on)? ?|ocm ?|ocn ?)0*([0-9]+)$', 'ocolc \\3')",
+}
+
+# The partial expression index for the match query on a tag. Its expression and WHERE
+# must stay those of _MATCH_QUERY for the planner to use it.
+_INDEX_SQL = "CREATE INDEX CONCURRENTLY IF NOT EXISTS marcaroni_spelling_{tag}_idx " \
+             "ON metabib.real_full_rec (({spelling})) " \
+             "WHERE tag = '{tag}' AND (subfield = 'a' OR subfield = 'z')"
+
+_TEMPORARY_TABLE = 'marcaroni_input_identifiers'
+
+_CREATE_TABLE = "CREATE TEMPORARY TABLE " + _TEMPORARY_TABLE + " (spelling TEXT, identifier TEXT) ON COMMIT DROP"
+
+_MATCH_QUERY = "SELECT DISTINCT t.identifier, bre.id, bre.source " \
+               "FROM metabib.real_full_rec rfr " \
+               "JOIN biblio.record_entry bre ON bre.id = rfr.record " \
+               "JOIN " + _TEMPORARY_TABLE + " t ON t.spelling = {spelling} " \
+               "WHERE not bre.deleted AND bre.source is not NULL " \
+               "AND rfr.tag = %s AND (rfr.subfield = 'a' OR rfr.subfield = 'z')"
+
+_URL_WORDS_TABLE = 'marcaroni_input_url_words'
+
+_CREATE_URL_WORDS_TABLE = "CREATE TEMPORARY TABLE " + _URL_WORDS_TABLE + " (word TEXT PRIMARY KEY) ON COMMIT DROP"
+
+_URL_QUERY = "SELECT rfr.value, bre.id, bre.source " \
+             "FROM metabib.real_full_rec rfr " \
+             "JOIN biblio.record_entry bre ON bre.id = rfr.record " \
+             "WHERE not bre.deleted AND bre.source is not NULL " \
+             "AND rfr.tag = '856' AND rfr.subfield = 'u' " \
+             "AND (strpos(rfr.value, '%') > 0 OR EXISTS (" \
+             "SELECT 1 FROM unnest(string_to_array(" + _FOLDED_VALUE_SQL + ", ' ')) AS v(word) " \
+             "JOIN " + _URL_WORDS_TABLE + " w ON w.word = v.word))"
+
+
+def _url_word(token):
+    """
+    :param token: str, a URL token.
+    :return: str, the word of token least likely to be in other URLs: the longest of
+             those with a digit, as item ids have, else the longest; the last one of
+             these, as the host comes first.
+    """
+    return max(reversed(token.split()), key=lambda word: (any(c.isdigit() for c in word), len(word)))
+
+
+def index_sql(match_field):
+    """
+    :param match_field: str, '020' or '035'.
+    :return: str, the statement creating the index the match query on match_field uses.
+    """
+    # An index expression names the column without the alias of the query.
+    return _INDEX_SQL.format(tag=match_field, spelling=SPELLING_SQL[match_field].replace('rfr.value', 'value'))
+
+
+def create_indexes(conn):
+    """
+    Create the indexes of the match queries that are missing. They are built without
+    locking out edits to the catalogue, which takes a while on a large one. If a build
+    fails, the invalid index it leaves must be dropped before trying again.
+
+    :param conn: psycopg2 connection, left in autocommit mode.
+    """
+    # CREATE INDEX CONCURRENTLY can't run in a transaction.
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for match_field in sorted(SPELLING_SQL):
+            print('Creating the index of %s for --live...' % (match_field,))
+            cur.execute(index_sql(match_field))
+
+
+class LiveBibData(ILSBibData):
+    """
+    ILSBibData filled from the database, for the given identifiers only.
+    """
+    def load_from_database(self, conn, identifiers, match_field):
+        """
+        :param conn: psycopg2 connection
+        :param identifiers: iterable of canonical identifiers, as extracted by PendingRecord.
+        :param match_field: str, '020', '035' or '856'.
+        """
+        if match_field == '856':
+            self._load_urls(conn, set(identifiers))
+            return
+        if match_field not in SPELLING_SQL:
+            raise ValueError("Cannot match on field [%s] against the database." % (match_field,))
+        rows = set()
+        for identifier in identifiers:
+            for spelling in spellings(identifier, match_field):
+                rows.add((spelling, identifier))
+        with conn.cursor() as cur:
+            cur.execute(_CREATE_TABLE)
+            cur.copy_from(db.StringIteratorIO('%s\t%s\n' % row for row in rows), _TEMPORARY_TABLE,
+                          sep='\t', columns=('spelling', 'identifier'))
+            cur.execute("ANALYZE " + _TEMPORARY_TABLE)
+            cur.execute(_MATCH_QUERY.format(spelling=SPELLING_SQL[match_field]), (match_field,))
+            for identifier, bib_id, source in cur:
+                if identifier not in self.records_by_identifiers:
+                    self.records_by_identifiers[identifier] = []
+                self.records_by_identifiers[identifier].append(Record(str(bib_id), str(source)))
+        conn.rollback()
+
+    def _load_urls(self, conn, identifiers):
+        """
+        :param conn: psycopg2 connection
+        :param identifiers: set of URL tokens.
+        """
+        with conn.cursor() as cur:
+            cur.execute(_CREATE_URL_WORDS_TABLE)
+            cur.copy_from(db.StringIteratorIO('%s\n' % word for word in set(map(_url_word, identifiers))),
+                          _URL_WORDS_TABLE, sep='\t', columns=('word',))
+            cur.execute("ANALYZE " + _URL_WORDS_TABLE)
+        with conn.cursor(name='marcaroni_live_urls') as cur:
+            cur.itersize = EXPORT_BATCH_SIZE
+            cur.execute(_URL_QUERY)
+            for value, bib_id, source in cur:
+                identifier = canonical_url(value)
+                if identifier not in identifiers:
+                    continue
+                if identifier not in self.records_by_identifiers:
+                    self.records_by_identifiers[identifier] = []
+                self.records_by_identifiers[identifier].append(Record(str(bib_id), str(source)))
+        conn.rollback()
@@ -0,0 +1,357 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Per-stage timing of a run, for --metrics and --profile.
+
+Code marks its stages with
+
+    with marcaroni.metrics.stage('lookup', len(batch)):
+        ...
+
+which costs next to nothing until enable() is called. A stage's times do not include the
+stages nested in it, so the stages of a run add up. Each stage keeps a histogram of the
+duration of its calls; for stages entered once per record (parse, extract, rules) that
+is the per-record latency.
+
+Stages may also be timed on other threads (e.g. write_io, on the thread of a
+marcaroni.writer.Writer). Their CPU time is that of their own thread, and they run
+alongside those of the main thread, so they are left out of its sum.
+
+The totals are written as JSON and as a Prometheus textfile, for the node_exporter
+textfile collector.
+"""
+
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the call duration histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 1.0, 10.0)
+
+_metrics = None
+
+
+class _Stage:
+    __slots__ = ('wall', 'cpu', 'calls', 'items', 'buckets')
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+        self.items = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # the last one is +Inf
+
+    def as_dict(self):
+        return {'wall': self.wall, 'cpu': self.cpu, 'calls': self.calls, 'items': self.items,
+                'buckets': list(self.buckets)}
+
+    def merge(self, data):
+        self.wall += data['wall']
+        self.cpu += data['cpu']
+        self.calls += data['calls']
+        self.items += data['items']
+        self.buckets = [a + b for a, b in zip(self.buckets, data['buckets'])]
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'items', 'wall', 'cpu', 'child_wall', 'child_cpu')
+
+    def __init__(self, metrics, name, items):
+        self.metrics = metrics
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.child_wall = self.child_cpu = 0.0
+        self.metrics._stack.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        stack = self.metrics._stack
+        stack.pop()
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+        self.metrics.add(self.name, wall - self.child_wall, cpu - self.child_cpu, self.items)
+        return False
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Metrics:
+    def __init__(self, job, record_stage):
+        """
+        :param job: str, the tool being measured, e.g. 'bibmatcher'.
+        :param record_stage: str, the stage whose items are the records of the run.
+        """
+        self.job = job
+        self.record_stage = record_stage
+        self.stages = {}  # dict[str] = _Stage, in the order first seen
+        self.background_stages = set()  # names of the stages timed off the main thread
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self):
+        # The stages being timed on this thread, innermost last.
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def stage(self, name, items=1):
+        return _Timer(self, name, items)
+
+    def add(self, name, wall, cpu, items=1):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = _Stage()
+                if threading.current_thread() is not threading.main_thread():
+                    self.background_stages.add(name)
+            stage.wall += wall
+            stage.cpu += cpu
+            stage.calls += 1
+            stage.items += items
+            stage.buckets[bisect_left(LATENCY_BUCKETS, wall)] += 1
+
+    def take(self):
+        """
+        The stages measured so far, e.g. in a worker process, to merge() into the parent's.
+        They are reset.
+
+        :rtype: dict
+        """
+        with self._lock:
+            stages = dict((name, stage.as_dict()) for name, stage in self.stages.items())
+            self.stages = {}
+        return stages
+
+    def merge(self, stages):
+        with self._lock:
+            for name, data in stages.items():
+                stage = self.stages.get(name)
+                if stage is None:
+                    stage = self.stages[name] = _Stage()
+                stage.merge(data)
+
+    def as_dict(self):
+        wall = time.perf_counter() - self.started
+        with self._lock:
+            stages = dict((name, stage.as_dict()) for name, stage in self.stages.items())
+        records = stages[self.record_stage]['items'] if self.record_stage in stages else 0
+        return {
+            'job': self.job,
+            'wall': wall,
+            'cpu': time.process_time() - self.started_cpu,
+            'records': records,
+            'records_per_second': records / wall if wall > 0 else 0.0,
+            # ru_maxrss is in kilobytes on Linux. Workers count once they have exited.
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'peak_rss_workers_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            'latency_buckets': list(LATENCY_BUCKETS),
+            'stages': stages,
+        }
+
+    def report(self):
+        """
+        :return: list of str, a table of the stages for the console.
+        """
+        data = self.as_dict()
+        lines = ["%-12s %10s %10s %10s %12s" % ('stage', 'wall (s)', 'cpu (s)', 'items', 'us/item')]
+        accounted = 0.0
+        for name, stage in data['stages'].items():
+            if name not in self.background_stages:
+                accounted += stage['wall']
+            lines.append("%-12s %10.3f %10.3f %10d %12.1f" % (name, stage['wall'], stage['cpu'], stage['items'],
+                                                              stage['wall'] * 1000000 / max(stage['items'], 1)))
+        lines.append("%-12s %10.3f" % ('other', data['wall'] - accounted))
+        if self.background_stages:
+            lines.append("%s: on other threads, alongside the rest" % (', '.join(sorted(self.background_stages)),))
+        lines.append("%d records in %.3f s (%.1f records/s), peak RSS %.1f MB" % (
+            data['records'], data['wall'], data['records_per_second'], data['peak_rss_bytes'] / 1048576.0))
+        return lines
+
+    def prometheus(self):
+        """
+        :return: str, in the Prometheus text exposition format.
+        """
+        data = self.as_dict()
+        job = _label_value(self.job)
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % label for label in [('job', job)] + labels)
+                lines.append('%s{%s} %s' % (name, label_text, _number(value)))
+
+        stages = data['stages']
+        metric('marcaroni_stage_seconds_total', 'counter', 'Wall time spent in a stage, without nested stages.',
+               [([('stage', _label_value(name))], stage['wall']) for name, stage in stages.items()])
+        metric('marcaroni_stage_cpu_seconds_total', 'counter', 'CPU time spent in a stage, without nested stages.',
+               [([('stage', _label_value(name))], stage['cpu']) for name, stage in stages.items()])
+        metric('marcaroni_stage_items_total', 'counter', 'Items (records, rows or batches) handled by a stage.',
+               [([('stage', _label_value(name))], stage['items']) for name, stage in stages.items()])
+        samples = []
+        for name, stage in stages.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), stage['buckets']):
+                cumulative += count
+                samples.append(([('stage', _label_value(name)), ('le', _number(bound))], cumulative))
+        lines.append('# HELP marcaroni_stage_call_seconds Duration of one call of a stage; per record for '
+                     'parse, extract and rules.')
+        lines.append('# TYPE marcaroni_stage_call_seconds histogram')
+        for labels, value in samples:
+            label_text = ','.join('%s="%s"' % label for label in [('job', job)] + labels)
+            lines.append('marcaroni_stage_call_seconds_bucket{%s} %s' % (label_text, _number(value)))
+        for name, stage in stages.items():
+            label_text = 'job="%s",stage="%s"' % (job, _label_value(name))
+            lines.append('marcaroni_stage_call_seconds_sum{%s} %s' % (label_text, _number(stage['wall'])))
+            lines.append('marcaroni_stage_call_seconds_count{%s} %s' % (label_text, _number(stage['calls'])))
+        metric('marcaroni_run_seconds', 'gauge', 'Wall time of the run.', [([], data['wall'])])
+        metric('marcaroni_records_total', 'counter', 'Records handled by the run.', [([], data['records'])])
+        metric('marcaroni_records_per_second', 'gauge', 'Records handled per second of the run.',
+               [([], data['records_per_second'])])
+        metric('marcaroni_peak_rss_bytes', 'gauge', 'Peak resident set size.',
+               [([('process', 'main')], data['peak_rss_bytes']),
+                ([('process', 'workers')], data['peak_rss_workers_bytes'])])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """
+        Write the metrics as JSON to filename, and as a Prometheus textfile next to it,
+        with the extension .prom.
+        """
+        _write_atomically(filename, json.dumps(self.as_dict(), indent=1) + '\n')
+        _write_atomically(os.path.splitext(filename)[0] + '.prom', self.prometheus())
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def _write_atomically(filename, text):
+    # The textfile collector may read the file at any time; never let it see half of it.
+    temporary_file_name = filename + '.tmp'
+    with open(temporary_file_name, 'w') as fp:
+        fp.write(text)
+    os.replace(temporary_file_name, filename)
+
+
+def enable(job, record_stage='parse'):
+    """
+    Start measuring the stages of this process.
+
+    :rtype: Metrics
+    """
+    global _metrics
+    _metrics = Metrics(job, record_stage)
+    return _metrics
+
+
+def current():
+    """
+    :return: Metrics, or None if not enabled.
+    """
+    return _metrics
+
+
+def stage(name, items=1):
+    """
+    :param name: str
+    :param items: int, records (or rows) handled by this call.
+    :return: a context manager timing its body as part of stage name.
+    """
+    if _metrics is None:
+        return _NO_TIMER
+    return _metrics.stage(name, items)
+
+
+def timed(iterable, name):
+    """
+    Iterate over iterable, timing each step as stage name; for readers that parse lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextmanager
+def profiling(filename, top=25):
+    """
+    Run the body under cProfile, and save the profile to filename for pstats or snakeviz.
+    The top functions by cumulative time are printed to stderr.
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(filename)
+        stats = pstats.Stats(profile, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(top)
+
+
+def measure_until_exit(job, metrics_file=None, profile_file=None, record_stage='parse'):
+    """
+    For scripts that run at module level and leave with exit(): measure from now on, and
+    write the metrics (and the profile) when the interpreter exits.
+    """
+    if metrics_file:
+        enable(job, record_stage)
+    profile = None
+    if profile_file:
+        profile = profiling(profile_file)
+        profile.__enter__()
+
+    def finish():
+        if profile is not None:
+            profile.__exit__(None, None, None)
+        if metrics_file:
+            _metrics.write(metrics_file)
+            for line in _metrics.report():
+                print(line)
+
+    atexit.register(finish)
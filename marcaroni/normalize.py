@@ -0,0 +1,264 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Canonical identifier keys, shared by update-data.py and bibmatcher.py.
+
+Both sides of a match go through canonical_identifier(), so each identifier is looked
+up once under one spelling:
+
+    020  ISBN-13 digits. ISBN-10s are converted, hyphens and qualifiers are dropped.
+    035  lower case, punctuation as single spaces. OCLC numbers become 'ocolc <digits>'
+         whatever their (OCoLC)/ocm/ocn/on prefix and leading zeros.
+    856  a token of the URL in $u: lower case, punctuation as single spaces, without the
+         proxy prefix ('... login url '), scheme and www. On platforms whose URLs vary
+         between libraries or sessions (URL_ITEM_KEYS), only the host and the query
+         parameters naming the item are kept. The database holds 856s in this folded
+         form already, and a token is its own token.
+
+identifier_key() turns a canonical identifier into a 64-bit integer key: an ISBN-13 is
+its own key, anything else is hashed.
+
+Records are also described by keys of their title, main entry and date, to match
+records without identifiers (see marcaroni.fallback):
+
+    title   the words of 245 $a $b $n $p, lower case without diacritics, less a few
+            articles and prepositions.
+    author  the main entry (100, 110 or 111 $a) up to its first comma, i.e. the surname
+            of a person, in the same form.
+    year    the first four-digit year of the date of publication.
+"""
+
+import re
+import hashlib
+import unicodedata
+from functools import lru_cache
+from urllib.parse import unquote
+
+# Distinct values seen in one run. Vendor files repeat the same 035 prefixes and
+# ISBNs from the CSV mode a lot, so this is plenty to make repeats free.
+CACHE_SIZE = 1 << 16
+
+_ISBN_STRIP = str.maketrans('x', 'X', '- ')
+_ISBN_10 = re.compile(r'^[0-9]{9}[0-9X]$')
+_ISBN_13 = re.compile(r'^97[89][0-9]{10}$')
+
+_PUNCTUATION = re.compile(r'[\W_]+')
+_OCLC = re.compile(r'^(?:ocolc (?:ocm|ocn|on)? ?|ocm ?|ocn ?)0*([0-9]+)$')
+_PROXY_PREFIX = re.compile(r'^.* login q?url ')
+_URL_SCHEMES = frozenset(['http', 'https', 'ftp'])
+_WWW = re.compile(r'^www[0-9]*$')
+
+# Platforms whose URLs name the same item in more than one way, e.g. with the library
+# in the path: the host, as words, and the query parameters that name the item. The
+# host may have more words before it (search.ebscohost.com, web.b.ebscohost.com).
+URL_ITEM_KEYS = [
+    (('ebookcentral', 'proquest', 'com'), ('docid',)),
+    (('site', 'ebrary', 'com'), ('docid',)),
+    (('ebscohost', 'com'), ('db', 'an')),
+]
+
+# Hosts spelled more than one way, and the spelling kept.
+URL_HOST_ALIASES = {
+    ('dx', 'doi', 'org'): ('doi', 'org'),
+}
+
+# Words a host may have before the host of URL_ITEM_KEYS.
+_HOST_PREFIX_WORDS = 3
+
+_HASHED_KEY_FLAG = 1 << 63
+
+_YEAR = re.compile(r'(?<![0-9])(1[5-9][0-9][0-9]|20[0-9][0-9])(?![0-9])')
+
+# Words left out of title keys. They tell little about a title and occur in most.
+TITLE_STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'as', 'at', 'by', 'for', 'from', 'in', 'of', 'on', 'or', 'the', 'to', 'with',
+    'de', 'des', 'du', 'et', 'la', 'le', 'les', 'un', 'une',
+    'das', 'der', 'die', 'und',
+    'el', 'los', 'las', 'y',
+])
+
+
+def _isbn_13_check_digit(first_12_digits):
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(first_12_digits))
+    return str((10 - total % 10) % 10)
+
+
+def canonical_isbn(value):
+    """
+    :type value: str
+    :return: str of 13 digits, or None if value does not hold an ISBN.
+    """
+    cleaned = value.strip().strip(',')
+    cleaned = cleaned.split(' ')[0]
+    cleaned = cleaned.strip('-')
+    cleaned = cleaned.split('ü')[0]  ## Delete me when umlauts are fixed
+    cleaned = cleaned.split('(')[0]
+    cleaned = cleaned.split('\\')[0]
+    cleaned = cleaned.translate(_ISBN_STRIP)
+    if _ISBN_13.match(cleaned):
+        return cleaned
+    if _ISBN_10.match(cleaned):
+        first_12_digits = '978' + cleaned[:9]
+        return first_12_digits + _isbn_13_check_digit(first_12_digits)
+    return None
+
+
+def canonical_035(value):
+    """
+    :type value: str
+    :return: str, or None if value holds no digits.
+    """
+    cleaned = _PUNCTUATION.sub(' ', value.lower()).strip()
+    if not any(c.isdigit() for c in cleaned):
+        return None
+    oclc = _OCLC.match(cleaned)
+    if oclc:
+        return 'ocolc ' + oclc.group(1)
+    return cleaned
+
+
+def _url_item_key(words):
+    """
+    :param words: list of str, a folded URL from its host on.
+    :return: list of str, the host and item key words, or None if the URL is not on one
+             of URL_ITEM_KEYS or lacks its parameters.
+    """
+    for host, parameters in URL_ITEM_KEYS:
+        for start in range(min(_HOST_PREFIX_WORDS, len(words) - len(host)) + 1):
+            if tuple(words[start:start + len(host)]) == host:
+                break
+        else:
+            continue
+        values = {}
+        for i in range(start + len(host), len(words) - 1):
+            if words[i] in parameters and words[i] not in values:
+                values[words[i]] = words[i + 1]
+        if len(values) < len(parameters):
+            return None
+        key = list(host)
+        for parameter in parameters:
+            key += [parameter, values[parameter]]
+        return key
+    return None
+
+
+def canonical_url(value):
+    """
+    :param value: str, an 856 $u, or a value of the database in which punctuation has
+                  been folded already.
+    :return: str, or None if nothing is left.
+    """
+    if '%' in value:
+        # A proxy may carry the URL quoted (login?qurl=https%3A%2F%2F...).
+        value = unquote(value)
+    cleaned = _PUNCTUATION.sub(' ', value.lower()).strip()
+    words = _PROXY_PREFIX.sub('', cleaned).split()
+    if words and words[0] in _URL_SCHEMES:
+        words = words[1:]
+    if words and _WWW.match(words[0]):
+        words = words[1:]
+    item_key = _url_item_key(words)
+    if item_key is not None:
+        return ' '.join(item_key)
+    for alias, host in URL_HOST_ALIASES.items():
+        if tuple(words[:len(alias)]) == alias:
+            words = list(host) + words[len(alias):]
+    return ' '.join(words) or None
+
+
+def isbn_10(isbn_13):
+    """
+    :param isbn_13: str, a canonical ISBN.
+    :return: str, the ISBN-10 spelling of the same book, or None if it has none.
+    """
+    if not isbn_13.startswith('978'):
+        return None
+    body = isbn_13[3:12]
+    check = (11 - sum((10 - i) * int(d) for i, d in enumerate(body)) % 11) % 11
+    return body + ('X' if check == 10 else str(check))
+
+
+def spellings(identifier, tag):
+    """
+    The spellings a canonical identifier may have in the database, once cleaned by
+    marcaroni.live. Only ISBNs have more than one.
+
+    :type identifier: str
+    :type tag: str
+    :rtype: list[str]
+    """
+    if tag == '020':
+        short = isbn_10(identifier)
+        if short is not None:
+            return [identifier, short]
+    return [identifier]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def canonical_identifier(value, tag):
+    """
+    :param value: str, a raw subfield value or a value from metabib.real_full_rec.
+    :param tag: str, the MARC tag it came from.
+    :return: str, or None if value is not a matchable identifier.
+    """
+    if tag == '020':
+        return canonical_isbn(value)
+    if tag == '035':
+        return canonical_035(value)
+    if tag == '856':
+        return canonical_url(value)
+    return value.strip() or None
+
+
+def identifier_key(identifier):
+    """
+    A 64-bit key for a canonical identifier. ISBN-13s are used as they are. Anything
+    else is hashed, with the top bit set so it can never collide with an ISBN. Unlike
+    hash(), the key is stable across processes.
+
+    :type identifier: str
+    :rtype: int
+    """
+    if len(identifier) == 13 and identifier.isdigit():
+        return int(identifier)
+    digest = hashlib.blake2b(identifier.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') | _HASHED_KEY_FLAG
+
+
+def _words(value):
+    """
+    :return: list of str, the words of value in lower case, without diacritics.
+    """
+    decomposed = unicodedata.normalize('NFKD', value.lower())
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return _PUNCTUATION.sub(' ', stripped).split()
+
+
+def title_key(title):
+    """
+    :param title: str, e.g. 245 $a $b $n $p joined by spaces.
+    :return: str, the words of the title that tell it apart, separated by spaces. Empty
+             if none are left.
+    """
+    return ' '.join(word for word in _words(title) if word not in TITLE_STOP_WORDS)
+
+
+def author_key(author):
+    """
+    :param author: str, a 100, 110 or 111 $a.
+    :return: str, the name up to its first comma, or '' if there is none.
+    """
+    return ' '.join(_words(author.split(',')[0]))
+
+
+def publication_year(date):
+    """
+    :param date: str, e.g. a 264 $c or 260 $c ('c2015.', '[2019]'), or 008/07-10.
+    :return: int, or 0 if date holds no year.
+    """
+    year = _YEAR.search(date)
+    return int(year.group(1)) if year else 0
@@ -1,139 +1,250 @@
 import logging
 import os
 import datetime
-import csv
 from pymarc.field import Field
 
+import marcaroni.compress
+import marcaroni.metrics
+import marcaroni.writer
+from marcaroni.checkpoint import CheckpointError
+
+
+def add_bib_id(marc_rec, bib_id):
+    """
+    Mark an incoming record with the id of the existing record it should overlay.
+    """
+    marc_rec.marc.add_field(Field(
+        tag='901',
+        indicators=[' ', ' '],
+        subfields=['c', bib_id]
+    ))
+
+
+def as_marc(data):
+    """
+    :param data: bytes, or a record with as_marc().
+    :rtype: bytes
+    """
+    return data if isinstance(data, bytes) else data.as_marc()
+
 
 class OutputRecordHandler:
-    def __init__(self, prefix, bibsource_prefix):
+    # Counters saved in a checkpoint. A file whose counter was 0 holds no records.
+    COUNTERS = (
+        'records_without_matches_counter',
+        'match_has_worse_license__counter',
+        'exact_match__counter',
+        'match_has_better_license__counter',
+        'ambiguous__counter',
+        'old_ddas_counter',
+        'self_ddas_counter',
+    )
+
+    def __init__(self, prefix, bibsource_prefix, checkpoint=None, compression=None):
+        """
+        :param checkpoint: dict, as returned by checkpoint_state(), to carry on from. Files
+                           with records are cut back to their size at the checkpoint.
+        :param compression: str, 'gz', 'bz2' or 'xz' to write the .mrc files compressed.
+        """
         if not os.path.exists(prefix):
             os.makedirs(prefix)
         self.prefix = prefix
+        self.compression = compression
         self.matches_by_bibsource = {}
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        if checkpoint is not None:
+            self.matches_by_bibsource = dict(checkpoint['matches_by_bibsource'])
+            for counter in self.COUNTERS:
+                setattr(self, counter, checkpoint['counters'][counter])
+
+        # Initialize logging. Each handler logs to its own directory, so several can be
+        # open at once (e.g. the jobs of a manifest).
+        log_format = logging.Formatter('  %(message)s')
+        self.log_handlers = [logging.FileHandler(os.path.join(prefix, 'marcaroni.log')), logging.StreamHandler()]
+        self.log = logging.getLogger('marcaroni.output.%d' % (id(self),))
+        self.log.setLevel(logging.INFO)
+        self.log.propagate = False
+        for handler in self.log_handlers:
+            handler.setFormatter(log_format)
+            self.log.addHandler(handler)
+        self.log.info("\nStarting Marcaroni: %s" %(datetime.datetime.now(), ) )
 
-        # Initialize logging
-        log_level = logging.INFO
-        log_format = '  %(message)s'
-        handlers = [logging.FileHandler(os.path.join(prefix, 'marcaroni.log')), logging.StreamHandler()]
-        logging.basicConfig(level = log_level, format = log_format, handlers = handlers)
-        logging.info("\nStarting Marcaroni: %s" %(datetime.datetime.now(), ) )
+        mrc = '.mrc' + marcaroni.compress.extension(compression)
 
         # Output file for incoming records with no match found.
-        self.no_matches_on_platform__file_name = os.path.join(prefix, bibsource_prefix + "_no_matches_on_platform.mrc")
-        self.no_matches_on_platform__file_pointer = open(self.no_matches_on_platform__file_name, "wb")
-        self.records_without_matches_counter = 0
+        self.no_matches_on_platform__file_name = os.path.join(prefix, bibsource_prefix + "_no_matches_on_platform" + mrc)
 
         # Output file for incoming records with one match on the platform, having a worse license.
-        self.match_has_worse_license__file_name = os.path.join(prefix, bibsource_prefix + "_match_has_worse_license.mrc")
-        self.match_has_worse_license__file_pointer = open(self.match_has_worse_license__file_name, "wb")
-        self.match_has_worse_license__counter = 0
+        self.match_has_worse_license__file_name = os.path.join(prefix, bibsource_prefix + "_match_has_worse_license" + mrc)
 
         # Output file for incoming records with one match on the platform, having the same bibsource.
-        self.exact_match__file_name = os.path.join(prefix, bibsource_prefix + "_exact_match_same_bibsource.mrc")
-        self.exact_match__file_pointer = open(self.exact_match__file_name, "wb")
+        self.exact_match__file_name = os.path.join(prefix, bibsource_prefix + "_exact_match_same_bibsource" + mrc)
         self.exact_match_ids__file_name = os.path.join(prefix, "exact_match_ids.txt")
-        self.exact_match_ids__file_pointer = open(self.exact_match_ids__file_name, "w")
-        self.exact_match__counter = 0
 
         # Output file for incoming records with one match on the platform, having a better license.
-        self.match_has_better_license__file_name = os.path.join(prefix, bibsource_prefix + "_match_has_better_license.mrc")
-        self.match_has_better_license__file_pointer = open(self.match_has_better_license__file_name, "wb")
-        self.match_has_better_license__counter = 0
+        self.match_has_better_license__file_name = os.path.join(prefix, bibsource_prefix + "_match_has_better_license" + mrc)
 
         # Output file for incoming records with multiple matches on the same platform (or are otherwise ambiguous).
-        self.ambiguous__file_name = os.path.join(prefix, bibsource_prefix + "_ambiguous.mrc")
-        self.ambiguous__file_pointer = open(self.ambiguous__file_name, "wb")
+        self.ambiguous__file_name = os.path.join(prefix, bibsource_prefix + "_ambiguous" + mrc)
         self.ambiguous_report__file_name = os.path.join(prefix, "report_ambiguous_records.csv")
-        self.ambiguous_report__file_pointer = open(self.ambiguous_report__file_name, "w")
-        self.ambiguous_report__csv_writer = csv.writer(self.ambiguous_report__file_pointer)
-        self.ambiguous_report__csv_writer.writerow(('Title', 'ISBN', 'Reason'))
-        self.ambiguous__counter = 0
 
         # Remove these - build a reporting script at some other point. Unlikely to match on record ID (035) across
         # distributor platforms.
         self.ddas_to_hide_report_file_name = os.path.join(prefix, 'report_existing_dda_records_to_hide.csv')
-        self.ddas_to_hide_report_fp = open(self.ddas_to_hide_report_file_name, "w")
-        self.ddas_to_hide_report_writer = csv.writer(self.ddas_to_hide_report_fp, dialect='excel-tab')
-        # self.ddas_to_hide_report_writer.writerow(('Platform', 'Title', 'BibId'))
-        self.old_ddas_counter = 0
-
         self.self_ddas_to_hide_report_file_name = os.path.join(prefix, 'report_ddas_from_this_file_to_hide.csv')
-        self.self_ddas_to_hide_report_fp = open(self.self_ddas_to_hide_report_file_name, "w")
-        self.self_ddas_to_hide_report_writer = csv.writer(self.self_ddas_to_hide_report_fp, dialect='excel-tab')
-        # self.self_ddas_to_hide_report_writer.writerow(('Platform','Title', 'BibId', '856'))
-        self.self_ddas_counter = 0
 
+        # Files are only created once a record goes into them. Clear out those of an earlier run
+        # into this directory, keeping what a checkpoint still counts on.
+        self._clear(checkpoint and checkpoint['offsets'])
+
+        self.writer = marcaroni.writer.Writer()
+        self.no_matches_on_platform = self._partition(self.no_matches_on_platform__file_name,
+                                                      'records_without_matches_counter')
+        self.match_has_worse_license = self._partition(self.match_has_worse_license__file_name,
+                                                       'match_has_worse_license__counter')
+        self.exact_match_records = self._partition(self.exact_match__file_name, 'exact_match__counter')
+        self.exact_match_ids = self._partition(self.exact_match_ids__file_name, 'exact_match__counter', 'text')
+        self.match_has_better_license = self._partition(self.match_has_better_license__file_name,
+                                                        'match_has_better_license__counter')
+        self.ambiguous_records = self._partition(self.ambiguous__file_name, 'ambiguous__counter')
+        self.ambiguous_report = self._partition(self.ambiguous_report__file_name, 'ambiguous__counter', 'csv',
+                                                header=('Title', 'ISBN', 'Reason'))
+        self.ddas_to_hide_report = self._partition(self.ddas_to_hide_report_file_name, 'old_ddas_counter', 'csv',
+                                                   dialect='excel-tab')
+        # header would be ('Platform', 'Title', 'BibId')
+        self.self_ddas_to_hide_report = self._partition(self.self_ddas_to_hide_report_file_name, 'self_ddas_counter',
+                                                        'csv', dialect='excel-tab')
+        # header would be ('Platform','Title', 'BibId', '856')
 
     def __del__(self):
-        self.no_matches_on_platform__file_pointer.close()
-        self.match_has_worse_license__file_pointer.close()
-        self.exact_match__file_pointer.close()
-        self.exact_match_ids__file_pointer.close()
-        self.match_has_better_license__file_pointer.close()
-        self.ambiguous__file_pointer.close()
-        self.ambiguous_report__file_pointer.close()
-
-        # Deprecated - I hope.
-        self.ddas_to_hide_report_fp.close()
-        self.self_ddas_to_hide_report_fp.close()
-
-        # Delete files that weren't used.
-        if self.records_without_matches_counter == 0:
-            os.remove(self.no_matches_on_platform__file_name)
-        if self.match_has_worse_license__counter == 0:
-            os.remove(self.match_has_worse_license__file_name)
-        if self.exact_match__counter == 0:
-            os.remove(self.exact_match__file_name)
-        if self.match_has_better_license__counter == 0:
-            os.remove(self.match_has_better_license__file_name)
-        if self.ambiguous__counter == 0:
-            os.remove(self.ambiguous__file_name)
-            os.remove(self.ambiguous_report__file_name)
-        if self.old_ddas_counter == 0:
-            os.remove(self.ddas_to_hide_report_file_name)
-        if self.self_ddas_counter == 0:
-            os.remove(self.self_ddas_to_hide_report_file_name)
+        self.close()
+
+    def close(self):
+        """
+        Write out the records still buffered and close the output files and the log.
+        Can be called more than once.
+        """
+        writer = getattr(self, 'writer', None)
+        if writer is not None:
+            # Waits for the writer's thread to write out the rest.
+            with marcaroni.metrics.stage('write', 0):
+                writer.close()
+        for handler in getattr(self, 'log_handlers', []):
+            self.log.removeHandler(handler)
+            handler.close()
+        self.log_handlers = []
 
+    def _file_names(self):
+        """
+        :return: dict of counter, by file name.
+        """
+        return {
+            self.no_matches_on_platform__file_name: 'records_without_matches_counter',
+            self.match_has_worse_license__file_name: 'match_has_worse_license__counter',
+            self.exact_match__file_name: 'exact_match__counter',
+            self.exact_match_ids__file_name: 'exact_match__counter',
+            self.match_has_better_license__file_name: 'match_has_better_license__counter',
+            self.ambiguous__file_name: 'ambiguous__counter',
+            self.ambiguous_report__file_name: 'ambiguous__counter',
+            self.ddas_to_hide_report_file_name: 'old_ddas_counter',
+            self.self_ddas_to_hide_report_file_name: 'self_ddas_counter',
+        }
+
+    def _clear(self, offsets):
+        """
+        Remove the output files of an earlier run, or cut them back to their size at the
+        checkpoint if they had records then.
+        """
+        for file_name, counter in self._file_names().items():
+            if offsets is not None and getattr(self, counter):
+                offset = offsets.get(os.path.basename(file_name))
+                if offset is None:
+                    raise CheckpointError("%s was not written by the checkpointed run. Resume with the same "
+                                          "--compress." % (file_name,))
+                if not os.path.exists(file_name) or os.path.getsize(file_name) < offset:
+                    raise CheckpointError("%s is shorter than at the checkpoint." % (file_name,))
+                os.truncate(file_name, offset)
+            elif os.path.exists(file_name):
+                os.remove(file_name)
+
+    def _partition(self, file_name, counter, kind='binary', header=None, dialect='excel'):
+        # Files that had records at the checkpoint are appended to, once cut back.
+        return self.writer.partition(file_name, kind, header, append=bool(getattr(self, counter)), dialect=dialect,
+                                     compression=self.compression if kind == 'binary' else None)
+
+    def checkpoint_state(self):
+        """
+        Write out the output files, and describe them for a checkpoint.
+
+        :return: dict
+        """
+        with marcaroni.metrics.stage('write', 0):
+            self.writer.flush()
+        offsets = {}
+        for partition in self.writer.partitions:
+            offsets[os.path.basename(partition.file_name)] = partition.size()
+        return {
+            'counters': dict((counter, getattr(self, counter)) for counter in self.COUNTERS),
+            'matches_by_bibsource': self.matches_by_bibsource,
+            'offsets': offsets,
+        }
+
+    # The write_* methods take a record as bytes (replayed from a worker), or the record
+    # itself, which is serialized as it is written.
     def no_match(self, marc_rec):
-        self.no_matches_on_platform__file_pointer.write(marc_rec.as_marc())
-        self.records_without_matches_counter += 1
+        self.write_no_match(marc_rec)
+
+    def write_no_match(self, data):
+        with marcaroni.metrics.stage('write'):
+            self.writer.write(self.no_matches_on_platform, data)
+            self.records_without_matches_counter += 1
 
     def match_is_worse(self, marc_rec, bib_id):
-        marc_rec.marc.add_field(Field(
-            tag='901',
-            indicators=[' ', ' '],
-            subfields=['c', bib_id]
-        ))
-        self.match_has_worse_license__file_pointer.write(marc_rec.as_marc())
-        self.match_has_worse_license__counter += 1
+        add_bib_id(marc_rec, bib_id)
+        self.write_match_is_worse(marc_rec)
+
+    def write_match_is_worse(self, data):
+        with marcaroni.metrics.stage('write'):
+            self.writer.write(self.match_has_worse_license, data)
+            self.match_has_worse_license__counter += 1
 
     def exact_match(self, marc_rec, bib_id):
-        marc_rec.marc.add_field(Field(
-            tag='901',
-            indicators=[' ', ' '],
-            subfields=['c', bib_id]
-        ))
-        self.exact_match__file_pointer.write(marc_rec.as_marc())
-        self.exact_match_ids__file_pointer.write('{}\n'.format(bib_id))
-        self.exact_match__counter += 1
+        add_bib_id(marc_rec, bib_id)
+        self.write_exact_match(marc_rec, bib_id)
+
+    def write_exact_match(self, data, bib_id):
+        with marcaroni.metrics.stage('write'):
+            self.writer.write(self.exact_match_records, data)
+            self.writer.write(self.exact_match_ids, '{}\n'.format(bib_id))
+            self.exact_match__counter += 1
 
     def match_is_better(self, marc_rec):
-        self.match_has_better_license__file_pointer.write(marc_rec.as_marc())
-        self.match_has_better_license__counter += 1
+        self.write_match_is_better(marc_rec)
+
+    def write_match_is_better(self, data):
+        with marcaroni.metrics.stage('write'):
+            self.writer.write(self.match_has_better_license, data)
+            self.match_has_better_license__counter += 1
 
     def ambiguous(self, record, reason):
-        self.ambiguous__file_pointer.write(record.as_marc())
-        self.ambiguous_report__csv_writer.writerow((record.title, record.isbn, reason))
-        self.ambiguous__counter += 1
+        self.write_ambiguous(record, record.title, record.isbn, reason)
+
+    def write_ambiguous(self, data, title, isbn, reason):
+        with marcaroni.metrics.stage('write'):
+            self.writer.write(self.ambiguous_records, data)
+            self.writer.write(self.ambiguous_report, (title, isbn, reason))
+            self.ambiguous__counter += 1
 
     def report_of_ddas_to_hide(self, platform, title, bib_id):
-        self.ddas_to_hide_report_writer.writerow((platform, title, bib_id))
-        self.old_ddas_counter += 1
+        with marcaroni.metrics.stage('write'):
+            self.writer.write(self.ddas_to_hide_report, (platform, title, bib_id))
+            self.old_ddas_counter += 1
 
     def report_of_self_ddas_to_hide(self, platform, title, isbn):
-        self.self_ddas_to_hide_report_writer.writerow((platform, title, '', isbn))
-        self.self_ddas_counter += 1
+        with marcaroni.metrics.stage('write'):
+            self.writer.write(self.self_ddas_to_hide_report, (platform, title, '', isbn))
+            self.self_ddas_counter += 1
 
     def count_matches_by_bibsource(self, matches):
         for match in matches:
@@ -142,24 +253,77 @@ class OutputRecordHandler:
             self.matches_by_bibsource[match.source] += 1
 
     def print_report(self, bibsources, total_record_count):
-        logging.info("Record count: " + str(total_record_count))
-        logging.info("# not found on this platform:          %d" % (self.records_without_matches_counter,))
-        logging.info("# found same platform, worse license:  %d" % (self.match_has_worse_license__counter,))
-        logging.info("# found same platform, same license:   %d" % (self.exact_match__counter,))
-        logging.info("# found same platform, better license: %d" % (self.match_has_better_license__counter,))
-        logging.info("# ambiguous:                           %d" % (self.ambiguous__counter,))
+        self.log.info("Record count: " + str(total_record_count))
+        self.log.info("# not found on this platform:          %d" % (self.records_without_matches_counter,))
+        self.log.info("# found same platform, worse license:  %d" % (self.match_has_worse_license__counter,))
+        self.log.info("# found same platform, same license:   %d" % (self.exact_match__counter,))
+        self.log.info("# found same platform, better license: %d" % (self.match_has_better_license__counter,))
+        self.log.info("# ambiguous:                           %d" % (self.ambiguous__counter,))
         if (self.old_ddas_counter > 0):
-            logging.info("DDAs that need to be deleted: \t%d" % (self.old_ddas_counter))
+            self.log.info("DDAs that need to be deleted: \t%d" % (self.old_ddas_counter))
 
         if (self.self_ddas_counter > 0):
-            logging.info("DDAs from this batch that need to be deactivated: %d" % (self.self_ddas_counter))
+            self.log.info("DDAs from this batch that need to be deactivated: %d" % (self.self_ddas_counter))
 
-        logging.info("\nMatches By Bibsource:")
-        logging.info("\tsource\tname\tcount(records)")
+        self.log.info("\nMatches By Bibsource:")
+        self.log.info("\tsource\tname\tcount(records)")
         for source in sorted(self.matches_by_bibsource.keys(), reverse=True,
                              key=lambda x: self.matches_by_bibsource[x]):
-            logging.info("\t%s\t%s: \t%d" % (source, bibsources.get_bib_source_by_id(source).name,
-                                             self.matches_by_bibsource[source]))
+            self.log.info("\t%s\t%s: \t%d" % (source, bibsources.get_bib_source_by_id(source).name,
+                                                  self.matches_by_bibsource[source]))
 
     def logger(self, message):
-        logging.info(message)
\ No newline at end of file
+        self.log.info(message)
+
+
+class OutputRecorder(OutputRecordHandler):
+    """
+    Takes the calls of an OutputRecordHandler in a worker process, with the records
+    rendered to MARC, so the parent can replay() them into the real handler in
+    input order.
+    """
+    # noinspection PyMissingConstructor
+    def __init__(self):
+        self.calls = []
+
+    def __del__(self):
+        pass
+
+    def _record(self, method, *args):
+        self.calls.append((method, args))
+
+    def write_no_match(self, data):
+        self._record('write_no_match', as_marc(data))
+
+    def write_match_is_worse(self, data):
+        self._record('write_match_is_worse', as_marc(data))
+
+    def write_exact_match(self, data, bib_id):
+        self._record('write_exact_match', as_marc(data), bib_id)
+
+    def write_match_is_better(self, data):
+        self._record('write_match_is_better', as_marc(data))
+
+    def write_ambiguous(self, data, title, isbn, reason):
+        self._record('write_ambiguous', as_marc(data), title, isbn, reason)
+
+    def report_of_ddas_to_hide(self, platform, title, bib_id):
+        self._record('report_of_ddas_to_hide', platform, title, bib_id)
+
+    def report_of_self_ddas_to_hide(self, platform, title, isbn):
+        self._record('report_of_self_ddas_to_hide', platform, title, isbn)
+
+    def count_matches_by_bibsource(self, matches):
+        self._record('count_matches_by_bibsource', matches)
+
+    def logger(self, message):
+        self._record('logger', message)
+
+    @staticmethod
+    def replay(calls, output_handler):
+        """
+        :type calls: list
+        :type output_handler: OutputRecordHandler
+        """
+        for method, args in calls:
+            getattr(output_handler, method)(*args)
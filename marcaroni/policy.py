@@ -0,0 +1,172 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+The match policy of bibmatcher.py, and the decision table its rules compile into.
+
+The predicates of a match only depend on the bib source of the input and the bib source
+of the match, so they are worked out once per source. Each distinct predicate vector gets
+a small number, and the matches of a record fold into one integer key holding, for each
+vector, whether it occurs never, once or more than once. The rules are run once per key
+against stand-in matches, and the rule that applied is remembered, so later records
+with the same key are decided by one dict lookup.
+"""
+
+import configparser
+import os
+import re
+
+from marcaroni.ils import Record
+
+DEFAULT_POLICY_FILE = os.path.join(os.path.dirname(__file__), '..', 'conf', 'match_policy.ini')
+
+
+class PolicyError(Exception):
+    pass
+
+
+def _split_list(value):
+    return [item.strip() for item in re.split(r'[,\n]', value) if item.strip()]
+
+
+class MatchPolicy:
+    def __init__(self):
+        self.default_match_field = '020'
+        self.match_field_by_bib_source = {}  # dict[str] = str
+        self.odd_bib_sources = set()  # set of str
+        self.excluded_publishers = {}  # dict[str] = list[str], by bib source id
+        self.rule_names = []  # list[str]
+        # Match records that no identifier matched by title, main entry and date
+        # (bibmatcher.py --fallback), keeping matches scoring at least the threshold.
+        self.fallback = False
+        self.fallback_threshold = 0.9
+
+    def load_from_file(self, filename=DEFAULT_POLICY_FILE):
+        config = configparser.ConfigParser()
+        # Keys are bib source ids and tags, keep them as they are.
+        config.optionxform = str
+        if not config.read(filename):
+            raise PolicyError("Match policy file [%s] not found." % (filename,))
+        if config.has_section('match_fields'):
+            for tag, bib_source_ids in config['match_fields'].items():
+                if tag == 'default':
+                    self.default_match_field = bib_source_ids.strip()
+                    continue
+                for bib_source_id in _split_list(bib_source_ids):
+                    self.match_field_by_bib_source[bib_source_id] = tag
+        if config.has_section('sources'):
+            self.odd_bib_sources = set(_split_list(config['sources'].get('odd', '')))
+        if config.has_section('publishers'):
+            for bib_source_id, publishers in config['publishers'].items():
+                self.excluded_publishers[bib_source_id] = _split_list(publishers)
+        if config.has_section('rules'):
+            self.rule_names = _split_list(config['rules'].get('order', ''))
+        if config.has_section('fallback'):
+            try:
+                self.fallback_threshold = config['fallback'].getfloat('threshold', self.fallback_threshold)
+            except ValueError:
+                raise PolicyError("Fallback threshold in match policy must be a number.")
+            if not 0 < self.fallback_threshold <= 1:
+                raise PolicyError("Fallback threshold in match policy must be above 0 and at most 1.")
+
+    def match_field(self, bib_source_id):
+        """
+        :type bib_source_id: str
+        :return: str, the tag the records of this bib source are matched on.
+        """
+        return self.match_field_by_bib_source.get(bib_source_id, self.default_match_field)
+
+    def rules(self, rules_by_name):
+        """
+        :param rules_by_name: dict of rule functions.
+        :return: list of the rule functions, in policy order.
+        """
+        for name in self.rule_names:
+            if name not in rules_by_name:
+                raise PolicyError("Unknown rule [%s] in match policy." % (name,))
+        return [rules_by_name[name] for name in self.rule_names]
+
+
+class _NoOutput:
+    """
+    Takes the output of rules run against stand-in matches, and drops it.
+    """
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+class DecisionTable:
+    """
+    Which rule applies to a record, looked up by the predicates of its matches.
+
+    Rules may only look at the predicate vectors, the number of matches with a given
+    vector (none, one or many), the sources of the matches and the input bib source.
+    """
+    def __init__(self, rules, bib_source_of_input, compute_predicates):
+        """
+        :param rules: list of rule functions, as in bibmatcher.py.
+        :type bib_source_of_input: BibSource
+        :param compute_predicates: function of a match source id, giving its PredicateVector.
+        """
+        self.rules = rules
+        self.bib_source_of_input = bib_source_of_input
+        self.compute_predicates = compute_predicates
+        self.vectors = {}  # dict[str] = PredicateVector, by match source
+        self.codes = {}  # dict[str] = int, by match source
+        self.vector_codes = {}  # dict[PredicateVector] = int
+        self.representatives = []  # per code: (PredicateVector, source id)
+        self.decisions = {}  # dict[int] = rule function or None
+
+    def _add_source(self, source):
+        vector = self.compute_predicates(source)
+        if vector not in self.vector_codes:
+            self.vector_codes[vector] = len(self.representatives)
+            self.representatives.append((vector, source))
+        self.vectors[source] = vector
+        self.codes[source] = self.vector_codes[vector]
+
+    def vector(self, source):
+        """
+        :rtype: PredicateVector
+        """
+        if source not in self.vectors:
+            self._add_source(source)
+        return self.vectors[source]
+
+    def key(self, matches):
+        """
+        :type matches: set of Record
+        :rtype: int
+        """
+        key = 0
+        codes = self.codes
+        for match in matches:
+            if match.source not in codes:
+                self._add_source(match.source)
+            seen_once = 1 << (codes[match.source] * 2)
+            key |= ((key & seen_once) << 1) | seen_once
+        return key
+
+    def _compile(self, key):
+        stand_ins = {}
+        for code, (vector, source) in enumerate(self.representatives):
+            count = (key >> (code * 2)) & 3
+            for i in range(2 if count == 3 else count):
+                stand_ins[Record('%d-%d' % (code, i), source)] = vector
+        for rule in self.rules:
+            if rule(None, self.bib_source_of_input, stand_ins, _NoOutput()):
+                return rule
+        return None
+
+    def rule(self, matches):
+        """
+        :type matches: set of Record
+        :return: the rule function that applies to these matches, or None.
+        """
+        key = self.key(matches)
+        if key not in self.decisions:
+            self.decisions[key] = self._compile(key)
+        return self.decisions[key]
@@ -0,0 +1,329 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+MARC records kept as the bytes they came in.
+
+bibmatcher.py only ever changes the leader's character coding position and appends a
+901, so a record is written out as its original bytes with those changes patched in,
+instead of being re-serialized by pymarc. Fields are decoded only when asked for.
+"""
+
+import io
+import logging
+import mmap
+import warnings
+
+import pymarc
+from pymarc import Field
+from pymarc.exceptions import BadSubfieldCodeWarning, BaseAddressInvalid, BaseAddressNotFound, NoFieldsFound, \
+    PymarcException, RecordDirectoryInvalid, RecordLeaderInvalid
+from pymarc.marc8 import marc8_to_unicode
+from pymarc.record import normalize_subfield_code
+
+END_OF_FIELD = b'\x1e'
+END_OF_RECORD = b'\x1d'
+SUBFIELD_INDICATOR = b'\x1f'
+LEADER_LENGTH = 24
+DIRECTORY_ENTRY_LENGTH = 12
+# The most the leader and a directory entry can hold.
+MAX_RECORD_LENGTH = 99999
+MAX_FIELD_LENGTH = 9999
+
+# Bytes read at a time from files that can't be mapped.
+READ_SIZE = 1 << 20
+
+
+class RecordTooLong(PymarcException):
+    """
+    A field added to a record would not fit the lengths of its leader or directory.
+    """
+    pass
+
+
+def split_records(buf, start=0):
+    """
+    Split MARC transmission data into records, by the length in each leader. A record
+    whose length is unreadable or does not end on an end-of-record mark is cut at the
+    next end-of-record mark instead.
+
+    :param buf: bytes, or another buffer such as an mmap.
+    :param start: int, offset of the first record in buf.
+    :return: iterator of bytes, copied out of buf, so they outlive it.
+    """
+    position = start
+    size = len(buf)
+    while position < size:
+        end = None
+        length = buf[position:position + 5]
+        if length.isdigit():
+            end = position + int(length)
+            if end > size or end - position <= LEADER_LENGTH or buf[end - 1:end] != END_OF_RECORD:
+                end = None
+        if end is None:
+            end = buf.find(END_OF_RECORD, position) + 1
+            if end == 0:
+                if not buf[position:].strip():
+                    # Trailing newlines or padding after the last record.
+                    return
+                end = size
+        yield bytes(buf[position:end])
+        position = end
+
+
+def split_stream(handler, start=0):
+    """
+    split_records() for a file that can only be read through, such as a compressed one,
+    reading it a block at a time.
+
+    :param handler: file opened in binary mode.
+    :param start: int, offset of the first record in the file.
+    :return: iterator of bytes
+    """
+    if handler.seekable():
+        handler.seek(start)
+    else:
+        while start > 0:
+            skipped = len(handler.read(min(start, READ_SIZE)))
+            if skipped == 0:
+                return
+            start -= skipped
+    buf = b''
+    position = 0
+    eof = False
+
+    def more():
+        # Keep only the rest of buf, and add the next block to it.
+        nonlocal buf, position, eof
+        block = handler.read(READ_SIZE)
+        if not block:
+            eof = True
+        buf = buf[position:] + block
+        position = 0
+
+    while True:
+        while len(buf) - position < 5 and not eof:
+            more()
+        if position >= len(buf):
+            return
+        end = None
+        length = buf[position:position + 5]
+        if length.isdigit():
+            while len(buf) - position < int(length) and not eof:
+                more()
+            end = position + int(length)
+            if end > len(buf) or end - position <= LEADER_LENGTH or buf[end - 1:end] != END_OF_RECORD:
+                end = None
+        if end is None:
+            searched = position
+            while True:
+                end = buf.find(END_OF_RECORD, searched) + 1
+                if end != 0 or eof:
+                    break
+                # more() moves the rest of buf to the start.
+                searched = len(buf) - position
+                more()
+            if end == 0:
+                if not buf[position:].strip():
+                    # Trailing newlines or padding after the last record.
+                    return
+                end = len(buf)
+        yield buf[position:end]
+        position = end
+
+
+def read_raw_records(handler, start=0):
+    """
+    :param handler: file opened in binary mode, compressed files included (see compress.open_input()).
+    :param start: int, offset of the first record to read, e.g. from a checkpoint. The
+                  offset is in the uncompressed data.
+    :return: iterator of bytes
+    """
+    # A compressed file (e.g. gzip.open()) has the fileno() of the compressed data, so only
+    # files opened with open() are mapped.
+    if isinstance(getattr(handler, 'raw', handler), io.FileIO):
+        try:
+            buf = mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # An empty file, or one that can't be mapped, e.g. a pipe.
+            buf = None
+        if buf is not None:
+            # Unmapped once read through, or when the iterator is closed or dropped.
+            with buf:
+                yield from split_records(buf, start)
+            return
+    yield from split_stream(handler, start)
+
+
+def append_field(data, tag, field_data):
+    """
+    Add a field at the end of a record, by extending the directory and the data, without
+    touching the other fields.
+
+    :type data: bytes
+    :type tag: str
+    :param field_data: bytes, the field as written by pymarc's Field.as_marc().
+    :rtype: bytes
+    :raises RecordTooLong: if the field or the record would be too long for MARC.
+    """
+    length = len(data) + DIRECTORY_ENTRY_LENGTH + len(field_data)
+    if len(field_data) > MAX_FIELD_LENGTH:
+        raise RecordTooLong("A %s field of %d bytes is longer than MARC allows (%d)." %
+                            (tag, len(field_data), MAX_FIELD_LENGTH))
+    if length > MAX_RECORD_LENGTH:
+        raise RecordTooLong("Adding a %s field would make the record %d bytes, longer than MARC allows (%d)." %
+                            (tag, length, MAX_RECORD_LENGTH))
+    base_address = int(data[12:17])
+    fields = data[base_address:-1]
+    entry = b'%s%04d%05d' % (tag.encode('ascii'), len(field_data), len(fields))
+    leader = b'%05d%s%05d%s' % (length, data[5:12],
+                                base_address + DIRECTORY_ENTRY_LENGTH, data[17:LEADER_LENGTH])
+    return leader + data[LEADER_LENGTH:base_address - 1] + entry + END_OF_FIELD + fields + field_data + END_OF_RECORD
+
+
+class RawRecord:
+    """
+    Stands in for a pymarc Record, without decoding the whole record up front.
+
+    The directory is read once into a map of tag to field positions, and a field is only
+    decoded the first time it is asked for. bibmatcher.py needs a handful of tags from
+    records of 40-80 fields, so most fields are never decoded. The leader and added
+    fields are patched into the original bytes, which as_marc() returns. Anything else
+    is answered by a full pymarc Record, built on first use.
+    """
+    def __init__(self, data, force_utf8=True):
+        self.data = data
+        self.force_utf8 = force_utf8
+        self._leader = data[0:LEADER_LENGTH].decode('ascii')
+        if len(self._leader) != LEADER_LENGTH:
+            raise RecordLeaderInvalid
+        self._record = None
+        self._entries = []  # per field: (tag, start, end) of its data, without the end of field
+        self._fields = []  # per field: the decoded Field, or None until asked for
+        self._positions = {}  # dict[str] = list[int], indexes into _entries by tag
+        self._read_directory()
+
+    def _read_directory(self):
+        data = self.data
+        base_address = int(data[12:17])
+        if base_address <= 0:
+            raise BaseAddressNotFound
+        if base_address >= len(data):
+            raise BaseAddressInvalid
+        directory = data[LEADER_LENGTH:base_address - 1]
+        if len(directory) % DIRECTORY_ENTRY_LENGTH != 0:
+            raise RecordDirectoryInvalid
+        for entry_start in range(0, len(directory), DIRECTORY_ENTRY_LENGTH):
+            entry = directory[entry_start:entry_start + DIRECTORY_ENTRY_LENGTH]
+            tag = entry[0:3].decode('ascii')
+            start = base_address + int(entry[7:12])
+            self._add_entry(tag, (tag, start, start + int(entry[3:7]) - 1), None)
+        if not self._entries:
+            raise NoFieldsFound
+
+    def _add_entry(self, tag, entry, field):
+        self._positions.setdefault(tag, []).append(len(self._entries))
+        self._entries.append(entry)
+        self._fields.append(field)
+
+    def _encoding(self):
+        if self._leader[9] == 'a' or self.force_utf8:
+            return 'utf-8'
+        return 'iso8859-1'
+
+    def _decode_value(self, value):
+        encoding = self._encoding()
+        if encoding == 'iso8859-1':
+            return marc8_to_unicode(value)
+        return value.decode(encoding)
+
+    def _decode(self, position):
+        """
+        Decode one field the way pymarc's Record.decode_marc() does.
+        """
+        field = self._fields[position]
+        if field is not None:
+            return field
+        tag, start, end = self._entries[position]
+        entry_data = self.data[start:end]
+        if tag < '010' and tag.isdigit():
+            field = Field(tag=tag, data=entry_data.decode(self._encoding()))
+        else:
+            subs = entry_data.split(SUBFIELD_INDICATOR)
+            indicators = subs[0].decode('ascii')
+            if len(indicators) != 2:
+                logging.warning("unexpected indicators: %s", entry_data)
+            indicators = (indicators + '  ')[:2]
+            subfields = []
+            for subfield in subs[1:]:
+                if len(subfield) == 0:
+                    continue
+                skip_bytes = 1
+                try:
+                    code = subfield[0:1].decode('ascii')
+                except UnicodeDecodeError:
+                    warnings.warn(BadSubfieldCodeWarning())
+                    code, skip_bytes = normalize_subfield_code(subfield)
+                subfields.append(code)
+                subfields.append(self._decode_value(subfield[skip_bytes:]))
+            field = Field(tag=tag, indicators=[indicators[0], indicators[1]], subfields=subfields)
+        self._fields[position] = field
+        return field
+
+    @property
+    def record(self):
+        """
+        The whole record, as pymarc would have read it.
+
+        :rtype: pymarc.Record
+        """
+        if self._record is None:
+            self._record = pymarc.Record(leader=self._leader, force_utf8=self.force_utf8)
+            self._record.add_field(*[self._decode(position) for position in range(len(self._entries))])
+        return self._record
+
+    @property
+    def leader(self):
+        return self._leader
+
+    @leader.setter
+    def leader(self, leader):
+        # Length and base address are the record's own, as pymarc would write them.
+        self._leader = leader
+        if self._record is not None:
+            self._record.leader = leader
+        self.data = self.data[:5] + leader[5:12].encode('ascii') + self.data[12:17] + \
+            leader[17:LEADER_LENGTH].encode('ascii') + self.data[LEADER_LENGTH:]
+
+    def add_field(self, *fields):
+        for field in fields:
+            self.data = append_field(self.data, field.tag, field.as_marc(encoding=self._encoding()))
+            self._add_entry(field.tag, (field.tag, None, None), field)
+        if self._record is not None:
+            self._record.add_field(*fields)
+
+    def as_marc(self):
+        return self.data
+
+    def get_fields(self, *tags):
+        if len(tags) == 0:
+            return self.record.get_fields()
+        if len(tags) == 1:
+            positions = self._positions.get(tags[0], [])
+        else:
+            positions = sorted(p for tag in tags for p in self._positions.get(tag, []))
+        return [self._decode(position) for position in positions]
+
+    def __getitem__(self, tag):
+        positions = self._positions.get(tag)
+        if not positions:
+            return None
+        return self._decode(positions[0])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.record, name)
@@ -0,0 +1,266 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+A resident match service, so bibmatcher.py does not reload the bib data on every run.
+
+The server keeps the loaded bib data in memory and answers over a Unix socket, one JSON
+document per line:
+
+    request:  {"match_field": "020", "identifiers": [["9780306406157", ...], ...]}
+    response: {"matches": [[["123", "58"], ...], ...]}
+
+    request:  {"status": true}
+    response: {"bib_data": "/path/to/bib-data.snap", "modified": 1700000000.0, "match_fields": ["020"]}
+
+Each request carries a batch of identifier sets, and gets one list of [id, source] pairs
+back per set. When update-data.py publishes a new file under the same name, the server
+loads it next to the old one and swaps it in. Requests already running finish on the
+data they started with.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import marcaroni.ils
+import marcaroni.snapshot
+
+# How often the server looks for a newly published bib data file, in seconds.
+POLL_INTERVAL = 30
+
+# Generous, but keeps a confused client from eating the server's memory. A longer
+# request gets an error, and the connection is closed.
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+
+class ServerError(Exception):
+    pass
+
+
+def _file_identity(filename):
+    # update-data.py replaces the file with os.replace(), which gives it a new inode.
+    stat = os.stat(filename)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def load_resident_bib_data(bib_data_file_name, match_field):
+    """
+    Snapshots are mapped. CSV files are held in compact arrays, as the server keeps
+    them for a long time.
+
+    :rtype: marcaroni.snapshot.SnapshotBibData | marcaroni.ils.CompactILSBibData
+    """
+    if marcaroni.snapshot.is_snapshot(bib_data_file_name):
+        eg_records = marcaroni.snapshot.SnapshotBibData()
+    else:
+        eg_records = marcaroni.ils.CompactILSBibData()
+    try:
+        eg_records.load_from_file(bib_data_file_name, match_field)
+    except SystemExit:
+        # The loaders exit on a bad file, as bibmatcher.py would, having said why on stderr.
+        # The server must keep running on the data it has.
+        raise ServerError("Could not load %s from [%s]." % (match_field, bib_data_file_name))
+    return eg_records
+
+
+class _Generation:
+    """
+    The bib data of one version of the file, loaded lazily per match field.
+    """
+    def __init__(self, bib_data_file_name):
+        self.bib_data_file_name = bib_data_file_name
+        self.identity = _file_identity(bib_data_file_name)
+        self.modified = os.path.getmtime(bib_data_file_name)
+        self.by_match_field = {}
+        self.lock = threading.Lock()
+
+    def bib_data(self, match_field):
+        eg_records = self.by_match_field.get(match_field)
+        if eg_records is None:
+            with self.lock:
+                eg_records = self.by_match_field.get(match_field)
+                if eg_records is None:
+                    eg_records = load_resident_bib_data(self.bib_data_file_name, match_field)
+                    self.by_match_field[match_field] = eg_records
+        return eg_records
+
+
+class MatchService:
+    """
+    Holds the current generation of bib data and replaces it when the file changes.
+    """
+    def __init__(self, bib_data_file_name):
+        # Generations come and go; loads only pause the garbage collector.
+        marcaroni.ils.FREEZE_AFTER_LOAD = False
+        self.bib_data_file_name = bib_data_file_name
+        self.generation = _Generation(bib_data_file_name)
+        self._stopped = threading.Event()
+
+    def match(self, match_field, identifier_sets):
+        """
+        :type match_field: str
+        :type identifier_sets: list[list[str]]
+        :return: list of sets of Record, one per identifier set.
+        """
+        # Take the reference once; a swap in the meantime does not affect this request.
+        eg_records = self.generation.bib_data(match_field)
+        return eg_records.match_many(identifier_sets)
+
+    def status(self):
+        generation = self.generation
+        return {
+            'bib_data': os.path.abspath(generation.bib_data_file_name),
+            'modified': generation.modified,
+            'match_fields': sorted(generation.by_match_field),
+        }
+
+    def refresh(self):
+        """
+        Load the file again if it was replaced, with the match fields already in use,
+        and swap it in.
+
+        :return: bool, True if a new generation was swapped in.
+        """
+        try:
+            identity = _file_identity(self.bib_data_file_name)
+        except OSError:
+            return False
+        if identity == self.generation.identity:
+            return False
+        generation = _Generation(self.bib_data_file_name)
+        for match_field in list(self.generation.by_match_field):
+            generation.bib_data(match_field)
+        self.generation = generation
+        return True
+
+    def watch(self, interval=POLL_INTERVAL):
+        while not self._stopped.wait(interval):
+            try:
+                if self.refresh():
+                    print("Swapped in bib data modified %s." % (self.generation.modified,))
+            except Exception as e:
+                # Keep serving the old data; update-data.py may still be writing.
+                print("Could not load new bib data: %s" % (e,))
+
+    def stop(self):
+        self._stopped.set()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        service = self.server.service
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_SIZE + 1)
+            if not line:
+                return
+            if len(line) > MAX_REQUEST_SIZE and not line.endswith(b'\n'):
+                # The rest of the request can't be told from the next one.
+                self._reply({'error': "Request longer than %d bytes." % (MAX_REQUEST_SIZE,)})
+                return
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if request.get('status'):
+                    response = service.status()
+                else:
+                    matches = service.match(request['match_field'], request['identifiers'])
+                    response = {'matches': [sorted(records) for records in matches]}
+            except Exception as e:
+                response = {'error': str(e)}
+            self._reply(response)
+
+    def _reply(self, response):
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class MatchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                # Left behind by a server that is gone.
+                os.unlink(socket_path)
+            else:
+                raise ServerError("A match server is already listening on [%s]." % (socket_path,))
+            finally:
+                probe.close()
+        self.service = service
+        socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+
+    def serve(self, match_fields=(), poll_interval=POLL_INTERVAL):
+        """
+        Preload match_fields, then serve until interrupted.
+        """
+        try:
+            for match_field in match_fields:
+                self.service.generation.bib_data(match_field)
+            watcher = threading.Thread(target=self.service.watch, args=(poll_interval,), daemon=True)
+            watcher.start()
+            self.serve_forever()
+        finally:
+            self.service.stop()
+            self.server_close()
+            os.unlink(self.server_address)
+
+
+class RemoteBibData:
+    """
+    Stands in for ILSBibData, with the matching done by a running MatchServer.
+    """
+    def __init__(self, socket_path, match_field):
+        self.socket_path = socket_path
+        self.match_field = match_field
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(socket_path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile('rb')
+
+    def _request(self, request):
+        try:
+            self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        except OSError:
+            # The server may have hung up on a request too long, with an error to read.
+            pass
+        # Responses are as long as the matches of a batch make them.
+        line = self.rfile.readline()
+        if not line.endswith(b'\n'):
+            raise ServerError("Match server closed the connection.")
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise ServerError(response['error'])
+        return response
+
+    def status(self):
+        return self._request({'status': True})
+
+    def match_many(self, identifier_sets):
+        """
+        :type identifier_sets: list[set[str]]
+        :return: list of sets of Record
+        """
+        response = self._request({'match_field': self.match_field,
+                                  'identifiers': [sorted(identifiers) for identifiers in identifier_sets]})
+        return [set(marcaroni.ils.Record(*record) for record in records) for records in response['matches']]
+
+    def __contains__(self, item):
+        return len(self.match([item])) > 0
+
+    def match(self, new_identifiers):
+        return self.match_many([new_identifiers])[0]
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
@@ -0,0 +1,947 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Compiled, memory-mapped snapshot of the bib data.
+
+A snapshot is a single file made of named sections. The header is followed by a
+directory of (name, offset, length) entries, and every section starts on an
+8-byte boundary so fixed-width columns can be cast straight out of the mapped
+pages. For each tag, the distinct identifiers are sorted by their UTF-8 bytes:
+
+    <tag>.key_offsets   Q[n_keys + 1]   offsets of each identifier in <tag>.keys
+    <tag>.keys          bytes           the sorted identifiers, back to back
+    <tag>.row_offsets   I[n_keys + 1]   first row of each identifier in the columns below
+    <tag>.ids           I[n_rows]       bib id
+    <tag>.sources       H[n_rows]       index into meta['sources']
+
+The reverse index goes from bib id to everything the snapshot knows about the record.
+Records are sorted by id:
+
+    records.ids         I[n_records]       bib id
+    records.sources     H[n_records]       index into meta['sources']
+    records.offsets     Q[n_records + 1]   offsets of each record in records.identifiers
+    records.identifiers bytes              b'<tag>\x1f<identifier>\x1e' for each identifier
+    records.slots       I[max_id + 1]      position + 1 of each bib id, 0 if absent
+
+records.slots is only written when the ids are dense enough for it to stay small;
+otherwise lookups binary search records.ids.
+
+A snapshot written with titles (update-data.py --titles) also describes records by
+title, main entry and date, for marcaroni.fallback. Described records are sorted by id:
+
+    titles.ids              I[n_titled]       bib id
+    titles.sources          H[n_titled]       index into meta['sources']
+    titles.years            H[n_titled]       year of publication, 0 if unknown
+    titles.title_offsets    Q[n_titled + 1]   offsets of each title key in titles.titles
+    titles.titles           bytes             the title keys, back to back
+    titles.author_offsets   Q[n_titled + 1]   offsets of each author key in titles.authors
+    titles.authors          bytes             the author keys, back to back
+
+and the title words are indexed like the identifiers of a tag, pointing at positions
+in the titles.* columns:
+
+    title_tokens.key_offsets  Q[n_words + 1]
+    title_tokens.keys         bytes
+    title_tokens.row_offsets  I[n_words + 1]
+    title_tokens.rows         I[n_postings]   position in titles.*
+
+The 'meta' section is JSON and holds the tag list, the bib source strings and the
+watermark of the export, which update-data.py --delta uses to refresh the snapshot.
+
+A snapshot named .gz, .bz2 or .xz is written compressed, and read into memory rather
+than mapped.
+"""
+
+import sys
+import os
+import mmap
+import json
+import heapq
+import shutil
+import pickle
+import struct
+import datetime
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+
+from marcaroni import compress
+from marcaroni import fallback
+from marcaroni.ils import Record
+
+# What the reverse index knows about one bib record.
+# identifiers is a list of (tag, identifier) tuples.
+BibRecord = namedtuple('BibRecord', ['id', 'source', 'identifiers'])
+
+MAGIC = b'MRCNSNAP'
+VERSION = 3
+BYTE_ORDER = {'little': 1, 'big': 2}[sys.byteorder]
+
+_HEADER = struct.Struct('<8sIII')  # magic, version, byte order, section count
+_NAME_LEN = 32
+_ENTRY = struct.Struct('<%dsQQ' % (_NAME_LEN,))  # name, offset, length
+_ALIGN = 8
+
+_TAG_SEPARATOR = b'\x1f'
+_IDENTIFIER_TERMINATOR = b'\x1e'
+# records.slots is written when it costs at most this many slots per record.
+_MAX_SLOTS_PER_RECORD = 4
+# Values buffered by each column while writing a snapshot.
+_CHUNK = 65536
+# Rows a SnapshotBuilder sorts in memory before it spills them to disk as a sorted run,
+# and rows read from a run at a time while the runs are merged.
+SORT_RUN_SIZE = 250000
+_RUN_CHUNK = 4096
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def is_snapshot(filename):
+    """
+    Tell a compiled snapshot from a bib-data.txt CSV file.
+
+    :param filename: str
+    :rtype: bool
+    """
+    with compress.open_file(filename, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def _typed(typecode, values):
+    a = array(typecode, values)
+    if a.itemsize != struct.calcsize(typecode):
+        raise SnapshotError("Array type [%s] does not have the expected width on this platform" % (typecode,))
+    return a
+
+
+class _Sections:
+    """
+    The sections of a snapshot being written. Each is spooled to a temporary file until
+    all are done, so the directory, which gives their lengths, can be written ahead of
+    them without holding them in memory.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = []  # list of (str, file)
+        self.columns = []
+
+    def open(self, name):
+        """
+        :return: binary file to write the section to.
+        """
+        fp = tempfile.TemporaryFile(dir=self.directory)
+        self.files.append((name, fp))
+        return fp
+
+    def column(self, name, typecode):
+        """
+        :rtype: _Column
+        """
+        column = _Column(self.open(name), typecode)
+        self.columns.append(column)
+        return column
+
+    def spill(self):
+        """
+        Write out the values buffered by the columns.
+        """
+        for column in self.columns:
+            column.flush()
+
+    def write(self, filename):
+        self.spill()
+        names = [name.encode('utf-8') for name, _ in self.files]
+        for name in names:
+            if len(name) > _NAME_LEN:
+                raise SnapshotError("Section name [%s] is too long." % (name,))
+
+        offset = _HEADER.size + _ENTRY.size * len(self.files)
+        directory = []
+        for (name, fp), encoded_name in zip(self.files, names):
+            offset += -offset % _ALIGN
+            length = fp.seek(0, os.SEEK_END)
+            directory.append(_ENTRY.pack(encoded_name, offset, length))
+            offset += length
+
+        temp_file_name = filename + '.tmp'
+        with compress.open_file(temp_file_name, 'wb', compress.compression_of(filename)) as output:
+            output.write(_HEADER.pack(MAGIC, VERSION, BYTE_ORDER, len(self.files)))
+            output.write(b''.join(directory))
+            for name, fp in self.files:
+                output.write(b'\0' * (-output.tell() % _ALIGN))
+                fp.seek(0)
+                shutil.copyfileobj(fp, output)
+        compress.fsync(temp_file_name)
+        os.replace(temp_file_name, filename)
+
+    def close(self):
+        for _, fp in self.files:
+            fp.close()
+
+
+class _Column:
+    """
+    A fixed-width section, buffered in an array until spilled to its file.
+    """
+    def __init__(self, fp, typecode):
+        self.fp = fp
+        self.values = _typed(typecode, [])
+        self.append = self.values.append
+
+    def skip(self, count):
+        """
+        Write count zeros.
+        """
+        self.flush()
+        self.fp.write(bytes(count * self.values.itemsize))
+
+    def flush(self):
+        self.fp.write(self.values.tobytes())
+        del self.values[:]
+
+
+class _SortedRuns:
+    """
+    Items sorted with a bounded amount of memory: up to SORT_RUN_SIZE of them are
+    sorted in memory, then spilled to a temporary file as a sorted run. The runs are
+    merged as they are read back.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.items = []
+        self.runs = []  # list of file
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, item):
+        """
+        :param item: tuple, of items that can be pickled.
+        """
+        self.items.append(item)
+        self.count += 1
+        if len(self.items) >= SORT_RUN_SIZE:
+            self._spill()
+
+    def _spill(self):
+        self.items.sort()
+        fp = tempfile.TemporaryFile(dir=self.directory)
+        for start in range(0, len(self.items), _RUN_CHUNK):
+            pickle.dump(self.items[start:start + _RUN_CHUNK], fp, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(fp)
+        self.items = []
+
+    def sorted(self):
+        """
+        Read the items back, once.
+
+        :return: iterator of the items, in order.
+        """
+        if not self.runs:
+            self.items.sort()
+            return iter(self.items)
+        if self.items:
+            self._spill()
+        return heapq.merge(*(self._read(fp) for fp in self.runs))
+
+    @staticmethod
+    def _read(fp):
+        fp.seek(0)
+        while True:
+            try:
+                items = pickle.load(fp)
+            except EOFError:
+                return
+            for item in items:
+                yield item
+
+    def close(self):
+        for fp in self.runs:
+            fp.close()
+
+
+def _unique(items):
+    """
+    :param items: sorted iterable
+    :return: list of the items, without repeats.
+    """
+    unique = []
+    for item in items:
+        if not unique or unique[-1] != item:
+            unique.append(item)
+    return unique
+
+
+def _merge_sorted(added, kept, join):
+    """
+    Merge two iterators of tuples, each sorted by the first item and with no first item
+    twice.
+
+    :param join: function of the added and the kept tuples with the same first item,
+                 returning the one tuple to take their place.
+    """
+    added = iter(added)
+    pending = next(added, None)
+    for item in kept:
+        while pending is not None and pending[0] < item[0]:
+            yield pending
+            pending = next(added, None)
+        if pending is not None and pending[0] == item[0]:
+            item = join(pending, item)
+            pending = next(added, None)
+        yield item
+    if pending is not None:
+        yield pending
+        for item in added:
+            yield item
+
+
+def _join_rows(added, kept):
+    return added[0], sorted(set(added[1]).union(kept[1]))
+
+
+def _join_records(added, kept):
+    entries = set(added[2].split(_IDENTIFIER_TERMINATOR)[:-1])
+    entries.update(kept[2].split(_IDENTIFIER_TERMINATOR)[:-1])
+    return added[0], kept[1], b''.join(entry + _IDENTIFIER_TERMINATOR for entry in sorted(entries))
+
+
+def _write_sorted_keys(sections, name, rows_by_key):
+    """
+    Write <name>.key_offsets, <name>.keys and <name>.row_offsets.
+
+    :param rows_by_key: iterator of (bytes, list), in key order.
+    :return: iterator of the lists of rows, for the caller to write to its columns.
+    """
+    key_offsets = sections.column(name + '.key_offsets', 'Q')
+    keys = sections.open(name + '.keys')
+    row_offsets = sections.column(name + '.row_offsets', 'I')
+    key_offset = row_offset = 0
+    key_offsets.append(0)
+    row_offsets.append(0)
+    for position, (key, rows) in enumerate(rows_by_key):
+        keys.write(key)
+        key_offset += len(key)
+        key_offsets.append(key_offset)
+        yield rows
+        row_offset += len(rows)
+        row_offsets.append(row_offset)
+        if position % _CHUNK == 0:
+            sections.spill()
+
+
+class SnapshotBuilder:
+    """
+    Collect exported rows and write them out as a snapshot. The rows are sorted in runs
+    spilled to disk, so the memory used doesn't grow with the catalogue.
+    """
+    def __init__(self, directory=None):
+        """
+        :param directory: str, where to spill the sorted runs, by default the system's
+                          temporary directory.
+        """
+        self.directory = directory
+        self.tags = set()
+        self.rows = _SortedRuns(directory)  # (tag, key, bib id, source code)
+        self.record_rows = _SortedRuns(directory)  # (bib id, records.identifiers entry, source code)
+        # (bib id, order added, source code, title key, author key, year)
+        self.descriptions = _SortedRuns(directory)
+        self.source_codes = {}  # dict[str] = int
+        self.meta = {}
+        self.previous = None  # Snapshot, see merge()
+        self.previous_codes = []  # list of int, the code of each source of the previous snapshot
+        self.exclude_ids = set()
+
+    def _source_code(self, source):
+        if source not in self.source_codes:
+            self.source_codes[source] = len(self.source_codes)
+        return self.source_codes[source]
+
+    def add(self, row):
+        """
+        :param row: (identifier, id, source, tag, subfield), as written to bib-data.txt
+        """
+        identifier, bib_id, source, tag = row[0], int(row[1]), row[2], row[3]
+        key = identifier.encode('utf-8')
+        code = self._source_code(source)
+        self.tags.add(tag)
+        self.rows.add((tag, key, bib_id, code))
+        self.record_rows.add((bib_id, tag.encode('utf-8') + _TAG_SEPARATOR + key + _IDENTIFIER_TERMINATOR, code))
+
+    def add_description(self, row):
+        """
+        :param row: (id, source, title, author, date) of a record, as exported by
+                    marcaroni.export.export_descriptions()
+        """
+        bib_id, source, title, author, date = row
+        description = fallback.describe(title, author, date)
+        self.descriptions.add((int(bib_id), len(self.descriptions), self._source_code(source),
+                               description.title.encode('utf-8'), description.author.encode('utf-8'),
+                               min(description.year, 0xFFFF)))
+
+    def merge(self, snapshot, exclude_ids=()):
+        """
+        Keep the rows of an existing snapshot, leaving out the given bib ids. They are
+        not read until write(), which goes through each section of the snapshot once,
+        in its sorted order, alongside the rows added.
+
+        :type snapshot: Snapshot
+        :param exclude_ids: set of int
+        """
+        if self.previous is not None:
+            raise SnapshotError("Only one snapshot can be merged.")
+        self.previous = snapshot
+        self.previous_codes = [self._source_code(source) for source in snapshot.meta['sources']]
+        self.exclude_ids = set(exclude_ids)
+
+    def _previous_has(self, name):
+        return self.previous is not None and name in self.previous
+
+    def _tag_rows(self, tag, rows):
+        """
+        :param rows: iterator of the rows added for tag, in order.
+        :return: iterator of (bytes, list of (int, int)), the identifiers of tag in key
+                 order, each with its (bib id, source code) rows in order.
+        """
+        added = ((key, _unique((bib_id, code) for _, _, bib_id, code in group))
+                 for key, group in groupby(rows, itemgetter(1)))
+        if not self._previous_has(tag + '.keys'):
+            return added
+        return _merge_sorted(added, self._previous_tag_rows(tag), _join_rows)
+
+    def _previous_tag_rows(self, tag):
+        index = _TagIndex(self.previous, tag)
+        ids, sources, codes, exclude_ids = index.ids, index.sources, self.previous_codes, self.exclude_ids
+        row_offsets = index.row_offsets
+        for position in range(index.key_count):
+            rows = [(ids[row], codes[sources[row]]) for row in range(row_offsets[position], row_offsets[position + 1])
+                    if ids[row] not in exclude_ids]
+            if rows:
+                yield index.key(position), rows
+
+    def _records(self):
+        """
+        :return: iterator of (int, int, bytes), the bib id, source code and
+                 records.identifiers entries of each record, by id.
+        """
+        if self.previous is None:
+            return self._added_records()
+        return _merge_sorted(self._added_records(), self._previous_records(), _join_records)
+
+    def _added_records(self):
+        for bib_id, group in groupby(self.record_rows.sorted(), itemgetter(0)):
+            rows = list(group)
+            yield bib_id, rows[0][2], b''.join(_unique(entry for _, entry, _ in rows))
+
+    def _previous_records(self):
+        records = RecordIndex(self.previous)
+        buf, base, offsets, codes = self.previous._map, records.identifiers_base, records.offsets, records.codes
+        for position, bib_id in enumerate(records.ids):
+            if bib_id not in self.exclude_ids:
+                yield (bib_id, self.previous_codes[codes[position]],
+                       buf[base + offsets[position]:base + offsets[position + 1]])
+
+    def _titles(self):
+        """
+        :return: iterator of (int, int, bytes, bytes, int, int), the bib id, source code,
+                 title key, author key and year of each described record, by id, and its
+                 position in the previous snapshot, or -1 if added. A description added
+                 replaces the one kept for the same record.
+        """
+        if not self._previous_has('titles.ids'):
+            return self._added_titles()
+        return _merge_sorted(self._added_titles(), self._previous_titles(), lambda added, kept: added)
+
+    def _added_titles(self):
+        for bib_id, group in groupby(self.descriptions.sorted(), itemgetter(0)):
+            # The last added for the record.
+            for _, _, code, title, author, year in group:
+                pass
+            yield bib_id, code, title, author, year, -1
+
+    def _previous_titles(self):
+        titles = TitleIndex(self.previous)
+        buf, codes, years = self.previous._map, titles.codes, titles.years
+        title_offsets, titles_base = titles.title_offsets, titles.titles_base
+        author_offsets, authors_base = titles.author_offsets, titles.authors_base
+        for position, bib_id in enumerate(titles.ids):
+            if bib_id not in self.exclude_ids:
+                yield (bib_id, self.previous_codes[codes[position]],
+                       buf[titles_base + title_offsets[position]:titles_base + title_offsets[position + 1]],
+                       buf[authors_base + author_offsets[position]:authors_base + author_offsets[position + 1]],
+                       years[position], position)
+
+    def _previous_postings(self, dropped, shift_starts, shifts):
+        """
+        The title words of the previous snapshot, with the positions of the titles kept
+        moved to where they were written.
+        """
+        titles = TitleIndex(self.previous)
+        words, positions = titles.words, titles.positions
+        for word_position in range(words.key_count):
+            moved = [position + shifts[bisect_right(shift_starts, position) - 1]
+                     for position in positions[words.row_offsets[word_position]:words.row_offsets[word_position + 1]]
+                     if position not in dropped]
+            if moved:
+                yield words.key(word_position), moved
+
+    def _write_tag(self, sections, tag, rows):
+        ids = sections.column(tag + '.ids', 'I')
+        codes = sections.column(tag + '.sources', 'H')
+        add_id, add_code = ids.append, codes.append
+        for rows in _write_sorted_keys(sections, tag, self._tag_rows(tag, rows)):
+            for bib_id, code in rows:
+                add_id(bib_id)
+                add_code(code)
+
+    def _write_records(self, sections):
+        ids = sections.column('records.ids', 'I')
+        codes = sections.column('records.sources', 'H')
+        offsets = sections.column('records.offsets', 'Q')
+        identifiers = sections.open('records.identifiers')
+        offset = count = max_id = 0
+        offsets.append(0)
+        for count, (bib_id, code, data) in enumerate(self._records(), 1):
+            ids.append(bib_id)
+            codes.append(code)
+            identifiers.write(data)
+            offset += len(data)
+            offsets.append(offset)
+            max_id = bib_id
+            if count % _CHUNK == 0:
+                sections.spill()
+        if count and max_id < _MAX_SLOTS_PER_RECORD * count:
+            # Read back the ids just written, rather than keep them all.
+            ids.flush()
+            ids.fp.seek(0)
+            slots = sections.column('records.slots', 'I')
+            position = next_id = 0
+            while True:
+                chunk = _typed('I', [])
+                chunk.frombytes(ids.fp.read(_CHUNK * chunk.itemsize))
+                if not chunk:
+                    break
+                for bib_id in chunk:
+                    if bib_id > next_id:
+                        slots.skip(bib_id - next_id)
+                    position += 1
+                    slots.append(position)
+                    next_id = bib_id + 1
+                slots.flush()
+
+    def _write_titles(self, sections):
+        ids = sections.column('titles.ids', 'I')
+        codes = sections.column('titles.sources', 'H')
+        years = sections.column('titles.years', 'H')
+        title_offsets = sections.column('titles.title_offsets', 'Q')
+        titles = sections.open('titles.titles')
+        author_offsets = sections.column('titles.author_offsets', 'Q')
+        authors = sections.open('titles.authors')
+        title_offset = author_offset = 0
+        title_offsets.append(0)
+        author_offsets.append(0)
+        postings = _SortedRuns(self.directory)  # (word, position), of the titles added
+        # The titles kept from the previous snapshot stay in order, moved by the titles
+        # dropped and added before them: those from shift_starts[i] on by shifts[i].
+        dropped = set()
+        shift_starts, shifts = [], []
+        next_previous = 0
+        for position, (bib_id, code, title, author, year, previous_position) in enumerate(self._titles()):
+            ids.append(bib_id)
+            codes.append(code)
+            years.append(year)
+            titles.write(title)
+            title_offset += len(title)
+            title_offsets.append(title_offset)
+            authors.write(author)
+            author_offset += len(author)
+            author_offsets.append(author_offset)
+            if position % _CHUNK == 0:
+                sections.spill()
+            if previous_position < 0:
+                for word in set(title.split()):
+                    postings.add((word, position))
+                continue
+            if previous_position > next_previous:
+                dropped.update(range(next_previous, previous_position))
+            next_previous = previous_position + 1
+            if not shifts or shifts[-1] != position - previous_position:
+                shift_starts.append(previous_position)
+                shifts.append(position - previous_position)
+
+        added = ((word, [position for _, position in group])
+                 for word, group in groupby(postings.sorted(), itemgetter(0)))
+        if self._previous_has('titles.ids'):
+            dropped.update(range(next_previous, len(TitleIndex(self.previous))))
+            added = _merge_sorted(added, self._previous_postings(dropped, shift_starts, shifts), _join_rows)
+        rows = sections.column('title_tokens.rows', 'I')
+        for word_positions in _write_sorted_keys(sections, 'title_tokens', added):
+            rows.values.extend(word_positions)
+        postings.close()
+
+    def write(self, filename):
+        """
+        Write the snapshot to a temporary file next to filename, then move it into
+        place, so readers never map a half-written file. Until then, each section is
+        spooled to a temporary file of its own in the same directory.
+
+        :param filename: str
+        """
+        if len(self.source_codes) > 0xFFFF:
+            raise SnapshotError("Too many bib sources for a snapshot.")
+        tags = set(self.tags)
+        if self.previous is not None:
+            tags.update(self.previous.meta['tags'])
+        meta = dict(self.meta)
+        meta.update({
+            'tags': sorted(tags),
+            'sources': sorted(self.source_codes, key=self.source_codes.get),
+            'created': datetime.datetime.now().isoformat(),
+        })
+        sections = _Sections(os.path.dirname(os.path.abspath(filename)))
+        try:
+            sections.open('meta').write(json.dumps(meta).encode('utf-8'))
+            added = groupby(self.rows.sorted(), itemgetter(0))
+            pending = next(added, None)
+            for tag in sorted(tags):
+                if pending is not None and pending[0] == tag:
+                    self._write_tag(sections, tag, pending[1])
+                    pending = next(added, None)
+                else:
+                    self._write_tag(sections, tag, ())
+            self._write_records(sections)
+            if len(self.descriptions) or self._previous_has('titles.ids'):
+                self._write_titles(sections)
+            sections.write(filename)
+        finally:
+            sections.close()
+            for runs in self.rows, self.record_rows, self.descriptions:
+                runs.close()
+
+
+class Snapshot:
+    """
+    A read-only, memory-mapped snapshot file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        if compress.compression_of(filename):
+            # A compressed snapshot can't be mapped, so it is decompressed into memory.
+            with compress.open_input(filename, 'rb') as fp:
+                self._map = fp.read()
+        else:
+            with open(filename, 'rb') as fp:
+                self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order, count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise SnapshotError("[%s] is not a marcaroni snapshot." % (filename,))
+        if version != VERSION:
+            raise SnapshotError("Snapshot [%s] has version %d, expected %d. Run update-data.py again."
+                                % (filename, version, VERSION))
+        if byte_order != BYTE_ORDER:
+            raise SnapshotError("Snapshot [%s] was written on a host with another byte order." % (filename,))
+        self.sections = {}  # dict[str] = (int, int)
+        for i in range(count):
+            name, offset, length = _ENTRY.unpack_from(self._map, _HEADER.size + i * _ENTRY.size)
+            self.sections[name.rstrip(b'\0').decode('utf-8')] = (offset, length)
+        self.meta = json.loads(self.bytes('meta').decode('utf-8'))
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def bytes(self, name):
+        offset, length = self.sections[name]
+        return self._map[offset:offset + length]
+
+    def offset(self, name):
+        return self.sections[name][0]
+
+    def column(self, name, typecode):
+        """
+        A zero-copy view of a fixed-width section.
+
+        :param name: str
+        :param typecode: str, a struct format character
+        :rtype: memoryview
+        """
+        offset, length = self.sections[name]
+        return memoryview(self._map)[offset:offset + length].cast(typecode)
+
+
+class _SortedKeys:
+    """
+    Binary search over the sorted keys of <name>.keys, each with a range of rows.
+    """
+    def __init__(self, snapshot, name):
+        self._map = snapshot._map
+        self.key_offsets = snapshot.column(name + '.key_offsets', 'Q')
+        self.keys_base = snapshot.offset(name + '.keys')
+        self.row_offsets = snapshot.column(name + '.row_offsets', 'I')
+        self.key_count = len(self.key_offsets) - 1
+
+    def key(self, i):
+        return self._map[self.keys_base + self.key_offsets[i]:self.keys_base + self.key_offsets[i + 1]]
+
+    def find(self, key):
+        """
+        :param key: bytes
+        :return: position of key, or -1.
+        """
+        lo, hi = 0, self.key_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.key_count and self.key(lo) == key:
+            return lo
+        return -1
+
+    def find_sorted(self, keys):
+        """
+        Look up many keys in one pass. Each search starts where the last one ended and
+        gallops forward, so a batch costs much less than a binary search per key.
+
+        :param keys: sorted list of bytes
+        :return: list of positions, or -1 for keys not found.
+        """
+        positions = []
+        buf, base, offsets, count = self._map, self.keys_base, self.key_offsets, self.key_count
+
+        def key_at(i):
+            return buf[base + offsets[i]:base + offsets[i + 1]]
+
+        lo = 0
+        for key in keys:
+            step = 1
+            while lo + step < count and key_at(lo + step) < key:
+                lo += step
+                step *= 2
+            hi = min(lo + step + 1, count)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if key_at(mid) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < count and key_at(lo) == key:
+                positions.append(lo)
+            else:
+                positions.append(-1)
+        return positions
+
+    def rows(self, position):
+        return range(self.row_offsets[position], self.row_offsets[position + 1])
+
+
+class _TagIndex(_SortedKeys):
+    """
+    The sorted identifiers of one tag, and the records having each.
+    """
+    def __init__(self, snapshot, tag):
+        super().__init__(snapshot, tag)
+        self.ids = snapshot.column(tag + '.ids', 'I')
+        self.sources = snapshot.column(tag + '.sources', 'H')
+
+
+class RecordIndex:
+    """
+    Bib id to identifiers and source, answered from the mapped pages.
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.sources = snapshot.meta['sources']
+        self.ids = snapshot.column('records.ids', 'I')
+        self.codes = snapshot.column('records.sources', 'H')
+        self.offsets = snapshot.column('records.offsets', 'Q')
+        self.identifiers_base = snapshot.offset('records.identifiers')
+        self.slots = snapshot.column('records.slots', 'I') if 'records.slots' in snapshot else None
+
+    def _position(self, bib_id):
+        bib_id = int(bib_id)
+        if self.slots is not None:
+            if 0 <= bib_id < len(self.slots):
+                return self.slots[bib_id] - 1
+            return -1
+        position = bisect_left(self.ids, bib_id)
+        if position < len(self.ids) and self.ids[position] == bib_id:
+            return position
+        return -1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, bib_id):
+        return self._position(bib_id) >= 0
+
+    def get(self, bib_id):
+        """
+        :param bib_id: int or str
+        :return: BibRecord, or None if the snapshot has no identifiers for this record.
+        """
+        position = self._position(bib_id)
+        if position < 0:
+            return None
+        data = self.snapshot._map[self.identifiers_base + self.offsets[position]:
+                                  self.identifiers_base + self.offsets[position + 1]]
+        identifiers = []
+        for entry in data.split(_IDENTIFIER_TERMINATOR)[:-1]:
+            tag, identifier = entry.split(_TAG_SEPARATOR, 1)
+            identifiers.append((tag.decode('utf-8'), identifier.decode('utf-8')))
+        return BibRecord(str(self.ids[position]), self.sources[self.codes[position]], identifiers)
+
+
+class TitleIndex:
+    """
+    Title words to the records having them, and the title, main entry and date of each
+    of those records, answered from the mapped pages. Records are known by their
+    position in the titles.* columns.
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.sources = snapshot.meta['sources']
+        self.words = _SortedKeys(snapshot, 'title_tokens')
+        self.positions = snapshot.column('title_tokens.rows', 'I')
+        self.ids = snapshot.column('titles.ids', 'I')
+        self.codes = snapshot.column('titles.sources', 'H')
+        self.years = snapshot.column('titles.years', 'H')
+        self.title_offsets = snapshot.column('titles.title_offsets', 'Q')
+        self.titles_base = snapshot.offset('titles.titles')
+        self.author_offsets = snapshot.column('titles.author_offsets', 'Q')
+        self.authors_base = snapshot.offset('titles.authors')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def postings(self, word):
+        """
+        :type word: str
+        :return: sequence of int, the positions of the records with word in their title.
+        """
+        position = self.words.find(word.encode('utf-8'))
+        if position < 0:
+            return ()
+        return self.positions[self.words.row_offsets[position]:self.words.row_offsets[position + 1]]
+
+    def description(self, position):
+        """
+        :rtype: fallback.Description
+        """
+        buf = self.snapshot._map
+        title = buf[self.titles_base + self.title_offsets[position]:
+                    self.titles_base + self.title_offsets[position + 1]]
+        author = buf[self.authors_base + self.author_offsets[position]:
+                     self.authors_base + self.author_offsets[position + 1]]
+        return fallback.Description(title.decode('utf-8'), author.decode('utf-8'), self.years[position])
+
+    def record(self, position):
+        """
+        :rtype: Record
+        """
+        return Record(str(self.ids[position]), self.sources[self.codes[position]])
+
+
+class SnapshotBibData:
+    """
+    Drop-in replacement for ILSBibData, answering from a memory-mapped snapshot.
+    """
+    def __init__(self):
+        self.snapshot = None
+        self.sources = []
+        self.indexes = []
+        self._records = None
+        self._titles = None
+
+    @property
+    def records(self):
+        """
+        The reverse index, opened on first use.
+
+        :rtype: RecordIndex
+        """
+        if self._records is None:
+            self._records = RecordIndex(self.snapshot)
+        return self._records
+
+    @property
+    def titles(self):
+        """
+        The title index, opened on first use.
+
+        :return: TitleIndex, or None if the snapshot was written without titles.
+        """
+        if self._titles is None and 'titles.ids' in self.snapshot:
+            self._titles = TitleIndex(self.snapshot)
+        return self._titles
+
+    def load_from_file(self, bib_data_file_name, match_field = None):
+        self.snapshot = Snapshot(bib_data_file_name)
+        self.sources = self.snapshot.meta['sources']
+        for tag in self.snapshot.meta['tags']:
+            if match_field and tag != match_field:
+                continue
+            index = _TagIndex(self.snapshot, tag)
+            if index.key_count > 0:
+                self.indexes.append(index)
+        if len(self.indexes) == 0:
+            print("Bib data file did not contain valid records.", file=sys.stderr)
+            sys.exit(1)
+
+    def __contains__(self, item):
+        key = item.encode('utf-8')
+        return any(index.find(key) >= 0 for index in self.indexes)
+
+    def match_many(self, identifier_sets):
+        """
+        Match the identifiers of many records at once. Identifiers are looked up once
+        per batch, in key order.
+
+        :type identifier_sets: list[set[str]]
+        :return: list of sets of Record, one per identifier set.
+        """
+        keys = {identifier: identifier.encode('utf-8') for identifiers in identifier_sets
+                for identifier in identifiers}
+        wanted = sorted(set(keys.values()))
+        found = {}  # dict[bytes] = list[Record]
+        for index in self.indexes:
+            for key, position in zip(wanted, index.find_sorted(wanted)):
+                if position < 0:
+                    continue
+                records = found.setdefault(key, [])
+                for row in index.rows(position):
+                    records.append(Record(str(index.ids[row]), self.sources[index.sources[row]]))
+        return [set(record for identifier in identifiers for record in found.get(keys[identifier], ()))
+                for identifiers in identifier_sets]
+
+    def match(self, new_identifiers):
+        matches = set()
+        for identifier in new_identifiers:
+            key = identifier.encode('utf-8')
+            for index in self.indexes:
+                position = index.find(key)
+                if position < 0:
+                    continue
+                for row in index.rows(position):
+                    matches.add(Record(str(index.ids[row]), self.sources[index.sources[row]]))
+        return matches
+
+    def match_titles(self, descriptions, threshold):
+        """
+        Match records by title, main entry and date (see marcaroni.fallback).
+
+        :type descriptions: list[fallback.Description]
+        :param threshold: float, the lowest score kept.
+        :return: list of sets of Record, one per description.
+        """
+        return [fallback.match(self.titles, description, threshold) for description in descriptions]
@@ -88,16 +88,15 @@ class BibSourceRegistry:
         source_ids.remove(self.selected.id)
         return source_ids
 
-    def get_match_field(self, bib_source_id = None):
+    def get_match_field(self, policy, bib_source_id = None):
+        """
+        :type policy: marcaroni.policy.MatchPolicy
+        :type bib_source_id: str
+        :return: str, the tag to match on, or None if no bib source is given or selected.
+        """
         if not bib_source_id:
             if not self.selected:
                 return None
             else:
                 bib_source_id = self.selected.id
-
-        if bib_source_id in ('68', '87', '67', '76', '66', '1', '93', '41', '48', '49', '40', '71', '40', '22', '37', '102', '106'):
-            return '035'
-        if bib_source_id in ('91'):
-            return '035'
-        else:
-            return '020'
+        return policy.match_field(bib_source_id)
@@ -0,0 +1,231 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+"""
+Output files written in large blocks by a background thread.
+
+A Writer owns partitions: output files that are only created when the first item is
+written to them. write() serializes the item (bytes, a str, a CSV row, or a record with
+as_marc()) and puts the bytes in a batch. Full batches go over a bounded queue to the
+writer's thread, which writes each partition once its buffer is large. write() only
+waits when the queue is full, i.e. when the disk can't keep up. The thread's work is
+timed as the metrics stage write_io.
+
+Records are serialized by write(), on the caller's thread, so they may be changed or
+reused once it returns.
+
+close() writes everything out and closes the files. Writers still open when the
+interpreter exits, e.g. because sys.exit() or an exception ended the run, are closed
+then.
+"""
+
+import atexit
+import csv
+import io
+import os
+import queue
+import threading
+
+from marcaroni import compress
+from marcaroni import metrics
+
+# Items handed to the writer's thread at once.
+BATCH_SIZE = 256
+# Batches waiting for the writer's thread, at most.
+QUEUE_SIZE = 64
+# Bytes kept per partition before they are written to its file.
+BUFFER_SIZE = 1 << 20
+
+# Writers not closed yet, to close at exit. The writer's thread keeps a writer alive anyway.
+_open_writers = set()
+
+
+class Partition:
+    """
+    One output file of a Writer.
+    """
+    def __init__(self, file_name, kind='binary', header=None, append=False, dialect='excel', compression=None):
+        """
+        :param kind: str, 'binary' for MARC (bytes or records with as_marc()), 'text' for
+                     str, or 'csv' for rows.
+        :param header: a row written first when the file is created, for 'csv'.
+        :param append: bool, add to an existing file (e.g. when resuming) rather than start it over.
+        :param compression: str, 'gz', 'bz2' or 'xz' to write the file compressed (see marcaroni.compress).
+        """
+        self.file_name = file_name
+        self.kind = kind
+        self.header = header
+        self.append = append
+        self.compression = compression
+        self.count = 0  # items handed to write()
+        self._fp = None
+        self._buffer = bytearray()
+        if kind == 'csv':
+            self._rows = io.StringIO()
+            self._csv_writer = csv.writer(self._rows, dialect=dialect)
+        self._header_data = self._serialize(header) if header is not None else None
+
+    def _serialize(self, item):
+        if self.kind == 'csv':
+            self._csv_writer.writerow(item)
+            text = self._rows.getvalue()
+            self._rows.seek(0)
+            self._rows.truncate()
+            return text.encode('utf-8')
+        if self.kind == 'text':
+            return item.encode('utf-8')
+        if isinstance(item, bytes):
+            return item
+        return item.as_marc()
+
+    def _write(self, data):
+        if self._fp is None:
+            self._open()
+        self._buffer += data
+        if len(self._buffer) >= BUFFER_SIZE:
+            self._drain()
+
+    def _open(self):
+        self._fp = compress.open_file(self.file_name, 'ab' if self.append else 'wb', self.compression)
+        if self._header_data is not None and not self.append:
+            self._buffer += self._header_data
+
+    def _drain(self):
+        if self._buffer:
+            self._fp.write(self._buffer)
+            self._buffer = bytearray()
+
+    def _flush(self):
+        if self._fp is not None and self.compression:
+            # Ends the compressed stream, so the file is whole up to its size now. Writing
+            # on appends another one.
+            self._close()
+        elif self._fp is not None:
+            self._drain()
+            self._fp.flush()
+
+    def _close(self):
+        if self._fp is not None:
+            self._drain()
+            self._fp.close()
+            self._fp = None
+            # Appends from here on, e.g. if the partition is written to again.
+            self.append = True
+
+    def size(self):
+        """
+        :return: int, the size of the file, 0 if it was not created. Only up to date after Writer.flush().
+        """
+        if self._fp is None and not os.path.exists(self.file_name):
+            return 0
+        return os.path.getsize(self.file_name)
+
+
+class Writer:
+    def __init__(self, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.partitions = []
+        self._batch = []
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='marcaroni-writer', daemon=True)
+        self._thread.start()
+        _open_writers.add(self)
+
+    def partition(self, file_name, kind='binary', header=None, append=False, dialect='excel', compression=None):
+        """
+        :rtype: Partition
+        """
+        partition = Partition(file_name, kind, header, append, dialect, compression)
+        self.partitions.append(partition)
+        return partition
+
+    def write(self, partition, item):
+        """
+        :type partition: Partition
+        """
+        self._batch.append((partition, partition._serialize(item)))
+        partition.count += 1
+        if len(self._batch) >= self.batch_size:
+            self._send()
+
+    def _send(self):
+        self._raise_error()
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def flush(self):
+        """
+        Wait until everything written so far is in the files.
+        """
+        if self._closed:
+            return
+        self._send()
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        self._raise_error()
+
+    def close(self):
+        """
+        Write everything out and close the files. Can be called more than once.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        _open_writers.discard(self)
+        try:
+            self._send()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                with metrics.stage('write_io', 0):
+                    for partition in list(self.partitions):
+                        try:
+                            partition._close()
+                        except Exception as e:
+                            if self._error is None:
+                                self._error = e
+                return
+            try:
+                if isinstance(task, threading.Event):
+                    with metrics.stage('write_io', 0):
+                        for partition in list(self.partitions):
+                            partition._flush()
+                    continue
+                if self._error is None:
+                    with metrics.stage('write_io', len(task)):
+                        for partition, data in task:
+                            partition._write(data)
+            except Exception as e:
+                # Raised in the caller's thread on its next call; keep taking tasks so it never blocks.
+                if self._error is None:
+                    self._error = e
+            finally:
+                if isinstance(task, threading.Event):
+                    task.set()
+
+
+@atexit.register
+def _close_open_writers():
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception as e:
+            print("Could not write out all output: %s" % (e,))
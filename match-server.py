@@ -0,0 +1,51 @@
+#!/usr/local/bin/python3
+# vim: set expandtab:
+# vim: tabstop=4:
+# vim: ai:
+# vim: shiftwidth=4:
+
+##
+# Keep the bib data loaded and answer bibmatcher.py --server requests over a Unix socket.
+# A new file published by update-data.py is picked up without a restart.
+
+import optparse
+import os
+import sys
+
+import marcaroni.server
+
+
+def parse_cmd_line():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-d", "--bib-data", dest="bib_data", default="bib-data.snap",
+                      help="CSV file or compiled snapshot of Bib Data to serve. [default: %default]")
+    parser.add_option("--socket", dest="socket", default="marcaroni.sock",
+                      help="Unix socket to listen on. [default: %default]")
+    parser.add_option("-m", "--match-field", dest="match_fields", action="append", default=[],
+                      help="Load this match field before accepting requests. May be repeated; "
+                           "other fields are loaded on first use.")
+    parser.add_option("--poll", dest="poll", type="int", default=marcaroni.server.POLL_INTERVAL,
+                      help="Seconds between checks for a new bib data file. [default: %default]")
+    opts, args = parser.parse_args()
+
+    if not os.path.exists(opts.bib_data):
+        parser.error("Bib data file [%s] not found." % (opts.bib_data,))
+    return opts
+
+
+def main():
+    opts = parse_cmd_line()
+    service = marcaroni.server.MatchService(opts.bib_data)
+    try:
+        server = marcaroni.server.MatchServer(opts.socket, service)
+        print("Serving %s on %s" % (opts.bib_data, opts.socket))
+        server.serve(opts.match_fields, opts.poll)
+    except marcaroni.server.ServerError as e:
+        print(e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
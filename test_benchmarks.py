@@ -0,0 +1,92 @@
+#!/usr/local/bin/python3
+
+import io
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import marcaroni.ils
+import marcaroni.policy
+import marcaroni.sources
+from marcaroni.normalize import canonical_identifier
+from benchmarks import run, synthetic
+
+
+def get_conf():
+    bibsources = marcaroni.sources.BibSourceRegistry()
+    bibsources.load_from_file('conf/bib_sources.csv')
+    policy = marcaroni.policy.MatchPolicy()
+    policy.load_from_file()
+    return bibsources, policy
+
+
+def get_catalogue(seed=1):
+    bibsources, policy = get_conf()
+    return synthetic.Catalogue(bibsources, policy, seed)
+
+
+class SyntheticTestCase(unittest.TestCase):
+    def test_isbn(self):
+        for number in (0, 1, 12345678, 99999999):
+            value = synthetic.isbn(0, number)
+            self.assertEqual(canonical_identifier(value, '020'), value)
+        self.assertNotEqual(synthetic.isbn(0, 5), synthetic.isbn(9, 5))
+
+    def test_rows(self):
+        catalogue = get_catalogue()
+        rows = list(catalogue.rows(1000))
+        self.assertGreaterEqual(len(rows), 1000)
+        self.assertEqual(int(rows[-1][1]), catalogue.record_count)
+        self.assertEqual(rows, list(get_catalogue().rows(1000)))
+        self.assertNotEqual(rows, list(get_catalogue(2).rows(1000)))
+        for identifier, bib_id, source, tag, subfield in rows:
+            self.assertEqual(canonical_identifier(identifier, tag), identifier)
+            self.assertEqual(catalogue.source(int(bib_id)), source)
+            if identifier.startswith('v'):
+                self.assertIn(source, catalogue.matched_on_035)
+
+    def test_match_rate(self):
+        catalogue = get_catalogue()
+        eg_records = marcaroni.ils.ILSBibData()
+        for identifier, bib_id, source, tag, subfield in catalogue.rows(5000):
+            if tag == '020':
+                eg_records.add(identifier, bib_id, source)
+        for match_rate in (0.0, 0.5, 1.0):
+            identifier_sets = synthetic.vendor_identifier_sets(catalogue, 1000, match_rate, seed=3,
+                                                               missing_percent=0)
+            matched = sum(1 for identifiers in identifier_sets
+                          if eg_records.match(set(canonical_identifier(value, '020') for value in identifiers)))
+            self.assertAlmostEqual(matched / 1000, match_rate, delta=0.05)
+
+
+class RunTestCase(unittest.TestCase):
+    def test_compare(self):
+        baseline = {'load_csv_020': {'seconds': 1.0}, 'match_csv_020': {'seconds': 1.0}}
+        results = {'load_csv_020': {'seconds': 1.2}, 'match_csv_020': {'seconds': 1.3}, 'new': {'seconds': 9.0}}
+        regressions = run.compare(results, baseline, 0.25)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('match_csv_020'))
+
+    def test_run_benchmarks(self):
+        bibsources, policy = get_conf()
+        directory = tempfile.mkdtemp()
+        try:
+            data = run.BenchmarkData(directory, bibsources, policy, 2000, 200, 0.5, 1)
+            with redirect_stdout(io.StringIO()):
+                data.generate()
+                results = run.run_benchmarks(data, 1, 1, {'load_csv_020', 'match_csv_020', 'process_035_w1'})
+            self.assertEqual(sorted(results), ['load_csv_020', 'match_csv_020', 'process_035_w1'])
+            self.assertEqual(results['process_035_w1']['items'], 200)
+
+            # A second run finds the files of the first.
+            record_count = data.catalogue.record_count
+            data = run.BenchmarkData(directory, bibsources, policy, 2000, 200, 0.5, 1)
+            data.generate()
+            self.assertEqual(data.catalogue.record_count, record_count)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,20 @@
 #!/usr/local/bin/python3
 
+import io
+import os
+import shutil
+import tempfile
 import unittest
+from contextlib import redirect_stdout, redirect_stderr
 
+from pymarc import Record, Field
+
+import marcaroni.fallback
 import marcaroni.output
+import marcaroni.policy
+import marcaroni.rawmarc
 import marcaroni.ils
+import marcaroni.snapshot
 import marcaroni.sources
 import bibmatcher
 
@@ -28,6 +39,9 @@ class MockOutputRecordHandler(marcaroni.output.OutputRecordHandler):
     def match_is_better(self, marc_rec):
         self.calls.append(('ignore', marc_rec))
 
+    def exact_match(self, marc_rec, bib_id):
+        self.calls.append(('exact', marc_rec, bib_id))
+
     def report_of_ddas_to_hide(self, title, platform, bib_id):
         self.calls.append(('report_of_ddas_to_hide', title, platform, bib_id))
 
@@ -146,5 +160,218 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(output.calls[0][0], 'ignore')
 
 
+class ParallelTestCase(unittest.TestCase):
+    @staticmethod
+    def get_marc_data(count):
+        data = b''
+        for i in range(count):
+            record = Record()
+            record.add_field(Field(tag='245', indicators=['0', '0'], subfields=['a', 'Title %d' % (i,)]))
+            data += record.as_marc()
+        return data
+
+    def test_read_record_chunks(self):
+        data = self.get_marc_data(5)
+        chunks = list(bibmatcher.read_record_chunks(io.BytesIO(data), chunk_size=2))
+        self.assertEqual([records_before_chunk for records_before_chunk, chunk in chunks], [0, 2, 4])
+        self.assertEqual(b''.join(chunk for records_before_chunk, chunk in chunks), data)
+
+    def test_read_raw_records_bad_length(self):
+        data = self.get_marc_data(1)
+        self.assertEqual(list(marcaroni.rawmarc.read_raw_records(io.BytesIO(data + b'junk'))), [data, b'junk'])
+
+    def test_recorder_replay(self):
+        recorder = marcaroni.output.OutputRecorder()
+        recorder.match_is_better(bibmatcher.PendingRecord(Record(), None, '020', 1))
+        recorder.report_of_ddas_to_hide('platform', 'title', '42')
+        output = MockOutputRecordHandler()
+        output.write_match_is_better = lambda data: output.calls.append(('write_match_is_better', data))
+        marcaroni.output.OutputRecorder.replay(recorder.calls, output)
+        self.assertEqual(output.calls, [('write_match_is_better', Record().as_marc()),
+                                        ('report_of_ddas_to_hide', 'platform', 'title', '42')])
+
+
+class CSVTestCase(unittest.TestCase):
+    def test_detect_identifier_columns_by_heading(self):
+        self.assertEqual(bibmatcher.detect_identifier_columns(['Title', 'ISBN', 'eISBN'], [], '020'), [1, 2])
+        self.assertEqual(bibmatcher.detect_identifier_columns(['Title', 'OCLC #'], [], '035'), [1])
+
+    def test_detect_identifier_columns_by_values(self):
+        rows = [['Title', '9780306406157', '2001'], ['Other', '="978-0-306-40615-7"', '2002'], ['Third', '', '']]
+        self.assertEqual(bibmatcher.detect_identifier_columns(['A', 'B', 'C'], rows, '020'), [1])
+        self.assertEqual(bibmatcher.detect_identifier_columns(['A', 'B', 'C'], rows, '035'), [])
+
+    def test_match_rows(self):
+        bibsources = marcaroni.sources.BibSourceRegistry()
+        for bib_source_id, platform in [('1', 'a'), ('2', 'a'), ('3', 'b')]:
+            bibsources._add_bib_source(marcaroni.sources.BibSource(bib_source_id, 'Source ' + bib_source_id,
+                                                                   platform, 'dda'))
+        bibsources.set_selected('1')
+        eg_records = marcaroni.ils.CompactILSBibData()
+        eg_records.add('9780306406157', '10', '2')
+        eg_records.add('9780306406157', '11', '3')
+        rows = [['Title', '9780306406157'], ['Missing', '9780000000000'], ['Short']]
+        out_rows, histogram = bibmatcher.match_rows(rows, bibsources, eg_records, [1], '020',
+                                                    bibsources.other_sources_on_platform())
+        self.assertEqual(out_rows, [['NULL', '10', '11', 'Title', '9780306406157'],
+                                    ['NULL', 'NULL', 'NULL', 'Missing', '9780000000000'],
+                                    ['NULL', 'NULL', 'NULL', 'Short']])
+        self.assertEqual(histogram, {'2': 1, '3': 1})
+
+
+class FallbackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bibsources = marcaroni.sources.BibSourceRegistry()
+        for bib_source_id, platform in [('1', 'a'), ('2', 'b')]:
+            self.bibsources._add_bib_source(marcaroni.sources.BibSource(bib_source_id, 'Source ' + bib_source_id,
+                                                                        platform, 'purchased'))
+        self.bibsources.set_selected('1')
+        self.policy = marcaroni.policy.MatchPolicy()
+        self.policy.load_from_file()
+        self.policy.fallback = True
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        builder.add(('9780306406157', '10', '2', '020', 'a'))
+        builder.add_description(('10', '2', 'A history of coffee', 'Smith, John', '2003'))
+        file_name = os.path.join(self.directory, 'bib-data.snap')
+        builder.write(file_name)
+        self.eg_records = marcaroni.snapshot.SnapshotBibData()
+        self.eg_records.load_from_file(file_name, '020')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def get_marc_data(title, author, date):
+        record = Record()
+        record.add_field(Field(tag='008', data='000000s%s    xxu' % (date,)))
+        record.add_field(Field(tag='100', indicators=['1', ' '], subfields=['a', author]))
+        record.add_field(Field(tag='245', indicators=['0', '0'], subfields=['a', title]))
+        record.add_field(Field(tag='856', indicators=['4', '0'], subfields=['u', 'http://example.com/']))
+        return record.as_marc()
+
+    def process(self, *records):
+        output = MockOutputRecordHandler()
+        output.matches_by_bibsource = {}
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()) as err:
+            bibmatcher.process_mrc_file(self.eg_records, list(records), output, self.bibsources.selected,
+                                        self.bibsources, '020', self.policy)
+        return output, err.getvalue()
+
+    def test_description(self):
+        raw_record = marcaroni.rawmarc.RawRecord(self.get_marc_data('The history of coffee /', 'Smith, John,', '2003'))
+        record = bibmatcher.PendingRecord(raw_record, None, '020', 1)
+        self.assertEqual(record.description(), marcaroni.fallback.Description('history coffee', 'smith', 2003))
+
+    def test_match_on_title_goes_through_rules(self):
+        output, err = self.process(self.get_marc_data('A history of coffee.', 'Smith, J.', '2003'),
+                                   self.get_marc_data('Another book entirely', 'Smith, J.', '2003'))
+        self.assertEqual([call[0] for call in output.calls], ['add', 'ambiguous'])
+        self.assertEqual(output.calls[1][2], 'Record has no identifier in 020.')
+        self.assertEqual(output.matches_by_bibsource, {'2': 1})
+        self.assertIn('NOTE: record no 1 matched 1 by title: 10', err)
+
+    def test_no_fallback(self):
+        self.policy.fallback = False
+        output, err = self.process(self.get_marc_data('A history of coffee.', 'Smith, J.', '2003'))
+        self.assertEqual([call[0] for call in output.calls], ['ambiguous'])
+        self.assertNotIn('NOTE', err)
+
+
+class URLMatchTestCase(unittest.TestCase):
+    @staticmethod
+    def get_marc_data(*urls):
+        record = Record()
+        record.add_field(Field(tag='245', indicators=['0', '0'], subfields=['a', 'Title']))
+        for url in urls:
+            record.add_field(Field(tag='856', indicators=['4', '0'], subfields=['u', url]))
+        return record.as_marc()
+
+    def test_extract_urls(self):
+        raw_record = marcaroni.rawmarc.RawRecord(self.get_marc_data(
+            'http://proxy.example.ca/login?url=https://ebookcentral.proquest.com/lib/uwo/detail.action?docID=1234567',
+            'https://www.jstor.org/stable/10.2307/j.ctt1'))
+        record = bibmatcher.PendingRecord(raw_record, None, '856', 1)
+        self.assertEqual(record.identifiers, {'ebookcentral proquest com docid 1234567',
+                                              'jstor org stable 10 2307 j ctt1'})
+
+    def test_extract_urls_without_digits(self):
+        raw_record = marcaroni.rawmarc.RawRecord(self.get_marc_data('https://www.example.com/', 'http://a.ca/books'))
+        record = bibmatcher.PendingRecord(raw_record, None, '856', 1)
+        self.assertEqual(record.identifiers, {'example com', 'a ca books'})
+
+    def test_reload_matches_on_url(self):
+        directory = tempfile.mkdtemp()
+        try:
+            builder = marcaroni.snapshot.SnapshotBuilder()
+            builder.add(('ebookcentral proquest com docid 1234567', '10', '1', '856', 'u'))
+            file_name = os.path.join(directory, 'bib-data.snap')
+            builder.write(file_name)
+            eg_records = marcaroni.snapshot.SnapshotBibData()
+            eg_records.load_from_file(file_name, '856')
+        finally:
+            shutil.rmtree(directory)
+        bibsources = marcaroni.sources.BibSourceRegistry()
+        bibsources._add_bib_source(marcaroni.sources.BibSource('1', 'Source 1', 'a', 'purchased'))
+        bibsources.set_selected('1')
+        policy = marcaroni.policy.MatchPolicy()
+        policy.load_from_file()
+        output = MockOutputRecordHandler()
+        output.matches_by_bibsource = {}
+        data = self.get_marc_data('https://ebookcentral.proquest.com/lib/other/detail.action?docID=1234567')
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            bibmatcher.process_mrc_file(eg_records, [data], output, bibsources.selected, bibsources, '856', policy)
+        self.assertEqual(output.matches_by_bibsource, {'1': 1})
+        self.assertEqual([call[0] for call in output.calls], ['exact'])
+        self.assertEqual(output.calls[0][2], '10')
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ('a.mrc', 'b.mrc'):
+            open(os.path.join(self.directory, name), 'wb').close()
+        self.manifest = os.path.join(self.directory, 'jobs.csv')
+        self.bibsources = marcaroni.sources.BibSourceRegistry()
+        self.bibsources.load_from_file(os.path.join(os.path.dirname(__file__), 'conf', 'bib_sources.csv'))
+        self.policy = marcaroni.policy.MatchPolicy()
+        self.policy.load_from_file()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_manifest(self, *lines):
+        with open(self.manifest, 'w') as fp:
+            fp.write('input,bib_source,match_field,output\n')
+            for line in lines:
+                fp.write(line + '\n')
+
+    def test_read_manifest(self):
+        self.write_manifest('a.mrc,9,,', 'b.mrc,50,020,out')
+        jobs = bibmatcher.read_manifest(self.manifest, self.bibsources, self.policy)
+        self.assertEqual(jobs, [
+            bibmatcher.Job(os.path.join(self.directory, 'a.mrc'), '9', '035', os.path.join(self.directory, 'a')),
+            bibmatcher.Job(os.path.join(self.directory, 'b.mrc'), '50', '020', os.path.join(self.directory, 'out')),
+        ])
+
+    def test_read_manifest_same_output(self):
+        self.write_manifest('a.mrc,9,,out', 'b.mrc,50,,out')
+        with self.assertRaises(SystemExit), redirect_stdout(io.StringIO()):
+            bibmatcher.read_manifest(self.manifest, self.bibsources, self.policy)
+
+    def test_handlers_log_to_their_own_directory(self):
+        handlers = [marcaroni.output.OutputRecordHandler(os.path.join(self.directory, name), 'x')
+                    for name in ('one', 'two')]
+        handlers[0].logger('first')
+        handlers[1].logger('second')
+        for handler in handlers:
+            for log_handler in handler.log_handlers:
+                log_handler.flush()
+        with open(os.path.join(self.directory, 'one', 'marcaroni.log')) as fp:
+            log = fp.read()
+        self.assertIn('first', log)
+        self.assertNotIn('second', log)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/local/bin/python3
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+
+from pymarc import Record, Field
+
+import marcaroni.checkpoint
+import marcaroni.compress
+import marcaroni.output
+import marcaroni.sources
+import bibmatcher
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.directory, 'in.mrc')
+        with open(self.input_file, 'wb') as fp:
+            fp.write(b'a' * 10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_state(self, input_offset):
+        return {
+            'input_files': [os.path.abspath(self.input_file)],
+            'input_index': 0,
+            'input_offset': input_offset,
+            'input_digest': marcaroni.checkpoint.input_digest(self.input_file, input_offset),
+            'bib_source': '50',
+            'match_field': '020',
+            'finished': False,
+        }
+
+    def test_save_and_load(self):
+        checkpoint = marcaroni.checkpoint.Checkpoint(self.directory)
+        self.assertFalse(checkpoint.exists())
+        checkpoint.save(self.get_state(5000))
+        self.assertEqual(checkpoint.load(), self.get_state(5000))
+
+    def test_input_may_change_after_the_checkpoint(self):
+        checkpoint = marcaroni.checkpoint.Checkpoint(self.directory)
+        state = self.get_state(5000)
+        with open(self.input_file, 'r+b') as fp:
+            fp.seek(5000)
+            fp.write(b'b')
+        checkpoint.check(state, [self.input_file], '50', '020')
+        with open(self.input_file, 'r+b') as fp:
+            fp.seek(4999)
+            fp.write(b'b')
+        with self.assertRaises(marcaroni.checkpoint.CheckpointError):
+            checkpoint.check(state, [self.input_file], '50', '020')
+
+    def test_compressed_input(self):
+        compressed_file = self.input_file + '.gz'
+        with open(self.input_file, 'rb') as fp, marcaroni.compress.open_file(compressed_file, 'wb') as out:
+            out.write(fp.read())
+        for input_offset in (0, 100, 5000, 4000, 10000):
+            self.assertEqual(marcaroni.checkpoint.input_digest(compressed_file, input_offset),
+                             marcaroni.checkpoint.input_digest(self.input_file, input_offset))
+        self.assertIsNone(marcaroni.checkpoint.input_digest(compressed_file, 10001))
+
+    def test_other_run(self):
+        checkpoint = marcaroni.checkpoint.Checkpoint(self.directory)
+        with self.assertRaises(marcaroni.checkpoint.CheckpointError):
+            checkpoint.check(self.get_state(0), [self.input_file], '51', '020')
+        with self.assertRaises(marcaroni.checkpoint.CheckpointError):
+            checkpoint.load()
+
+
+class MockRecord:
+    title = 'Title'
+    isbn = '9780306406157'
+
+    @staticmethod
+    def as_marc():
+        return b'record'
+
+
+class ResumeOutputTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.directory, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_handler(self, checkpoint=None, compression=None):
+        with redirect_stderr(io.StringIO()):
+            return marcaroni.output.OutputRecordHandler(self.prefix, 'x', checkpoint, compression)
+
+    def test_files_are_cut_back(self):
+        handler = self.get_handler()
+        handler.no_match(MockRecord())
+        state = handler.checkpoint_state()
+        handler.no_match(MockRecord())
+        handler.ambiguous(MockRecord(), 'Reason')
+        del handler
+
+        handler = self.get_handler(state)
+        self.assertEqual(handler.records_without_matches_counter, 1)
+        self.assertEqual(handler.ambiguous__counter, 0)
+        handler.no_match(MockRecord())
+        handler.ambiguous(MockRecord(), 'Reason')
+        del handler
+
+        with open(os.path.join(self.prefix, 'x_no_matches_on_platform.mrc'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'record' * 2)
+        with open(os.path.join(self.prefix, 'report_ambiguous_records.csv'), 'r') as fp:
+            self.assertEqual(fp.read(), 'Title,ISBN,Reason\nTitle,9780306406157,Reason\n')
+
+    def test_compressed_files_are_cut_back(self):
+        handler = self.get_handler(compression='gz')
+        handler.no_match(MockRecord())
+        state = handler.checkpoint_state()
+        handler.no_match(MockRecord())
+        del handler
+
+        handler = self.get_handler(state, 'gz')
+        handler.no_match(MockRecord())
+        del handler
+        with marcaroni.compress.open_file(os.path.join(self.prefix, 'x_no_matches_on_platform.mrc.gz')) as fp:
+            self.assertEqual(fp.read(), b'record' * 2)
+        with self.assertRaises(marcaroni.checkpoint.CheckpointError):
+            self.get_handler(state)
+
+    def test_missing_output(self):
+        handler = self.get_handler()
+        handler.no_match(MockRecord())
+        state = handler.checkpoint_state()
+        del handler
+        os.remove(os.path.join(self.prefix, 'x_no_matches_on_platform.mrc'))
+        with self.assertRaises(marcaroni.checkpoint.CheckpointError):
+            self.get_handler(state)
+
+
+class ProcessCheckpointTestCase(unittest.TestCase):
+    def test_read_pending_records_offsets(self):
+        records = []
+        for i in range(3):
+            record = Record()
+            record.add_field(Field(tag='245', indicators=['0', '0'], subfields=['a', 'Title %d' % (i,)]))
+            records.append(record.as_marc())
+        pending = list(bibmatcher.read_pending_records(records, marcaroni.sources.BibSourceRegistry(),
+                                                       '020', 10, 100))
+        self.assertEqual([record.sequence for record in pending], [11, 12, 13])
+        self.assertEqual(pending[0].input_start, 100)
+        self.assertEqual(pending[2].input_end, 100 + sum(len(data) for data in records))
+        self.assertEqual(pending[1].input_start, pending[0].input_end)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/local/bin/python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import marcaroni.compress
+
+DATA = b''.join(b'%08d\x1e\x1d' % (i,) for i in range(50000))
+
+
+class CompressTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_names(self):
+        self.assertEqual(marcaroni.compress.compression_of('a.mrc.gz'), 'gz')
+        self.assertEqual(marcaroni.compress.compression_of('a.mrc.XZ'), 'xz')
+        self.assertIsNone(marcaroni.compress.compression_of('a.mrc'))
+        self.assertEqual(marcaroni.compress.uncompressed_name('dir/a.mrc.bz2'), 'dir/a.mrc')
+        self.assertEqual(marcaroni.compress.uncompressed_name('a.mrc'), 'a.mrc')
+        self.assertEqual(marcaroni.compress.extension('bz2'), '.bz2')
+        self.assertEqual(marcaroni.compress.extension(None), '')
+
+    def test_round_trip(self):
+        for compression in ('gz', 'bz2', 'xz'):
+            file_name = self.path('a.mrc.' + compression)
+            with marcaroni.compress.open_file(file_name, 'wb') as fp:
+                fp.write(DATA)
+            with open(file_name, 'rb') as fp:
+                self.assertNotEqual(fp.read(len(DATA)), DATA)
+            with marcaroni.compress.open_input(file_name) as fp:
+                self.assertFalse(fp.seekable())
+                self.assertEqual(fp.read(5), DATA[:5])
+                self.assertEqual(fp.read(), DATA[5:])
+                self.assertEqual(fp.read(), b'')
+
+    def test_appended_streams(self):
+        file_name = self.path('a.mrc.gz')
+        with marcaroni.compress.open_file(file_name, 'wb') as fp:
+            fp.write(DATA[:1000])
+        with marcaroni.compress.open_file(file_name, 'ab') as fp:
+            fp.write(DATA[1000:])
+        with marcaroni.compress.open_input(file_name) as fp:
+            self.assertEqual(fp.read(), DATA)
+
+    def test_text(self):
+        file_name = self.path('bib-data.txt.gz')
+        with marcaroni.compress.open_file(file_name, 'wt') as fp:
+            fp.write('identifier,id\n9781234567897,10\n')
+        with marcaroni.compress.open_input(file_name, 'r') as fp:
+            self.assertEqual(list(fp), ['identifier,id\n', '9781234567897,10\n'])
+
+    def test_uncompressed_file_is_opened_as_is(self):
+        file_name = self.path('a.mrc')
+        with open(file_name, 'wb') as fp:
+            fp.write(DATA)
+        with marcaroni.compress.open_input(file_name) as fp:
+            self.assertTrue(fp.seekable())
+            self.assertEqual(fp.read(), DATA)
+
+    def test_close_before_the_end(self):
+        file_name = self.path('a.mrc.xz')
+        with marcaroni.compress.open_file(file_name, 'wb') as fp:
+            fp.write(DATA * 20)
+        with marcaroni.compress.open_input(file_name) as fp:
+            self.assertEqual(fp.read(10), DATA[:10])
+
+    def test_bad_data_is_raised_in_reader(self):
+        file_name = self.path('a.mrc.gz')
+        with open(file_name, 'wb') as fp:
+            fp.write(b'not gzip data')
+        with marcaroni.compress.open_input(file_name) as fp:
+            with self.assertRaises(OSError):
+                fp.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
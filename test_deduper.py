@@ -0,0 +1,193 @@
+#!/usr/local/bin/python3
+
+import importlib.util
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+from contextlib import redirect_stdout
+
+from pymarc import Field, MARCReader, Record
+
+spec = importlib.util.spec_from_file_location('deduper', os.path.join(os.path.dirname(__file__), 'tools', 'deduper.py'))
+deduper = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(deduper)
+
+
+def get_record(control_number=None, isbn=None, title=None, url=None):
+    record = Record(force_utf8=True)
+    if control_number:
+        record.add_field(Field(tag='001', data=control_number))
+    if isbn:
+        record.add_field(Field(tag='020', indicators=[' ', ' '], subfields=['a', isbn]))
+    if title:
+        record.add_field(Field(tag='245', indicators=['0', '0'], subfields=['a', title]))
+    if url:
+        record.add_field(Field(tag='856', indicators=['4', '0'], subfields=['u', url]))
+    return record
+
+
+class DeduperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry_name = os.path.join(self.directory, 'registry.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, records, junk=b''):
+        with open(self.path(name), 'wb') as fp:
+            for record in records:
+                fp.write(record.as_marc())
+            fp.write(junk)
+        return self.path(name)
+
+    def read(self, name):
+        """
+        :return: list of the 001s of the records of an output file (None for a record
+                 without one), or None if there is no such file.
+        """
+        if not os.path.exists(self.path(name)):
+            return None
+        with open(self.path(name), 'rb') as fp:
+            return [record['001'].value() if record['001'] else None for record in MARCReader(fp)]
+
+    def dedupe(self, name, keys=deduper.KEYS, registry_name=None):
+        registry = deduper.Registry(registry_name or self.registry_name)
+        try:
+            with redirect_stdout(io.StringIO()) as out:
+                deduper.dedupe(self.path(name), keys, registry)
+        finally:
+            registry.close()
+        return out.getvalue()
+
+    def registry_size(self):
+        registry = deduper.Registry(self.registry_name)
+        try:
+            return len(registry)
+        finally:
+            registry.close()
+
+    def test_key_values(self):
+        record = deduper.rawmarc.RawRecord(get_record(
+            ' ebc123 ', '0-306-40615-2 (pbk.)', 'The history of coffee /',
+            'http://proxy.example.ca/login?url=https://www.jstor.org/stable/10.2307/j.ctt1').as_marc())
+        self.assertEqual(deduper.key_values(record, '001'), {'ebc123'})
+        self.assertEqual(deduper.key_values(record, '020'), {'9780306406157'})
+        self.assertEqual(deduper.key_values(record, '035'), set())
+        self.assertEqual(deduper.key_values(record, '245'), {'history coffee'})
+        self.assertEqual(deduper.key_values(record, '856'), {'jstor org stable 10 2307 j ctt1'})
+
+    def test_dupes_unsure_and_deduped(self):
+        self.write('a.mrc', [
+            get_record('1', '9780306406157', 'A history of coffee', 'https://example.com/1'),
+            get_record('2', '9780000000002', 'Tea', 'https://example.com/2'),
+            # The same record again, in other spellings.
+            get_record('1', '0306406152', 'The History of Coffee.', 'http://www.example.com/1/'),
+            # The same title and URL as record 2, but another 001 and ISBN.
+            get_record('3', '9780000000003', 'Tea', 'https://example.com/2'),
+            # Nothing to tell it by.
+            get_record(title='The'),
+        ])
+        out = self.dedupe('a.mrc')
+        self.assertEqual(self.read('a-deduped.mrc'), ['1', '2', None])
+        self.assertEqual(self.read('a-dupes.mrc'), ['1'])
+        self.assertEqual(self.read('a-unsure.mrc'), ['3'])
+        self.assertIn("record 4, 1 of its 1 856 seen before, 0 of its 1 001 seen before, "
+                      "0 of its 1 020 seen before", out)
+        self.assertIn("Deduped : 3 records", out)
+
+    def test_same_title_other_book(self):
+        self.write('a.mrc', [
+            get_record('1', '9780306406157', 'Coffee'),
+            get_record('2', '9780000000002', 'Coffee'),
+            # Only told by its title.
+            get_record(title='Coffee'),
+            get_record(title='Tea'),
+        ])
+        self.dedupe('a.mrc')
+        self.assertEqual(self.read('a-deduped.mrc'), ['1', '2', None])
+        self.assertEqual(self.read('a-dupes.mrc'), [None])
+        self.assertIsNone(self.read('a-unsure.mrc'))
+
+    def test_default_key(self):
+        with unittest.mock.patch('sys.argv', ['deduper.py', 'a.mrc']):
+            self.assertEqual(deduper.parse_cmd_line(), (['856'], None, ['a.mrc']))
+
+    def test_output_files_only_when_needed(self):
+        self.write('a.mrc', [get_record('1'), get_record('2')])
+        self.dedupe('a.mrc')
+        self.assertEqual(self.read('a-deduped.mrc'), ['1', '2'])
+        self.assertIsNone(self.read('a-dupes.mrc'))
+        self.assertIsNone(self.read('a-unsure.mrc'))
+
+    def test_records_passed_through(self):
+        record = get_record('1', '9780306406157', 'Caf\u00e9', 'https://example.com/1')
+        record.leader = record.leader[:9] + ' ' + record.leader[10:]
+        self.write('a.mrc', [record])
+        self.dedupe('a.mrc', ['856'])
+        with open(self.path('a.mrc'), 'rb') as fp:
+            expected = fp.read()
+        with open(self.path('a-deduped.mrc'), 'rb') as fp:
+            self.assertEqual(fp.read(), expected)
+
+    def test_single_key(self):
+        records = [
+            get_record('1', '9780306406157', 'Coffee', 'https://example.com/1'),
+            get_record('2', '9780306406157', 'Coffee', 'https://example.com/2'),
+        ]
+        self.write('a.mrc', records)
+        self.dedupe('a.mrc', ['020'], os.path.join(self.directory, 'isbn.sqlite'))
+        self.assertEqual(self.read('a-dupes.mrc'), ['2'])
+        self.assertIsNone(self.read('a-unsure.mrc'))
+
+        self.dedupe('a.mrc', ['020', '245'], os.path.join(self.directory, 'isbn-title.sqlite'))
+        self.assertEqual(self.read('a-dupes.mrc'), ['2'])
+
+        self.dedupe('a.mrc')
+        self.assertIsNone(self.read('a-dupes.mrc'))
+        self.assertEqual(self.read('a-unsure.mrc'), ['2'])
+
+    def test_registry_across_files_and_runs(self):
+        self.write('a.mrc', [get_record('1', url='https://example.com/1')])
+        self.write('b.mrc', [get_record('1', url='https://example.com/1'), get_record('2', url='https://example.com/2')])
+        registry = deduper.Registry(self.registry_name)
+        try:
+            with redirect_stdout(io.StringIO()):
+                deduper.dedupe(self.path('a.mrc'), deduper.KEYS, registry)
+                deduper.dedupe(self.path('b.mrc'), deduper.KEYS, registry)
+        finally:
+            registry.close()
+        self.assertEqual(self.read('b-dupes.mrc'), ['1'])
+        self.assertEqual(self.read('b-deduped.mrc'), ['2'])
+        self.assertEqual(self.registry_size(), 4)
+
+        # A later run, with the same registry.
+        self.write('c.mrc', [get_record('2', url='https://example.com/2'), get_record('3', url='https://example.com/3')])
+        self.dedupe('c.mrc')
+        self.assertEqual(self.read('c-dupes.mrc'), ['2'])
+        self.assertEqual(self.read('c-deduped.mrc'), ['3'])
+        self.assertEqual(self.registry_size(), 6)
+
+    def test_rollback_when_file_fails(self):
+        self.write('a.mrc', [get_record('1')])
+        self.dedupe('a.mrc')
+        self.write('b.mrc', [get_record('2'), get_record('3')], junk=b'junk')
+        with self.assertRaises(Exception):
+            self.dedupe('b.mrc')
+        self.assertEqual(self.registry_size(), 1)
+
+        # Once fixed, the file is deduped as if the failed run never happened.
+        self.write('b.mrc', [get_record('2'), get_record('3')])
+        self.dedupe('b.mrc')
+        self.assertEqual(self.read('b-deduped.mrc'), ['2', '3'])
+        self.assertEqual(self.registry_size(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
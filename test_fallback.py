@@ -0,0 +1,74 @@
+#!/usr/local/bin/python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import marcaroni.fallback
+import marcaroni.ils
+import marcaroni.snapshot
+from marcaroni.fallback import describe, score
+
+DESCRIPTIONS = [
+    ('10', '1', 'A history of coffee', 'Smith, John', '2003'),
+    ('11', '58', 'The history of coffee : from Ethiopia to Europe', 'Smith, J.', 'c2004.'),
+    ('12', '1', 'A history of tea', 'Jones, Mary', '2003'),
+    ('13', '71', 'Coffee', 'Brown, Anne', '1999'),
+]
+
+
+class FallbackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'bib-data.snap')
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        builder.add(('9781234567897', '10', '1', '020', 'a'))
+        for row in DESCRIPTIONS:
+            builder.add_description(row)
+        builder.write(self.file_name)
+        self.eg_records = marcaroni.snapshot.SnapshotBibData()
+        self.eg_records.load_from_file(self.file_name, '020')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_score(self):
+        self.assertEqual(score(describe('History of coffee', 'Smith, John', '2003'),
+                               describe('The history of coffee.', 'SMITH, J.', '[2004]')), 1.0)
+        self.assertLess(score(describe('History of coffee', 'Smith'), describe('History of coffee', 'Jones')), 0.9)
+        self.assertLess(score(describe('History of coffee', '', '1950'), describe('History of coffee', '', '2003')),
+                        0.9)
+        self.assertEqual(score(describe('History of coffee'), describe('History of tea')), 0.5)
+        self.assertEqual(score(describe(''), describe('')), 0.0)
+
+    def test_one_word_titles_need_the_author(self):
+        self.assertEqual(score(describe('Coffee'), describe('Coffee')), 0.0)
+        self.assertEqual(score(describe('Coffee', 'Brown'), describe('Coffee', 'Brown')), 1.0)
+
+    def test_candidates_share_the_most_words(self):
+        titles = self.eg_records.titles
+        positions = marcaroni.fallback.candidates(titles, describe('History of coffee'), 2)
+        self.assertEqual(sorted(titles.record(position).id for position in positions), ['10', '11'])
+        self.assertEqual(marcaroni.fallback.candidates(titles, describe('Nothing like it')), [])
+
+    def test_match_titles(self):
+        matches = self.eg_records.match_titles([describe('History of coffee', 'Smith, John', '2003'),
+                                                describe('History of tea', 'Smith, John', '1950'),
+                                                describe('Coffee', 'Brown, Anne')], 0.9)
+        self.assertEqual(matches, [{marcaroni.ils.Record('10', '1')},
+                                   set(),
+                                   {marcaroni.ils.Record('13', '71')}])
+
+    def test_candidates_skip_common_words(self):
+        old_max_postings = marcaroni.fallback.MAX_POSTINGS
+        marcaroni.fallback.MAX_POSTINGS = 2
+        try:
+            positions = marcaroni.fallback.candidates(self.eg_records.titles, describe('History of tea'))
+        finally:
+            marcaroni.fallback.MAX_POSTINGS = old_max_postings
+        self.assertEqual([self.eg_records.titles.record(position).id for position in positions], ['12'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/local/bin/python3
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import marcaroni.ils
+import marcaroni.live
+
+
+class CompactILSBibDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'bib-data.txt')
+        with open(self.file_name, 'w') as fp:
+            fp.write('identifier,id,source,tag,subfield\n')
+            for i in range(1000):
+                fp.write('97800000%05d,%d,%d,020,a\n' % (i, i, i % 7))
+                fp.write('ocolc %d,%d,%d,035,a\n' % (i, i, i % 7))
+            fp.write('9780000000042,5000,58,020,z\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_match(self):
+        eg_records = marcaroni.ils.CompactILSBibData()
+        eg_records.load_from_file(self.file_name, '020')
+        self.assertEqual(eg_records.match(['9780000000042', 'ocolc 42', 'missing']), {
+            marcaroni.ils.Record('42', '0'),
+            marcaroni.ils.Record('5000', '58'),
+        })
+        self.assertIn('9780000000999', eg_records)
+        self.assertNotIn('ocolc 999', eg_records)
+
+    def test_match_many(self):
+        eg_records = marcaroni.ils.CompactILSBibData()
+        eg_records.load_from_file(self.file_name, '020')
+        identifier_sets = [{'9780000000042', 'missing'}, set(), {'9780000000042'}, {'9780000000043', 'missing'},
+                           {'missing'}]
+        self.assertEqual(eg_records.match_many(identifier_sets),
+                         [eg_records.match(identifiers) for identifiers in identifier_sets])
+        self.assertEqual(eg_records.match_many(identifier_sets)[2], {
+            marcaroni.ils.Record('42', '0'),
+            marcaroni.ils.Record('5000', '58'),
+        })
+        self.assertEqual(eg_records.match_many([]), [])
+
+    def test_all_tags(self):
+        eg_records = marcaroni.ils.CompactILSBibData()
+        eg_records.load_from_file(self.file_name)
+        self.assertEqual(eg_records.key_count, 2000)
+        self.assertEqual(eg_records.match(['ocolc 999']), {marcaroni.ils.Record('999', '5')})
+
+    def test_shared_memory(self):
+        eg_records = marcaroni.ils.CompactILSBibData()
+        eg_records.load_from_file(self.file_name, '020')
+        name = eg_records.publish()
+        try:
+            attached = marcaroni.ils.CompactILSBibData.attach(name)
+            self.assertEqual(attached.match(['9780000000042']), eg_records.match(['9780000000042']))
+            self.assertEqual(attached.key_count, 1000)
+            with self.assertRaises(TypeError):
+                attached.slots[0] = 0
+            attached.close()
+        finally:
+            eg_records.close()
+
+    def test_compact_from_dict_index(self):
+        eg_records = marcaroni.ils.ILSBibData()
+        eg_records.load_from_file(self.file_name, '035')
+        compact = eg_records.compact()
+        self.assertEqual(compact.match(['ocolc 42', 'ocolc 43']), eg_records.match(['ocolc 42', 'ocolc 43']))
+
+    def test_load_by_tag(self):
+        for compact in (False, True):
+            by_tag = marcaroni.ils.load_by_tag(self.file_name, ['020', '035'], compact)
+            self.assertEqual(sorted(by_tag), ['020', '035'])
+            self.assertEqual(by_tag['020'].key_count, 1000)
+            self.assertEqual(by_tag['020'].match(['9780000000042', 'ocolc 42']), {
+                marcaroni.ils.Record('42', '0'),
+                marcaroni.ils.Record('5000', '58'),
+            })
+            self.assertEqual(by_tag['035'].match(['9780000000042', 'ocolc 42']), {marcaroni.ils.Record('42', '0')})
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.copied = None
+        self.queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def copy_from(self, fp, table, sep, columns):
+        self.copied = fp.read()
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.cursor_ = FakeCursor(rows)
+
+    def cursor(self, name=None):
+        return self.cursor_
+
+    def rollback(self):
+        pass
+
+
+class LiveBibDataTestCase(unittest.TestCase):
+    def test_load_from_database(self):
+        conn = FakeConnection([('9780306406157', 10, 1), ('9780306406157', 11, 58)])
+        eg_records = marcaroni.live.LiveBibData()
+        eg_records.load_from_database(conn, {'9780306406157'}, '020')
+
+        self.assertEqual(sorted(conn.cursor_.copied.splitlines()),
+                         ['0306406152\t9780306406157', '9780306406157\t9780306406157'])
+        self.assertEqual(conn.cursor_.queries[-1][1], ('020',))
+        self.assertEqual(eg_records.match(['9780306406157']), {
+            marcaroni.ils.Record('10', '1'),
+            marcaroni.ils.Record('11', '58'),
+        })
+
+    def test_load_urls_from_database(self):
+        conn = FakeConnection([('http proxy example ca login url https www jstor org stable 10 2307 j ctt1', 10, 1),
+                               ('https www jstor org stable 10 2307 j ctt2', 11, 58)])
+        eg_records = marcaroni.live.LiveBibData()
+        eg_records.load_from_database(conn, {'jstor org stable 10 2307 j ctt1'}, '856')
+
+        self.assertEqual(conn.cursor_.copied, 'ctt1\n')
+        self.assertEqual(conn.cursor_.queries[-1], (marcaroni.live._URL_QUERY, None))
+        self.assertEqual(eg_records.match(['jstor org stable 10 2307 j ctt1']), {marcaroni.ils.Record('10', '1')})
+        self.assertEqual(eg_records.match(['jstor org stable 10 2307 j ctt2']), set())
+
+    def test_create_indexes(self):
+        conn = FakeConnection([])
+        with redirect_stdout(io.StringIO()):
+            marcaroni.live.create_indexes(conn)
+        self.assertTrue(conn.autocommit)
+        self.assertEqual([query for query, params in conn.cursor_.queries],
+                         [marcaroni.live.index_sql('020'), marcaroni.live.index_sql('035')])
+        # The index is on the expression the match query joins on, for the rows it reads.
+        index = marcaroni.live.index_sql('035')
+        self.assertIn("WHERE tag = '035' AND (subfield = 'a' OR subfield = 'z')", index)
+        self.assertIn(marcaroni.live.SPELLING_SQL['035'].replace('rfr.value', 'value'), index)
+        self.assertNotIn('rfr.', index)
+        self.assertIn("AND rfr.tag = %s AND (rfr.subfield = 'a' OR rfr.subfield = 'z')", marcaroni.live._MATCH_QUERY)
+
+    def test_url_word(self):
+        self.assertEqual(marcaroni.live._url_word('jstor org stable 10 2307 j ctt1'), 'ctt1')
+        self.assertEqual(marcaroni.live._url_word('ebookcentral proquest com docid 1234567'), '1234567')
+        self.assertEqual(marcaroni.live._url_word('example com books catalogue'), 'catalogue')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/local/bin/python3
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import marcaroni.metrics
+import marcaroni.writer
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = marcaroni.metrics.Metrics('test', 'parse')
+
+    def test_nested_stages_are_exclusive(self):
+        with self.metrics.stage('rules'):
+            with self.metrics.stage('write'):
+                time.sleep(0.05)
+        rules = self.metrics.stages['rules']
+        write = self.metrics.stages['write']
+        self.assertEqual(rules.calls, 1)
+        self.assertEqual(write.calls, 1)
+        self.assertGreaterEqual(write.wall, 0.05)
+        self.assertLess(rules.wall, 0.04)
+        self.assertEqual(self.metrics._stack, [])
+
+    def test_stages_on_other_threads(self):
+        def run():
+            with self.metrics.stage('write_io'):
+                time.sleep(0.05)
+        with self.metrics.stage('rules'):
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        self.assertEqual(self.metrics.background_stages, {'write_io'})
+        self.assertGreaterEqual(self.metrics.stages['write_io'].wall, 0.05)
+        self.assertGreaterEqual(self.metrics.stages['rules'].wall, 0.05)
+        self.assertLess(self.metrics.stages['write_io'].cpu, 0.04)
+        self.assertIn('write_io: on other threads, alongside the rest', self.metrics.report())
+
+    def test_writer_io(self):
+        directory = tempfile.mkdtemp()
+        metrics = marcaroni.metrics.enable('test')
+        try:
+            writer = marcaroni.writer.Writer(batch_size=2)
+            partition = writer.partition(os.path.join(directory, 'out.txt'), 'text')
+            for i in range(5):
+                writer.write(partition, '%d\n' % (i,))
+            writer.close()
+        finally:
+            marcaroni.metrics._metrics = None
+            shutil.rmtree(directory)
+        self.assertEqual(metrics.stages['write_io'].items, 5)
+        self.assertEqual(metrics.background_stages, {'write_io'})
+
+    def test_take_and_merge(self):
+        for i in range(3):
+            with self.metrics.stage('parse'):
+                pass
+        with self.metrics.stage('lookup', 3):
+            pass
+        stages = self.metrics.take()
+        self.assertEqual(self.metrics.stages, {})
+        self.assertEqual(stages['parse']['items'], 3)
+
+        parent = marcaroni.metrics.Metrics('test', 'parse')
+        parent.merge(stages)
+        parent.merge(stages)
+        self.assertEqual(parent.stages['parse'].calls, 6)
+        self.assertEqual(parent.stages['lookup'].items, 6)
+        self.assertEqual(sum(parent.stages['parse'].buckets), 6)
+        self.assertEqual(parent.as_dict()['records'], 6)
+
+    def test_disabled(self):
+        self.assertIsNone(marcaroni.metrics.current())
+        with marcaroni.metrics.stage('parse'):
+            pass
+        self.assertEqual(list(marcaroni.metrics.timed([1, 2], 'parse')), [1, 2])
+
+    def test_prometheus(self):
+        with self.metrics.stage('parse'):
+            pass
+        lines = self.metrics.prometheus().splitlines()
+        self.assertIn('# TYPE marcaroni_stage_call_seconds histogram', lines)
+        self.assertIn('marcaroni_stage_call_seconds_bucket{job="test",stage="parse",le="+Inf"} 1', lines)
+        self.assertIn('marcaroni_stage_items_total{job="test",stage="parse"} 1', lines)
+        self.assertIn('marcaroni_records_total{job="test"} 1', lines)
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with self.metrics.stage('parse'):
+                pass
+            self.metrics.write(os.path.join(directory, 'run.json'))
+            self.assertEqual(sorted(os.listdir(directory)), ['run.json', 'run.prom'])
+            with open(os.path.join(directory, 'run.json')) as fp:
+                data = json.load(fp)
+            self.assertEqual(data['records'], 1)
+            self.assertEqual(sorted(data['stages']), ['parse'])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
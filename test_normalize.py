@@ -0,0 +1,78 @@
+#!/usr/local/bin/python3
+
+import unittest
+
+from marcaroni.normalize import canonical_identifier, identifier_key, title_key, author_key, publication_year
+
+
+class NormalizeTestCase(unittest.TestCase):
+    def test_isbn_10_and_13_collapse(self):
+        for raw in ('9780306406157', '0306406152', '0-306-40615-2 (pbk.)', ' 978-0-306-40615-7,', '030640615x'):
+            self.assertEqual(canonical_identifier(raw, '020')[:12], '978030640615', raw)
+        self.assertEqual(canonical_identifier('0306406152', '020'), '9780306406157')
+        self.assertEqual(canonical_identifier('080442957X', '020'), '9780804429573')
+
+    def test_bad_isbn(self):
+        self.assertIsNone(canonical_identifier('12345', '020'))
+        self.assertIsNone(canonical_identifier('electronic bk.', '020'))
+
+    def test_oclc_prefixes(self):
+        for raw in ('(OCoLC)12345678', '(OCoLC)ocm12345678', 'ocm12345678', '(OCoLC)012345678',
+                    'ocolc ocn12345678', '(OCoLC) 12345678'):
+            self.assertEqual(canonical_identifier(raw, '035'), 'ocolc 12345678', raw)
+
+    def test_vendor_035(self):
+        self.assertEqual(canonical_identifier('(CaPaEBR)ebr10123456', '035'), 'capaebr ebr10123456')
+        self.assertEqual(canonical_identifier('capaebr ebr10123456', '035'), 'capaebr ebr10123456')
+        self.assertEqual(canonical_identifier('(MiAaPQ)EBC-1234567', '035'), 'miaapq ebc 1234567')
+        self.assertIsNone(canonical_identifier('(CaPaEBR)', '035'))
+
+    def test_url_proxy_prefix(self):
+        for raw in ('http://proxy.example.ca/login?url=https://www.jstor.org/stable/10.2307/j.ctt1',
+                    'http proxy example ca login url https www jstor org stable 10 2307 j ctt1',
+                    'https://login.proxy.example.edu/login?qurl=https%3A%2F%2Fwww.jstor.org%2Fstable%2F10.2307%2Fj.ctt1',
+                    'HTTP://JSTOR.ORG/stable/10.2307/j.ctt1/'):
+            self.assertEqual(canonical_identifier(raw, '856'), 'jstor org stable 10 2307 j ctt1', raw)
+
+    def test_url_item_keys(self):
+        for raw in ('https://ebookcentral.proquest.com/lib/uwo/detail.action?docID=1234567',
+                    'http://proxy.example.ca/login?url=https://ebookcentral.proquest.com/lib/other/reader.action?docID=1234567&ppg=5'):
+            self.assertEqual(canonical_identifier(raw, '856'), 'ebookcentral proquest com docid 1234567', raw)
+        for raw in ('http://search.ebscohost.com/login.aspx?direct=true&scope=site&db=nlebk&AN=123456',
+                    'https://web.b.ebscohost.com/ehost/detail?vid=0&db=nlebk&AN=123456'):
+            self.assertEqual(canonical_identifier(raw, '856'), 'ebscohost com db nlebk an 123456', raw)
+        self.assertEqual(canonical_identifier('http://dx.doi.org/10.1007/978-3-319-1', '856'), 'doi org 10 1007 978 3 319 1')
+        self.assertEqual(canonical_identifier('http://', '856'), None)
+
+    def test_url_tokens_are_their_own_tokens(self):
+        for raw in ('https://www.jstor.org/stable/10.2307/j.ctt1',
+                    'https://ebookcentral.proquest.com/lib/uwo/detail.action?docID=1234567',
+                    'https://search.ebscohost.com/login.aspx?direct=true&AN=123456',
+                    'http://dx.doi.org/10.1007/978-3-319-1'):
+            token = canonical_identifier(raw, '856')
+            self.assertEqual(canonical_identifier(token, '856'), token, raw)
+
+    def test_identifier_key(self):
+        self.assertEqual(identifier_key('9780306406157'), 9780306406157)
+        self.assertGreaterEqual(identifier_key('ocolc 12345678'), 1 << 63)
+        self.assertEqual(identifier_key('ocolc 12345678'), identifier_key('ocolc 12345678'))
+
+    def test_title_key(self):
+        self.assertEqual(title_key('The café : a history of coffee.'), 'cafe history coffee')
+        self.assertEqual(title_key('CAFE -- History of Coffee'), 'cafe history coffee')
+        self.assertEqual(title_key('The'), '')
+
+    def test_author_key(self):
+        self.assertEqual(author_key('Müller, Hans, 1950-'), 'muller')
+        self.assertEqual(author_key('United Nations.'), 'united nations')
+        self.assertEqual(author_key(''), '')
+
+    def test_publication_year(self):
+        self.assertEqual(publication_year('c2015.'), 2015)
+        self.assertEqual(publication_year('[2019], c2018'), 2019)
+        self.assertEqual(publication_year('[19--]'), 0)
+        self.assertEqual(publication_year('12345'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
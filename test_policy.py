@@ -0,0 +1,56 @@
+#!/usr/local/bin/python3
+
+import os
+import random
+import unittest
+
+import marcaroni.ils
+import marcaroni.output
+import marcaroni.policy
+import marcaroni.sources
+import bibmatcher
+
+
+class MatchPolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.policy = marcaroni.policy.MatchPolicy()
+        self.policy.load_from_file()
+        self.bibsources = marcaroni.sources.BibSourceRegistry()
+        self.bibsources.load_from_file(os.path.join(os.path.dirname(__file__), 'conf', 'bib_sources.csv'))
+
+    def test_load_from_file(self):
+        self.assertEqual(self.policy.match_field('91'), '035')
+        self.assertEqual(self.policy.match_field('50'), '020')
+        self.assertIn('81', self.policy.odd_bib_sources)
+        self.assertEqual(self.policy.excluded_publishers['1'], ['Nova Science'])
+        self.assertEqual(self.policy.rules(bibmatcher.RULES_BY_NAME)[-1], bibmatcher.handle_same_platform_matches)
+        self.assertFalse(self.policy.fallback)
+        self.assertEqual(self.policy.fallback_threshold, 0.9)
+
+    def test_unknown_rule(self):
+        self.policy.rule_names.append('no_such_rule')
+        with self.assertRaises(marcaroni.policy.PolicyError):
+            self.policy.rules(bibmatcher.RULES_BY_NAME)
+
+    def test_decision_table_agrees_with_rule_chain(self):
+        rules = self.policy.rules(bibmatcher.RULES_BY_NAME) + [bibmatcher.ambiguous_if_matches_on_ambiguous_bibsource]
+        source_ids = sorted(self.bibsources.bib_source_by_id)
+        generator = random.Random(1)
+        for bib_source_id in ('11', '50', '1'):
+            bib_source_of_input = self.bibsources.get_bib_source_by_id(bib_source_id)
+            decisions = bibmatcher.decision_table(bib_source_of_input, self.bibsources, self.policy)
+            decisions.rules = rules
+            for i in range(300):
+                matches = {marcaroni.ils.Record(str(n), generator.choice(source_ids))
+                           for n in range(generator.randint(1, 4))}
+                vectors = {match: decisions.vector(match.source) for match in matches}
+                expected = None
+                for rule in rules:
+                    if rule(None, bib_source_of_input, vectors, marcaroni.policy._NoOutput()):
+                        expected = rule
+                        break
+                self.assertIs(decisions.rule(matches), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/local/bin/python3
+
+import io
+import mmap
+import os
+import tempfile
+import unittest
+
+from pymarc import Record, Field
+
+import marcaroni.compress
+import marcaroni.rawmarc
+
+
+class RawMarcTestCase(unittest.TestCase):
+    @staticmethod
+    def get_marc_record(i):
+        record = Record()
+        record.leader = record.leader[0:9] + 'a' + record.leader[10:]
+        record.add_field(Field(tag='001', data='rec%d' % (i,)))
+        record.add_field(Field(tag='020', indicators=[' ', ' '], subfields=['a', '978000000%04d' % (i,)]))
+        record.add_field(Field(tag='245', indicators=['0', '0'], subfields=['a', 'Tïtle %d' % (i,)]))
+        return record
+
+    def test_split_records(self):
+        records = [self.get_marc_record(i).as_marc() for i in range(3)]
+        self.assertEqual(list(marcaroni.rawmarc.split_records(b''.join(records) + b'\n')), records)
+
+    def test_split_records_bad_length(self):
+        records = [self.get_marc_record(i).as_marc() for i in range(3)]
+        records[1] = b'99999' + records[1][5:]
+        self.assertEqual(list(marcaroni.rawmarc.split_records(b''.join(records))), records)
+
+    def test_read_raw_records_from_stream(self):
+        data = self.get_marc_record(0).as_marc()
+        self.assertEqual(list(marcaroni.rawmarc.read_raw_records(io.BytesIO(data))), [data])
+
+    def test_split_records_bad_last_record(self):
+        records = [self.get_marc_record(i).as_marc() for i in range(2)]
+        records[1] = b'99999' + records[1][5:-1]
+        self.assertEqual(list(marcaroni.rawmarc.split_records(b''.join(records) + b'\n')),
+                         [records[0], records[1] + b'\n'])
+        self.assertEqual(list(marcaroni.rawmarc.split_records(records[0] + b'\n  \n')), [records[0]])
+
+    def test_read_raw_records_unmaps_file(self):
+        records = [self.get_marc_record(i).as_marc() for i in range(3)]
+        maps = []
+
+        class RecordedMap(mmap.mmap):
+            def __init__(self, *args, **kwargs):
+                maps.append(self)
+
+        original_mmap = marcaroni.rawmarc.mmap.mmap
+        marcaroni.rawmarc.mmap.mmap = RecordedMap
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                file_name = os.path.join(directory, 'in.mrc')
+                with open(file_name, 'wb') as fp:
+                    fp.write(b''.join(records))
+                with open(file_name, 'rb') as fp:
+                    self.assertEqual(list(marcaroni.rawmarc.read_raw_records(fp)), records)
+                with open(file_name, 'rb') as fp:
+                    raw_records = marcaroni.rawmarc.read_raw_records(fp)
+                    first = next(raw_records)
+                    raw_records.close()
+        finally:
+            marcaroni.rawmarc.mmap.mmap = original_mmap
+        self.assertEqual(len(maps), 2)
+        self.assertTrue(all(buf.closed for buf in maps))
+        self.assertEqual(first, records[0])
+        self.assertIs(type(first), bytes)
+
+    def test_read_raw_records_from_compressed_file(self):
+        records = [self.get_marc_record(i).as_marc() for i in range(20)]
+        records[5] = b'99999' + records[5][5:]
+        data = b''.join(records) + b'\n'
+        original_read_size = marcaroni.rawmarc.READ_SIZE
+        marcaroni.rawmarc.READ_SIZE = 7
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                file_name = os.path.join(directory, 'in.mrc.gz')
+                with marcaroni.compress.open_file(file_name, 'wb') as fp:
+                    fp.write(data)
+                for start in (0, len(b''.join(records[:3]))):
+                    with marcaroni.compress.open_input(file_name) as fp:
+                        self.assertEqual(list(marcaroni.rawmarc.read_raw_records(fp, start)),
+                                         list(marcaroni.rawmarc.split_records(data, start)))
+        finally:
+            marcaroni.rawmarc.READ_SIZE = original_read_size
+
+    def test_unchanged_record_is_passed_through(self):
+        data = self.get_marc_record(1).as_marc()
+        record = marcaroni.rawmarc.RawRecord(data)
+        self.assertEqual(record['020']['a'], '9780000000001')
+        self.assertIs(record.as_marc(), data)
+
+    def test_changes_match_pymarc(self):
+        expected = self.get_marc_record(2)
+        record = marcaroni.rawmarc.RawRecord(expected.as_marc())
+        for r in (expected, record):
+            r.leader = r.leader[0:5] + 'c' + r.leader[6:]
+            r.add_field(Field(tag='901', indicators=[' ', ' '], subfields=['c', '12345']))
+        self.assertEqual(record.as_marc(), expected.as_marc())
+        self.assertEqual(record['901']['c'], '12345')
+
+    def test_too_long(self):
+        record = self.get_marc_record(4)
+        for i in range(19):
+            record.add_field(Field(tag='500', indicators=[' ', ' '], subfields=['a', 'x' * 5000]))
+        data = record.as_marc()
+        raw_record = marcaroni.rawmarc.RawRecord(data)
+        with self.assertRaisesRegex(marcaroni.rawmarc.RecordTooLong, 'field of 10005 bytes'):
+            raw_record.add_field(Field(tag='500', indicators=[' ', ' '], subfields=['a', 'x' * 10000]))
+        with self.assertRaisesRegex(marcaroni.rawmarc.RecordTooLong, 'make the record 10[0-9]{4} bytes'):
+            raw_record.add_field(Field(tag='500', indicators=[' ', ' '], subfields=['a', 'x' * 5000]))
+        self.assertIs(raw_record.as_marc(), data)
+        raw_record.add_field(Field(tag='901', indicators=[' ', ' '], subfields=['c', '12345']))
+        self.assertEqual(int(raw_record.as_marc()[:5]), len(raw_record.as_marc()))
+
+    def test_fields_are_decoded_on_demand(self):
+        record = marcaroni.rawmarc.RawRecord(self.get_marc_record(3).as_marc())
+        self.assertEqual(record['245']['a'], 'Tïtle 3')
+        self.assertIsNone(record['856'])
+        self.assertEqual([field.tag for field in record.get_fields('245', '001')], ['001', '245'])
+        self.assertEqual(sum(field is not None for field in record._fields), 2)
+        self.assertEqual(record.title(), 'Tïtle 3')
+        self.assertEqual([str(field) for field in record.record.get_fields()],
+                         [str(field) for field in self.get_marc_record(3).get_fields()])
+
+
+if __name__ == '__main__':
+    unittest.main()
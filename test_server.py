@@ -0,0 +1,143 @@
+#!/usr/local/bin/python3
+
+import gc
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+import marcaroni.ils
+import marcaroni.server
+
+
+class MatchServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'bib-data.txt')
+        self.write_bib_data('9780306406157,10,1,020,a\n')
+        self.service = marcaroni.server.MatchService(self.file_name)
+        self.socket_path = os.path.join(self.directory, 'marcaroni.sock')
+        self.server = marcaroni.server.MatchServer(self.socket_path, self.service)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def write_bib_data(self, rows):
+        temporary_name = self.file_name + '.tmp'
+        with open(temporary_name, 'w') as fp:
+            fp.write('identifier,id,source,tag,subfield\n')
+            fp.write(rows)
+        os.replace(temporary_name, self.file_name)
+
+    def test_match_many(self):
+        eg_records = marcaroni.server.RemoteBibData(self.socket_path, '020')
+        try:
+            self.assertEqual(eg_records.match_many([{'9780306406157'}, {'missing'}]),
+                             [{marcaroni.ils.Record('10', '1')}, set()])
+            self.assertEqual(eg_records.status()['match_fields'], ['020'])
+        finally:
+            eg_records.close()
+
+    def test_hot_swap(self):
+        eg_records = marcaroni.server.RemoteBibData(self.socket_path, '020')
+        try:
+            self.assertEqual(eg_records.match({'9780306406157'}), {marcaroni.ils.Record('10', '1')})
+            self.assertFalse(self.service.refresh())
+            self.write_bib_data('9780306406157,11,58,020,a\n')
+            self.assertTrue(self.service.refresh())
+            self.assertEqual(eg_records.match({'9780306406157'}), {marcaroni.ils.Record('11', '58')})
+        finally:
+            eg_records.close()
+
+    def test_reloads_are_not_frozen(self):
+        freeze_count = gc.get_freeze_count()
+        for i in range(3):
+            self.write_bib_data('9780306406157,%d,1,020,a\n' % (i,))
+            self.assertTrue(self.service.refresh())
+            self.service.generation.bib_data('020')
+        self.assertEqual(gc.get_freeze_count(), freeze_count)
+        self.assertTrue(gc.isenabled())
+
+    def test_bad_file_keeps_old_data(self):
+        eg_records = marcaroni.server.RemoteBibData(self.socket_path, '020')
+        watcher = threading.Thread(target=self.service.watch, args=(0.01,), daemon=True)
+        try:
+            self.assertEqual(eg_records.match({'9780306406157'}), {marcaroni.ils.Record('10', '1')})
+            with redirect_stdout(io.StringIO()) as out, redirect_stderr(io.StringIO()):
+                watcher.start()
+                self.write_bib_data('')
+                while 'Could not load' not in out.getvalue():
+                    time.sleep(0.01)
+                self.assertTrue(watcher.is_alive())
+                self.assertEqual(eg_records.match({'9780306406157'}), {marcaroni.ils.Record('10', '1')})
+
+                # A match field the file has no rows for gets an error; the connection stays up.
+                other_records = marcaroni.server.RemoteBibData(self.socket_path, '035')
+                with self.assertRaisesRegex(marcaroni.server.ServerError, 'Could not load 035'):
+                    other_records.match({'ocolc 1'})
+                self.assertEqual(other_records.status()['match_fields'], ['020'])
+                other_records.close()
+                self.write_bib_data('9780306406157,11,58,020,a\n')
+                while 'Swapped in' not in out.getvalue():
+                    time.sleep(0.01)
+            self.assertEqual(eg_records.match({'9780306406157'}), {marcaroni.ils.Record('11', '58')})
+        finally:
+            self.service.stop()
+            eg_records.close()
+
+    def test_socket_in_use(self):
+        with self.assertRaisesRegex(marcaroni.server.ServerError, 'already listening'):
+            marcaroni.server.MatchServer(self.socket_path, self.service)
+        eg_records = marcaroni.server.RemoteBibData(self.socket_path, '020')
+        self.assertEqual(eg_records.status()['match_fields'], [])
+        eg_records.close()
+
+    def test_stale_socket(self):
+        stale_path = os.path.join(self.directory, 'stale.sock')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(stale_path)
+        stale.close()
+        server = marcaroni.server.MatchServer(stale_path, self.service)
+        server.server_close()
+
+    def test_request_too_long(self):
+        old_max_request_size = marcaroni.server.MAX_REQUEST_SIZE
+        marcaroni.server.MAX_REQUEST_SIZE = 100
+        eg_records = marcaroni.server.RemoteBibData(self.socket_path, '020')
+        try:
+            with self.assertRaisesRegex(marcaroni.server.ServerError, 'Request longer than 100 bytes'):
+                eg_records.match_many([{'%013d' % (i,)} for i in range(100000)])
+            with self.assertRaisesRegex(marcaroni.server.ServerError, 'closed the connection'):
+                eg_records.status()
+        finally:
+            marcaroni.server.MAX_REQUEST_SIZE = old_max_request_size
+            eg_records.close()
+
+    def test_long_response(self):
+        self.write_bib_data(''.join('9780306406157,%d,1,020,a\n' % (i,) for i in range(1000)))
+        self.assertTrue(self.service.refresh())
+        old_max_request_size = marcaroni.server.MAX_REQUEST_SIZE
+        marcaroni.server.MAX_REQUEST_SIZE = 100
+        eg_records = marcaroni.server.RemoteBibData(self.socket_path, '020')
+        try:
+            self.assertEqual(len(eg_records.match({'9780306406157'})), 1000)
+        finally:
+            marcaroni.server.MAX_REQUEST_SIZE = old_max_request_size
+            eg_records.close()
+
+    def test_server_not_running(self):
+        with self.assertRaises(OSError):
+            marcaroni.server.RemoteBibData(os.path.join(self.directory, 'missing.sock'), '020')
+
+
+if __name__ == '__main__':
+    unittest.main()
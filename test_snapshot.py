@@ -0,0 +1,216 @@
+#!/usr/local/bin/python3
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import marcaroni.fallback
+import marcaroni.ils
+import marcaroni.snapshot
+
+ROWS = [
+    ('9781234567897', '10', '1', '020', 'a'),
+    ('9781234567897', '11', '58', '020', 'z'),
+    ('9781234567897', '10', '1', '020', 'z'),
+    ('0123456789', '12', '1', '020', 'a'),
+    ('ocolc 12345678', '10', '1', '035', 'a'),
+    ('ebr 99999999', '13', '71', '035', 'a'),
+]
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'bib-data.snap')
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        for row in ROWS:
+            builder.add(row)
+        builder.write(self.file_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, match_field=None):
+        eg_records = marcaroni.snapshot.SnapshotBibData()
+        eg_records.load_from_file(self.file_name, match_field)
+        return eg_records
+
+    def test_is_snapshot(self):
+        self.assertTrue(marcaroni.snapshot.is_snapshot(self.file_name))
+        csv_file_name = os.path.join(self.directory, 'bib-data.txt')
+        with open(csv_file_name, 'w') as fp:
+            fp.write('identifier,id,source,tag,subfield\n')
+        self.assertFalse(marcaroni.snapshot.is_snapshot(csv_file_name))
+
+    def test_match_collapses_duplicate_rows(self):
+        self.assertEqual(self.load('020').match(['9781234567897']), {
+            marcaroni.ils.Record('10', '1'),
+            marcaroni.ils.Record('11', '58'),
+        })
+
+    def test_match_respects_match_field(self):
+        eg_records = self.load('020')
+        self.assertEqual(eg_records.match(['ocolc 12345678']), set())
+        self.assertNotIn('ocolc 12345678', eg_records)
+        self.assertIn('0123456789', eg_records)
+
+    def test_match_all_tags(self):
+        self.assertEqual(self.load().match(['ocolc 12345678', '0123456789', 'missing']), {
+            marcaroni.ils.Record('10', '1'),
+            marcaroni.ils.Record('12', '1'),
+        })
+
+    def test_match_many(self):
+        eg_records = self.load()
+        batch = [{'9781234567897', 'ocolc 12345678'}, set(), {'missing', 'ebr 99999999'}, {'0123456789'}]
+        self.assertEqual(eg_records.match_many(batch), [eg_records.match(identifiers) for identifiers in batch])
+
+    def test_find_sorted(self):
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        for i in range(0, 2000, 2):
+            builder.add(('97800000%05d' % (i,), str(i), '1', '020', 'a'))
+        builder.write(self.file_name)
+        index = self.load().indexes[0]
+        keys = [b'000', b'9780000000000', b'9780000000001', b'9780000001998', b'9780000001999', b'999']
+        self.assertEqual(index.find_sorted(keys), [index.find(key) for key in keys])
+        self.assertEqual(index.find_sorted(keys)[3], 999)
+
+    def test_merge_replaces_changed_records(self):
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        builder.merge(marcaroni.snapshot.Snapshot(self.file_name), {10, 13})
+        builder.add(('9781234567897', '10', '58', '020', 'a'))
+        builder.meta['watermark'] = {'max_id': 13, 'edit_date': None}
+        builder.write(self.file_name)
+
+        eg_records = self.load()
+        self.assertEqual(eg_records.snapshot.meta['watermark']['max_id'], 13)
+        self.assertEqual(eg_records.match(['9781234567897', 'ocolc 12345678', 'ebr 99999999']), {
+            marcaroni.ils.Record('10', '58'),
+            marcaroni.ils.Record('11', '58'),
+        })
+        self.assertIn('0123456789', eg_records)
+
+    def test_record_index(self):
+        records = self.load().records
+        self.assertEqual(len(records), 4)
+        self.assertIn(10, records)
+        self.assertNotIn('14', records)
+        self.assertNotIn(100000, records)
+        self.assertEqual(records.get('10'), marcaroni.snapshot.BibRecord('10', '1', [
+            ('020', '9781234567897'),
+            ('035', 'ocolc 12345678'),
+        ]))
+        self.assertEqual(records.get(13).source, '71')
+        self.assertIsNone(records.get(1))
+
+    def test_record_index_sparse_ids(self):
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        builder.add(('9781234567897', '5000000', '1', '020', 'a'))
+        builder.add(('ocolc 1', '7', '58', '035', 'a'))
+        builder.write(self.file_name)
+        records = self.load().records
+        self.assertIsNone(records.slots)
+        self.assertEqual(records.get(5000000).identifiers, [('020', '9781234567897')])
+        self.assertEqual(records.get(7).source, '58')
+        self.assertIsNone(records.get(8))
+
+    def test_compressed_snapshot(self):
+        file_name = os.path.join(self.directory, 'bib-data.snap.xz')
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        for row in ROWS:
+            builder.add(row)
+        builder.write(file_name)
+        self.assertTrue(marcaroni.snapshot.is_snapshot(file_name))
+        eg_records = marcaroni.snapshot.SnapshotBibData()
+        eg_records.load_from_file(file_name, '020')
+        self.assertEqual(eg_records.match_many([{'9781234567897'}]), self.load('020').match_many([{'9781234567897'}]))
+
+    def test_titles(self):
+        self.assertIsNone(self.load().titles)
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        for row in ROWS:
+            builder.add(row)
+        builder.add_description(('10', '1', 'A history of coffee', 'Smith, John', 'c2003.'))
+        builder.add_description(('12', '1', 'Tea', '', ''))
+        builder.write(self.file_name)
+        titles = self.load('020').titles
+        self.assertEqual(len(titles), 2)
+        self.assertEqual(list(titles.postings('coffee')), [0])
+        self.assertEqual(list(titles.postings('missing')), [])
+        self.assertEqual(titles.description(0), marcaroni.fallback.Description('history coffee', 'smith', 2003))
+        self.assertEqual(titles.description(1), marcaroni.fallback.Description('tea', '', 0))
+        self.assertEqual(titles.record(1), marcaroni.ils.Record('12', '1'))
+
+    def test_merge_keeps_titles(self):
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        for row in ROWS:
+            builder.add(row)
+        builder.add_description(('10', '1', 'A history of coffee', 'Smith, John', '2003'))
+        builder.add_description(('12', '1', 'Tea', '', ''))
+        builder.write(self.file_name)
+
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        builder.merge(marcaroni.snapshot.Snapshot(self.file_name), {10})
+        builder.add(('9781234567897', '10', '58', '020', 'a'))
+        builder.add_description(('10', '58', 'A history of tea', 'Smith, John', '2003'))
+        builder.write(self.file_name)
+        titles = self.load().titles
+        self.assertEqual(sorted((titles.record(position), titles.description(position).title)
+                                for position in range(len(titles))),
+                         [(marcaroni.ils.Record('10', '58'), 'history tea'), (marcaroni.ils.Record('12', '1'), 'tea')])
+        self.assertEqual(len(titles.postings('tea')), 2)
+
+    def test_merge_moves_title_postings(self):
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        for bib_id, title in (('10', 'Coffee'), ('12', 'Tea'), ('14', 'Coffee and tea'), ('16', 'Water')):
+            builder.add(('ocolc ' + bib_id, bib_id, '1', '035', 'a'))
+            builder.add_description((bib_id, '1', title, '', ''))
+        builder.write(self.file_name)
+
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        builder.merge(marcaroni.snapshot.Snapshot(self.file_name), {10, 14})
+        builder.add_description(('11', '2', 'Milk and coffee', '', ''))
+        builder.add_description(('14', '2', 'Water and tea', '', ''))
+        builder.add_description(('18', '2', 'Tea', '', ''))
+        builder.write(self.file_name)
+        titles = self.load().titles
+
+        def ids(word):
+            return [titles.record(position).id for position in titles.postings(word)]
+        self.assertEqual(ids('coffee'), ['11'])
+        self.assertEqual(ids('tea'), ['12', '14', '18'])
+        self.assertEqual(ids('water'), ['14', '16'])
+        self.assertEqual(ids('milk'), ['11'])
+        self.assertEqual(titles.record(titles.postings('milk')[0]).source, '2')
+        self.assertNotIn(10, self.load().records)
+
+    def test_rows_spilled_to_disk(self):
+        eg_records = self.load()
+        with unittest.mock.patch('marcaroni.snapshot.SORT_RUN_SIZE', 2):
+            builder = marcaroni.snapshot.SnapshotBuilder(self.directory)
+            for row in ROWS + ROWS[:2]:
+                builder.add(row)
+            builder.add_description(('10', '1', 'Coffee', '', ''))
+            builder.add_description(('12', '1', 'Tea', '', ''))
+            builder.add_description(('10', '1', 'A history of coffee', '', ''))
+            self.assertEqual(len(builder.rows.runs), 4)
+            file_name = os.path.join(self.directory, 'spilled.snap')
+            builder.write(file_name)
+        spilled = marcaroni.snapshot.SnapshotBibData()
+        spilled.load_from_file(file_name)
+        for identifier in set(row[0] for row in ROWS):
+            self.assertEqual(spilled.match([identifier]), eg_records.match([identifier]))
+        for bib_id in 10, 11, 12, 13:
+            self.assertEqual(spilled.records.get(bib_id), eg_records.records.get(bib_id))
+        self.assertEqual([spilled.titles.description(position).title for position in range(len(spilled.titles))],
+                         ['history coffee', 'tea'])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['bib-data.snap', 'spilled.snap'])
+
+    def test_no_temporary_file_left_behind(self):
+        self.assertEqual(os.listdir(self.directory), ['bib-data.snap'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/local/bin/python3
+
+import importlib.util
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import marcaroni.snapshot
+
+spec = importlib.util.spec_from_file_location('update_data', os.path.join(os.path.dirname(__file__), 'update-data.py'))
+update_data = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(update_data)
+
+WATERMARK = {'max_id': 12, 'edit_date': '2024-01-01T00:00:00'}
+
+
+class FakeExport:
+    """
+    Stands in for marcaroni.export in update-data.py, with the database rows given.
+    """
+    def __init__(self, changed_ids, rows, descriptions):
+        self.changed_ids = changed_ids
+        self.rows = rows
+        self.descriptions = descriptions
+        self.description_ids = []
+
+    def read_watermark(self, cur):
+        return {'max_id': 13, 'edit_date': '2024-02-01T00:00:00'}
+
+    def changed_record_ids(self, cur, watermark):
+        return set(self.changed_ids)
+
+    def export_rows(self, conn, record_ids=None):
+        return [row for row in self.rows if record_ids is None or int(row[1]) in record_ids]
+
+    def export_descriptions(self, conn, record_ids=None):
+        self.description_ids.append(record_ids)
+        return [row for row in self.descriptions if record_ids is None or int(row[0]) in record_ids]
+
+
+class DeltaExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'bib-data.snap')
+        self.real_export = update_data.export
+
+    def tearDown(self):
+        update_data.export = self.real_export
+        shutil.rmtree(self.directory)
+
+    def write_snapshot(self, titles):
+        builder = marcaroni.snapshot.SnapshotBuilder()
+        builder.add(('9781234567897', '10', '1', '020', 'a'))
+        builder.add(('0123456789', '12', '1', '020', 'a'))
+        if titles:
+            builder.add_description(('10', '1', 'A history of coffee', 'Smith, John', '2003'))
+            builder.add_description(('12', '1', 'A history of tea', '', ''))
+        builder.meta['watermark'] = WATERMARK
+        builder.write(self.file_name)
+
+    def delta_export(self, titles):
+        update_data.export = FakeExport({12}, [('9780306406157', '12', '1', '020', 'a')],
+                                        [('12', '1', 'Tea and its history', '', '')])
+        with redirect_stdout(io.StringIO()):
+            return update_data.delta_export(None, None, self.file_name, titles)
+
+    def test_titles_added_by_full_export_only(self):
+        self.write_snapshot(titles=False)
+        self.assertFalse(self.delta_export(titles=True))
+        self.assertEqual(update_data.export.description_ids, [])
+        snapshot = marcaroni.snapshot.Snapshot(self.file_name)
+        self.assertEqual(snapshot.meta['watermark'], WATERMARK)
+        self.assertNotIn('titles.ids', snapshot)
+
+    def test_titles_kept_up_to_date(self):
+        self.write_snapshot(titles=True)
+        self.assertTrue(self.delta_export(titles=False))
+        self.assertEqual(update_data.export.description_ids, [{12}])
+        titles = marcaroni.snapshot.TitleIndex(marcaroni.snapshot.Snapshot(self.file_name))
+        self.assertEqual(sorted((titles.record(position).id, titles.description(position).title)
+                                for position in range(len(titles))),
+                         [('10', 'history coffee'), ('12', 'tea its history')])
+
+    def test_no_titles(self):
+        self.write_snapshot(titles=False)
+        self.assertTrue(self.delta_export(titles=False))
+        self.assertEqual(update_data.export.description_ids, [])
+        self.assertNotIn('titles.ids', marcaroni.snapshot.Snapshot(self.file_name))
+
+    def test_not_a_snapshot(self):
+        with open(self.file_name, 'wb') as f:
+            f.write(b'9781234567897,10,1,020,a\n')
+        self.assertFalse(self.delta_export(titles=False))
+
+    def test_full_export_without_csv(self):
+        update_data.export = FakeExport(set(), [('9780306406157', '12', '1', '020', 'a')], [])
+        with redirect_stdout(io.StringIO()):
+            update_data.full_export(None, None, None, self.file_name, titles=False)
+        self.assertEqual(os.listdir(self.directory), ['bib-data.snap'])
+        eg_records = marcaroni.snapshot.SnapshotBibData()
+        eg_records.load_from_file(self.file_name, '020')
+        self.assertEqual([record.id for record in eg_records.match({'9780306406157'})], ['12'])
+
+
+if __name__ == '__main__':
+    unittest.main()
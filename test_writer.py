@@ -0,0 +1,118 @@
+#!/usr/local/bin/python3
+
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pymarc import Field, Record
+
+import marcaroni.rawmarc
+import marcaroni.writer
+
+
+class MockRecord:
+    def __init__(self, data):
+        self.data = data
+
+    def as_marc(self):
+        return self.data
+
+
+class WriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as fp:
+            return fp.read()
+
+    def test_partitions_are_created_when_used(self):
+        writer = marcaroni.writer.Writer(batch_size=3)
+        records = writer.partition(self.path('records.mrc'))
+        writer.partition(self.path('unused.mrc'))
+        report = writer.partition(self.path('report.csv'), 'csv', header=('Title', 'ISBN'))
+        for i in range(10):
+            writer.write(records, b'%d;' % (i,) if i % 2 else MockRecord(b'%d;' % (i,)))
+        writer.write(report, ('A title, with a comma', '9780306406157'))
+        writer.close()
+        writer.close()
+        self.assertEqual(self.read('records.mrc'), b'0;1;2;3;4;5;6;7;8;9;')
+        self.assertEqual(self.read('report.csv'), b'Title,ISBN\r\n"A title, with a comma",9780306406157\r\n')
+        self.assertFalse(os.path.exists(self.path('unused.mrc')))
+        self.assertEqual(records.count, 10)
+
+    def test_flush(self):
+        writer = marcaroni.writer.Writer()
+        ids = writer.partition(self.path('ids.txt'), 'text')
+        writer.write(ids, '123\n')
+        writer.flush()
+        self.assertEqual(ids.size(), 4)
+        self.assertEqual(self.read('ids.txt'), b'123\n')
+        writer.close()
+
+    def test_append(self):
+        with open(self.path('report.csv'), 'wb') as fp:
+            fp.write(b'Title\r\nOne\r\n')
+        writer = marcaroni.writer.Writer()
+        report = writer.partition(self.path('report.csv'), 'csv', header=('Title',), append=True)
+        writer.write(report, ('Two',))
+        writer.close()
+        self.assertEqual(self.read('report.csv'), b'Title\r\nOne\r\nTwo\r\n')
+
+    def test_compressed_partition_is_whole_after_flush(self):
+        writer = marcaroni.writer.Writer()
+        records = writer.partition(self.path('records.mrc.gz'), compression='gz')
+        writer.write(records, b'one;')
+        writer.flush()
+        with gzip.open(self.path('records.mrc.gz')) as fp:
+            self.assertEqual(fp.read(), b'one;')
+        writer.write(records, b'two;')
+        writer.close()
+        with gzip.open(self.path('records.mrc.gz')) as fp:
+            self.assertEqual(fp.read(), b'one;two;')
+
+    def test_records_serialized_when_written(self):
+        record = Record()
+        record.add_field(Field(tag='001', data='1'))
+        record = marcaroni.rawmarc.RawRecord(record.as_marc())
+        expected = record.as_marc()
+        writer = marcaroni.writer.Writer()
+        records = writer.partition(self.path('records.mrc'))
+        writer.write(records, record)
+        record.add_field(Field(tag='901', indicators=[' ', ' '], subfields=['c', '12345']))
+        writer.close()
+        self.assertEqual(self.read('records.mrc'), expected)
+
+    def test_error_is_raised_in_caller(self):
+        writer = marcaroni.writer.Writer(batch_size=1)
+        missing = writer.partition(self.path('missing/records.mrc'))
+        writer.write(missing, b'record')
+        with self.assertRaises(FileNotFoundError):
+            writer.flush()
+        writer.close()
+
+    def test_written_out_at_exit(self):
+        script = ("import sys; sys.path.insert(0, %r)\n"
+                  "import marcaroni.writer\n"
+                  "writer = marcaroni.writer.Writer()\n"
+                  "records = writer.partition(%r)\n"
+                  "for i in range(1000):\n"
+                  "    writer.write(records, b'record')\n"
+                  "sys.exit(1)\n") % (os.path.dirname(os.path.abspath(__file__)), self.path('records.mrc'))
+        result = subprocess.run([sys.executable, '-c', script])
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(self.read('records.mrc'), b'record' * 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,26 +5,54 @@
 #vim: shiftwidth=4:
 
 ##
-# Given a MARC file,
+# Given MARC files, split each into the records not seen before (-deduped), those seen
+# before (-dupes) and those partly seen before (-unsure), going by the values of their
+# keys: 856 $u (the default), and on request 001, 020 $a, 035 $a and the normalized 245.
+#
+# Each key is judged on its own: all its values seen, none, or some. A record is a dupe
+# if every key with values says seen, new if every one says none, and unsure otherwise.
+# Different books may share a title, so the 245 only counts for records without any
+# values of the identifier keys asked for.
+#
+# The values seen are kept in an SQLite registry on disk, so memory use does not grow
+# with the number of records. Files are deduped against each other, in command line
+# order, and with --registry against every file deduped into that registry before.
 
-from pymarc.field import Field
-from pymarc import MARCReader
 import optparse
 import os
+import shutil
+import sqlite3
+import tempfile
+
+from marcaroni import compress
+from marcaroni import rawmarc
+from marcaroni.normalize import canonical_identifier, title_key
+
+KEYS = ['856', '001', '020', '035', '245']
+
+# Keys a record is told by when it has values for them; the 245 only when it has none.
+IDENTIFIER_KEYS = ['856', '001', '020', '035']
+
+# Pages of the registry cached in memory, in KiB. The rest stays on disk.
+REGISTRY_CACHE_KB = 64 * 1024
 
 
 class OutputHandler:
-    def __init__(self, prefix):
+    def __init__(self, prefix, compression=None):
         self.prefix = prefix
-        self.deduped_filename = prefix + '-deduped.mrc'
-        self.deduped_fp = open(self.deduped_filename, 'wb')
-        self.duplicates_filename = prefix + '-dupes.mrc'
-        self.dupes_fp = open(self.duplicates_filename, 'wb')
-        self.unsure_filename = prefix + '-unsure.mrc'
-        self.unsure_fp = open(self.unsure_filename, 'wb')
+        mrc = '.mrc' + compress.extension(compression)
+        self.deduped_filename = prefix + '-deduped' + mrc
+        self.deduped_fp = compress.open_file(self.deduped_filename, 'wb')
+        self.duplicates_filename = prefix + '-dupes' + mrc
+        self.dupes_fp = compress.open_file(self.duplicates_filename, 'wb')
+        self.unsure_filename = prefix + '-unsure' + mrc
+        self.unsure_fp = compress.open_file(self.unsure_filename, 'wb')
         self.count_deduped = self.count_unsure = self.count_dupes = 0
 
-    def __del__(self):
+    def close(self):
+        """
+        Close the output files, and make sure they are on disk.
+        """
         self.deduped_fp.close()
         self.dupes_fp.close()
         self.unsure_fp.close()
@@ -32,6 +60,9 @@ class OutputHandler:
             os.remove(self.duplicates_filename)
         if self.count_unsure == 0:
             os.remove(self.unsure_filename)
+        for filename in (self.deduped_filename, self.duplicates_filename, self.unsure_filename):
+            if os.path.exists(filename):
+                compress.fsync(filename)
 
     def deduped(self, record):
         self.deduped_fp.write(record.as_marc())
@@ -51,61 +82,150 @@ class OutputHandler:
         print("Unsure  : %d records" % (self.count_unsure))
 
 
-def dedupe(filename, key):
-
-    output_handler = OutputHandler(prefix=os.path.splitext(filename)[0])
-    registry = set()
-    double_header_count = 0
-    with open(filename, 'rb') as handler:
-        reader = MARCReader(handler, to_unicode=True, force_utf8=True)
-        for record in reader:
-            found_values = [] # All identifier values in this record.
-            already_found = [] # List of booleans. Was this identifier previously found?
-            id_fields = record.get_fields(key)
-            if key == '856':
-                for f in id_fields:
-                    if f.indicator1 == '4' and f.indicator2 == '0':
-                        found_values.append(f['u'])
-                        already_found.append(f['u'] in registry)
-            if key == '001':
-                for f in id_fields:
-                        found_values.append(f.value())
-                        already_found.append(f.value() in registry)
-            if key == '245':
-                for f in id_fields:
-                        found_values.append(f['a'] + f['b'])
-                        already_found.append((f['a'] + f['b']) in registry)
-
-            if all(already_found):
-                output_handler.dupe(record)
-            elif any(already_found):
-                print("Error: can't tell if dupe.")
-                output_handler.unsure(record)
-                registry |= set(found_values)
-            else:
-                output_handler.deduped(record)
-                registry |= set(found_values)
-        output_handler.write_report()
+class Registry:
+    """
+    The key values seen so far, in an SQLite file.
+
+    The values of a file are added in one transaction, committed once its output files
+    are written. If a run is cut short, the registry is as it was before that file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, isolation_level=None)
+        self.conn.execute("PRAGMA cache_size = -%d" % (REGISTRY_CACHE_KB,))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT NOT NULL, value TEXT NOT NULL, "
+                          "PRIMARY KEY (key, value)) WITHOUT ROWID")
+        self.statements = {}  # dict[int] = str, the insert of that many values
+
+    def begin(self):
+        self.conn.execute("BEGIN")
+
+    def commit(self):
+        self.conn.execute("COMMIT")
+
+    def rollback(self):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+
+    def add(self, values):
+        """
+        :param values: list of distinct (key, value) tuples.
+        :return: int, how many of them were not seen before.
+        """
+        if len(values) not in self.statements:
+            self.statements[len(values)] = "INSERT OR IGNORE INTO seen (key, value) VALUES " + \
+                                           ", ".join(["(?, ?)"] * len(values))
+        return self.conn.execute(self.statements[len(values)], [item for value in values for item in value]).rowcount
+
+    def __len__(self):
+        return self.conn.execute("SELECT count(*) FROM seen").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def key_values(record, key):
+    """
+    :type record: marcaroni.rawmarc.RawRecord
+    :param key: str, one of KEYS.
+    :return: set of str, the values of key in record, normalized.
+    """
+    values = set()
+    if key == '856':
+        for f in record.get_fields('856'):
+            if f.indicator1 == '4' and f.indicator2 == '0':
+                values.update(canonical_identifier(u, '856') for u in f.get_subfields('u'))
+    elif key == '001':
+        values.update(f.value().strip() for f in record.get_fields('001'))
+    elif key in ('020', '035'):
+        for f in record.get_fields(key):
+            values.update(canonical_identifier(a, key) for a in f.get_subfields('a'))
+    elif key == '245':
+        values.update(title_key(' '.join(f.get_subfields('a', 'b', 'n', 'p'))) for f in record.get_fields('245'))
+    values.discard(None)
+    values.discard('')
+    return values
+
+
+def dedupe(filename, keys, registry):
+
+    output_handler = OutputHandler(prefix=os.path.splitext(compress.uncompressed_name(filename))[0],
+                                   compression=compress.compression_of(filename))
+    registry.begin()
+    try:
+        with compress.open_input(filename) as handler:
+            for sequence, data in enumerate(rawmarc.read_raw_records(handler), 1):
+                # Passed through byte for byte.
+                record = rawmarc.RawRecord(data)
+                counts = {}  # dict[str] = (int, int), values of a key and how many were new
+                for key in keys:
+                    values = [(key, value) for value in sorted(key_values(record, key))]
+                    if values:
+                        counts[key] = (len(values), registry.add(values))
+                judged = [key for key in counts if key in IDENTIFIER_KEYS] or list(counts)
+
+                if not judged:
+                    # Nothing to tell it by.
+                    output_handler.deduped(record)
+                elif all(counts[key][1] == 0 for key in judged):
+                    output_handler.dupe(record)
+                elif all(counts[key][1] == counts[key][0] for key in judged):
+                    output_handler.deduped(record)
+                else:
+                    print("Error: can't tell if dupe: record %d, %s." % (sequence, ', '.join(
+                        "%d of its %d %s seen before" % (counts[key][0] - counts[key][1], counts[key][0], key)
+                        for key in judged)))
+                    output_handler.unsure(record)
+        output_handler.close()
+        registry.commit()
+    except BaseException:
+        registry.rollback()
+        raise
+    output_handler.write_report()
 
 
 def parse_cmd_line():
     parser = optparse.OptionParser(usage="%prog INPUT_FILE [ ... INPUT_FILE_N ]")
-    parser.add_option("-k", "--key", dest="key", default="856",
-                      help="Key to use to dedupe - available values 856 [def], 001, 245.")
+    parser.add_option("-k", "--key", dest="key", default='856',
+                      help="Keys to dedupe on, separated by commas: 856 ($u), 001, 020, 035, 245 (normalized "
+                           "title). A record is a dupe if all the values of each key were seen before, and "
+                           "unsure if only some were. The 245 only counts for records without values of the "
+                           "other keys. [default: %default]")
+    parser.add_option("-r", "--registry", dest="registry", default=None,
+                      help="SQLite file of the values seen, created if need be. Files deduped into it on earlier "
+                           "runs count as seen. Without it, only the files on the command line are compared.")
     opts, args = parser.parse_args()
 
+    keys = [key.strip() for key in opts.key.split(',') if key.strip()]
+    for key in keys:
+        if key not in KEYS:
+            parser.error("Unknown key [%s]; available keys are %s." % (key, ', '.join(KEYS)))
+    if not keys:
+        parser.error("Need at least one key.")
     if len(args) < 1:
         parser.error("Need at least one input file on command line.")
-    return opts.key, args
+    return keys, opts.registry, args
 
 
 def main():
-    key, input_files = parse_cmd_line()
-    for file in input_files:
-        if os.path.exists(file):
-            dedupe(file, key)
-        else:
-            print("File not found: [%s]" % (file,))
+    keys, registry_filename, input_files = parse_cmd_line()
+    temporary_directory = None
+    if registry_filename is None:
+        temporary_directory = tempfile.mkdtemp()
+        registry_filename = os.path.join(temporary_directory, 'registry.sqlite')
+    registry = Registry(registry_filename)
+    try:
+        for file in input_files:
+            if os.path.exists(file):
+                dedupe(file, keys, registry)
+            else:
+                print("File not found: [%s]" % (file,))
+        if temporary_directory is None:
+            print("Registry: %d values in %s" % (len(registry), registry_filename))
+    finally:
+        registry.close()
+        if temporary_directory is not None:
+            shutil.rmtree(temporary_directory)
 
 
 if __name__ == '__main__':
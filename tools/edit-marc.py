@@ -10,13 +10,15 @@ from pymarc import RecordLengthInvalid
 import optparse
 import os
 
+from marcaroni import compress
+
 
 class OutputHandler:
-    def __init__(self, prefix):
+    def __init__(self, prefix, compression=None):
         self.prefix = prefix
-        self.output_filename = prefix + '-pyedited' + '.mrc'
+        self.output_filename = prefix + '-pyedited' + '.mrc' + compress.extension(compression)
         print(self.output_filename)
-        self.output_fp = open(self.output_filename, 'wb')
+        self.output_fp = compress.open_file(self.output_filename, 'wb')
         self.count_edited = self.count_missing = 0
 
     def __del__(self):
@@ -91,8 +93,9 @@ RULES = [
 
 def process(filename):
 
-    output_handler = OutputHandler(prefix=os.path.splitext(filename)[0])
-    with open(filename, 'rb') as handler:
+    output_handler = OutputHandler(prefix=os.path.splitext(compress.uncompressed_name(filename))[0],
+                                   compression=compress.compression_of(filename))
+    with compress.open_input(filename) as handler:
         reader = MARCReader(handler, to_unicode=True, force_utf8=True)
         record = reader.__next__()
         while record:
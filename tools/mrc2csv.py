@@ -13,6 +13,8 @@ import optparse
 import os
 import csv
 
+from marcaroni import compress
+
 class OutputHandler:
     def __init__(self, prefix):
         self.prefix = prefix
@@ -41,8 +43,8 @@ def parse_cmd_line():
 
 def makecsv(file):
     header = ['001', '245', '856', '944', '950']
-    output_handler = OutputHandler(prefix=os.path.splitext(file)[0])
-    with open(file, 'rb') as handler:
+    output_handler = OutputHandler(prefix=os.path.splitext(compress.uncompressed_name(file))[0])
+    with compress.open_input(file) as handler:
         reader = MARCReader(handler, to_unicode=True, force_utf8=True)
         output_handler.write(header)
         for record in reader:
@@ -12,12 +12,14 @@ from pymarc import MARCReader
 import optparse
 import os
 
+from marcaroni import compress
+
 
 class OutputHandler:
-    def __init__(self, prefix):
+    def __init__(self, prefix, compression=None):
         self.prefix = prefix
-        self.output_filename = prefix + '-head.mrc'
-        self.output_fp = open(self.output_filename, 'wb')
+        self.output_filename = prefix + '-head.mrc' + compress.extension(compression)
+        self.output_fp = compress.open_file(self.output_filename, 'wb')
 
     def __del__(self):
         self.output_fp.close()
@@ -26,8 +28,9 @@ class OutputHandler:
         self.output_fp.write(record.as_marc())
 
 def head(filename, max_count):
-    output_handler = OutputHandler(prefix=os.path.splitext(filename)[0])
-    with open(filename, 'rb') as handler:
+    output_handler = OutputHandler(prefix=os.path.splitext(compress.uncompressed_name(filename))[0],
+                                   compression=compress.compression_of(filename))
+    with compress.open_input(filename) as handler:
         reader = MARCReader(handler, to_unicode=True, force_utf8=True)
         count = 0
         for record in reader:
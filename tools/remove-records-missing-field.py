@@ -9,14 +9,16 @@ from pymarc import MARCReader
 import optparse
 import os
 
+from marcaroni import compress
+
 
 class OutputHandler:
-    def __init__(self, prefix, tag):
+    def __init__(self, prefix, tag, compression=None):
         self.prefix = prefix
-        self.filtered_filename = prefix + '-containing-' + tag + '.mrc'
-        self.filtered_fp = open(self.filtered_filename, 'wb')
-        self.missing_filename = prefix + '-missing-' + tag + '.mrc'
-        self.missing_fp = open(self.missing_filename, 'wb')
+        self.filtered_filename = prefix + '-containing-' + tag + '.mrc' + compress.extension(compression)
+        self.filtered_fp = compress.open_file(self.filtered_filename, 'wb')
+        self.missing_filename = prefix + '-missing-' + tag + '.mrc' + compress.extension(compression)
+        self.missing_fp = compress.open_file(self.missing_filename, 'wb')
         self.count_filtered = self.count_missing = 0
 
     def __del__(self):
@@ -40,8 +42,9 @@ class OutputHandler:
 
 def filter(filename, tag):
 
-    output_handler = OutputHandler(prefix=os.path.splitext(filename)[0], tag=tag)
-    with open(filename, 'rb') as handler:
+    output_handler = OutputHandler(prefix=os.path.splitext(compress.uncompressed_name(filename))[0], tag=tag,
+                                   compression=compress.compression_of(filename))
+    with compress.open_input(filename) as handler:
         reader = MARCReader(handler, to_unicode=True, force_utf8=True)
         for record in reader:
             #print(record['245']['a'])
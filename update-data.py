@@ -5,54 +5,177 @@
 # vim: shiftwidth=2:
 
 from marcaroni import db
-import re
+from marcaroni import export
+from marcaroni import live
+from marcaroni import snapshot
+import optparse
+import os
+import shutil
+import tempfile
 
-try:
+
+def parse_cmd_line():
+  parser = optparse.OptionParser(usage="%prog [options]")
+  parser.add_option("-o", "--output", dest="output", default=None,
+                    help="CSV file of Bib Data to write, compressed if it ends in .gz, .bz2 or .xz. "
+                         "[default: bib-data.txt]")
+  parser.add_option("--snapshot", dest="snapshot", default=None,
+                    help="Also compile the bib data into a memory-mapped snapshot file, e.g. bib-data.snap. "
+                         "bibmatcher.py accepts it in place of the CSV file. Compressed if it ends in .gz, .bz2 "
+                         "or .xz, in which case it is read into memory rather than mapped.")
+  parser.add_option("--titles", action="store_true", dest="titles", default=False,
+                    help="Also put the title, main entry and date of each record in the --snapshot, for "
+                         "bibmatcher.py --fallback.")
+  parser.add_option("--delta", action="store_true", dest="delta", default=False,
+                    help="Refresh the existing --snapshot with only the records created, edited or deleted "
+                         "since it was written. Only the snapshot is written, never the CSV file, even when "
+                         "a full export is needed.")
+  parser.add_option("--live-indexes", action="store_true", dest="live_indexes", default=False,
+                    help="Create the indexes on metabib.real_full_rec that bibmatcher.py --live matches 020 "
+                         "and 035 with, if missing, and exit. Needs the right to create indexes.")
+  parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                    help="Export id ranges over this many database connections at once. [default: %default]")
+  opts, args = parser.parse_args()
+  if opts.delta and not opts.snapshot:
+    parser.error("--delta needs a --snapshot file to refresh.")
+  if opts.delta and opts.output:
+    parser.error("--delta does not write the CSV file; leave out --output.")
+  if not opts.delta and not opts.output:
+    opts.output = "bib-data.txt"
+  if opts.titles and not opts.snapshot:
+    parser.error("--titles needs a --snapshot file to write them to.")
+  if opts.jobs < 1:
+    parser.error("--jobs must be at least 1.")
+  return opts.output, opts.snapshot, opts.delta, opts.jobs, opts.titles, opts.live_indexes
+
+
+def add_descriptions(conn, builder, record_ids=None):
+  print('Exporting titles...')
+  for row in export.export_descriptions(conn, record_ids):
+    builder.add_description(row)
+
+
+def snapshot_builder(snapshot_file_name):
+  # The builder spills sorted runs of rows next to the snapshot, rather than in /tmp.
+  return snapshot.SnapshotBuilder(os.path.dirname(os.path.abspath(snapshot_file_name)))
+
+
+def full_export(conn, cur, output_file_name, snapshot_file_name, titles):
+  builder = snapshot_builder(snapshot_file_name) if snapshot_file_name else None
+  if builder is not None:
+    builder.meta['watermark'] = export.read_watermark(cur)
+
+  def rows():
+    for row in export.export_rows(conn):
+      if builder is not None:
+        builder.add(row)
+      yield row
+
+  #debug
+  print('Starting query...')
+  if output_file_name is None:
+    for row in rows():
+      pass
+  else:
+    export.publish_csv(rows(), output_file_name)
+
+  if builder is not None:
+    if titles:
+      add_descriptions(conn, builder)
+    print('Writing snapshot %s...' % (snapshot_file_name,))
+    builder.write(snapshot_file_name)
+
+
+def parallel_export(conn, cur, output_file_name, snapshot_file_name, jobs, titles):
+  builder = snapshot_builder(snapshot_file_name) if snapshot_file_name else None
+  if builder is not None:
+    builder.meta['watermark'] = export.read_watermark(cur)
+
+  directory = tempfile.mkdtemp(prefix='bib-data-shards-',
+                               dir=os.path.dirname(os.path.abspath(output_file_name or snapshot_file_name)))
+  try:
+    print('Starting %d exports...' % (jobs,))
+    shard_file_names = export.export_shards(cur, jobs, directory)
+    if output_file_name is not None:
+      print('Merging shards...')
+      export.publish_shards(shard_file_names, output_file_name)
+    if builder is not None:
+      for shard_file_name in shard_file_names:
+        for row in export.read_shard(shard_file_name):
+          builder.add(row)
+      if titles:
+        add_descriptions(conn, builder)
+      print('Writing snapshot %s...' % (snapshot_file_name,))
+      builder.write(snapshot_file_name)
+  finally:
+    shutil.rmtree(directory)
+
+
+def delta_export(conn, cur, snapshot_file_name, titles):
+  try:
+    previous = snapshot.Snapshot(snapshot_file_name)
+  except snapshot.SnapshotError as e:
+    # Left by an older version, or not a snapshot at all: it is written over.
+    print(e)
+    return False
+  watermark = previous.meta.get('watermark')
+  if watermark is None:
+    print('No watermark found in [%s].' % (snapshot_file_name,))
+    return False
+  if titles and 'titles.ids' not in previous:
+    # The titles of the records that did not change would be missing.
+    print('No titles in [%s] yet.' % (snapshot_file_name,))
+    return False
+
+  builder = snapshot_builder(snapshot_file_name)
+  builder.meta['watermark'] = export.read_watermark(cur)
+  changed_ids = export.changed_record_ids(cur, watermark)
+  print('%d records changed since %s.' % (len(changed_ids), watermark['edit_date']))
+
+  builder.merge(previous, changed_ids)
+  if changed_ids:
+    for row in export.export_rows(conn, changed_ids):
+      builder.add(row)
+    if titles or 'titles.ids' in previous:
+      add_descriptions(conn, builder, changed_ids)
+
+  print('Writing snapshot %s...' % (snapshot_file_name,))
+  builder.write(snapshot_file_name)
+  return True
+
+
+def main():
+  output_file_name, snapshot_file_name, delta, jobs, titles, live_indexes = parse_cmd_line()
+  try:
     conn = db.connect()
     cur = conn.cursor()
-except Exception as e:
+  except Exception as e:
     print("Update data could not connect.")
     exit(1)
-else:
-    output = open('bib-data.txt', 'w')
-    output.write('identifier,id,source,tag,subfield\n')
-    errors = open('shitty-isbns.txt','w')
-
-    #debug
-    print('Starting query...')
-    #cur.copy_expert("COPY (SELECT bre.id, bre.source, rfr.value FROM biblio.record_entry bre JOIN metabib.real_full_rec rfr ON bre.id = rfr.record WHERE not bre.deleted AND rfr.tag = '020' AND rfr.subfield in ('a','z') and bre.source is not NULL) TO STDOUT WITH CSV HEADER", data_dictionary)
-    cur.execute("SELECT bre.id, bre.source, rfr.value, rfr.tag, rfr.subfield FROM biblio.record_entry bre JOIN metabib.real_full_rec rfr ON bre.id = rfr.record WHERE not bre.deleted AND (rfr.tag = '020' OR  rfr.tag = '035') AND (rfr.subfield = 'a' OR rfr.subfield = 'z') and bre.source is not NULL")
-
-    #debug
-    print('Query finished. Cleaning data...')
-    for row in cur:
-      identifier = row[2].strip()
-      identifier = identifier.strip(',')
-      if str(row[3]) == '020':
-          identifier = identifier.split(' ')[0]
-          identifier = identifier.strip('-')
-          identifier = identifier.split('ü')[0] ## Delete me when umlauts are fixed
-          identifier = identifier.split('(')[0]
-          identifier = identifier.split('\\')[0]
-          ## If ISBN is the wrong length, warn but don't break
-          # if len(identifier) != 10 and len(identifier) != 13:
-            ## print("We probably have not found a good isbn here: " + cleaned)
-            # errors.write(','.join(map(str,row)))
-            # errors.write('\n')
-          ## Only consider matchable isbns strings that are between 9 and 14 chars.
-          if len(identifier) < 9 or len(identifier) > 14:
-              continue
-      elif str(row[3]) == '856':
-          identifier = re.sub(r'.* ca login url ','',identifier)
-      else:
-          if not any(i.isdigit() for i in identifier):
-              continue
-      if len(identifier) == 0:
-          continue
-      output.write(','.join((str(identifier), str(row[0]), str(row[1]), str(row[3]), str(row[4]))))
-      output.write('\n')
-
-    #debug
+
+  if live_indexes:
+    cur.close()
+    live.create_indexes(conn)
     print('Done.')
+    conn.close()
+    return
+
+  refreshed = False
+  if delta and os.path.exists(snapshot_file_name):
+    refreshed = delta_export(conn, cur, snapshot_file_name, titles)
+  if not refreshed:
+    if delta:
+      print('Running a full export.')
+    if jobs > 1:
+      parallel_export(conn, cur, output_file_name, snapshot_file_name, jobs, titles)
+    else:
+      full_export(conn, cur, output_file_name, snapshot_file_name, titles)
+
+  #debug
+  print('Done.')
+  cur.close()
+  conn.close()
+
 
-    exit()
+if __name__ == '__main__':
+  main()